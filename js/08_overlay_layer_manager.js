@@ -5,7 +5,7 @@
  * 依赖：
  *  - window.map 已存在（01_map_init.js 里已做 window.map = map）
  *  - OpenLayers 全局对象 ol 已引入
- *  - （可选）window.RasterOpsAPI 或 window.rasteropsApi 中提供 deleteAsset(assetId, opts)
+ *  - （可选）window.RasterOpsAPI 或 window.rasteropsApi 中提供 deleteAsset(assetId, opts) / bulkAssets(action, ids, opts)
  *
  * 推荐用法：
  *  1) 在 index.html 里引入本文件（放在 01_map_init.js 之后、82_rasterops_panel.js 之前/之后均可，但要确保 window.map 已就绪）
@@ -26,6 +26,38 @@
     return String(s ?? '').replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c]));
   }
 
+  function rasteropsBase() {
+    return (window.RASTEROPS_BASE_URL || 'http://10.8.49.5:9001').replace(/\/$/,'');
+  }
+
+  // 批量删除(服务器)：提交一个 bulk 任务并等待结束，返回 job.result.items（assetId -> {ok, error}）
+  async function bulkDeleteOnServer(assetIds) {
+    const opts = { unpublish: true, delete_files: true, purge: 'all' };
+    const Api = window.RasterOpsAPI;
+    const api = typeof Api === 'function' ? new Api() : window.rasteropsApi;
+    let job;
+    if (api?.bulkAssets && api?.watchJob) {
+      job = await api.bulkAssets('delete', assetIds, opts);
+      job = await api.watchJob(job.id, null, 1000);
+    } else {
+      const resp = await fetch(`${rasteropsBase()}/api/assets/bulk`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(Object.assign({ action: 'delete', asset_ids: assetIds }, opts)),
+      });
+      if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+      job = await resp.json();
+      while (['done', 'error', 'cancelled'].indexOf(job.status) < 0) {
+        await new Promise((r) => setTimeout(r, 1000));
+        const r2 = await fetch(`${rasteropsBase()}/api/jobs/${encodeURIComponent(job.id)}`);
+        if (!r2.ok) throw new Error(`HTTP ${r2.status}`);
+        job = await r2.json();
+      }
+    }
+    if (job.status !== 'done') throw new Error(job.message || job.status);
+    return (job.result && job.result.items) || {};
+  }
+
   // ---------- OverlayGroup 初始化 ----------
   function ensureOverlayGroup() {
     if (!window.map || !window.ol) return null;
@@ -67,6 +99,40 @@
     if (emptyTip) emptyTip.style.display = layers.length ? 'none' : 'block';
     if (!layers.length) return;
 
+    // 多个 rasterops 图层时提供“全部删除(服务器)”：一次 bulk 任务，按逐项结果移除图层
+    const assetLayers = layers.filter((l) => l.get('__assetId'));
+    const assetIds = [...new Set(assetLayers.map((l) => l.get('__assetId')))];
+    if (assetIds.length > 1) {
+      const bar = document.createElement('div');
+      bar.style.cssText = 'display:flex;justify-content:flex-end;padding:2px 0 4px;';
+      const btnDeleteAll = document.createElement('button');
+      btnDeleteAll.textContent = `全部删除(${assetIds.length})`;
+      btnDeleteAll.title = '批量从服务器删除这些图层对应的资产（取消发布 + 删除上传文件）';
+      btnDeleteAll.style.cssText = 'padding:2px 6px;border:0;border-radius:3px;background:#e53e3e;color:#fff;cursor:pointer;font-size:11px;';
+      btnDeleteAll.addEventListener('click', async () => {
+        const ok = window.confirm(`确认删除 ${assetIds.length} 个资产？\n\n这会尝试：取消发布 GeoServer + 删除后端文件。`);
+        if (!ok) return;
+        btnDeleteAll.disabled = true;
+        btnDeleteAll.textContent = '删除中...';
+        try {
+          const items = await bulkDeleteOnServer(assetIds);
+          assetLayers.forEach((l) => {
+            const r = items[l.get('__assetId')];
+            if (r && r.ok) overlayGroup.getLayers().remove(l);
+          });
+          const failed = assetIds.filter((id) => !(items[id] && items[id].ok));
+          if (failed.length) alert(`${failed.length} 个资产删除失败：${items[failed[0]]?.error || failed[0]}`);
+        } catch (e) {
+          console.error('[LayerManager] 批量删除失败', e);
+          alert(`批量删除失败：${e?.message || e}`);
+        } finally {
+          window.refreshLayerManager();
+        }
+      });
+      bar.appendChild(btnDeleteAll);
+      container.appendChild(bar);
+    }
+
     layers.forEach((layer, idx) => {
       const title = layer.get('title') || layer.get('name') || `栅格图层_${idx + 1}`;
       const visible = layer.getVisible?.() ?? true;
@@ -133,8 +199,7 @@
           if (api?.deleteAsset) {
             await api.deleteAsset(assetId, { unpublish: true, delete_files: true, purge: 'all' });
           } else {
-            const base = (window.RASTEROPS_BASE_URL || 'http://10.8.49.5:9001').replace(/\/$/,'');
-            const url = `${base}/api/assets/${encodeURIComponent(assetId)}?unpublish=true&delete_files=true&purge=all`;
+            const url = `${rasteropsBase()}/api/assets/${encodeURIComponent(assetId)}?unpublish=true&delete_files=true&purge=all`;
             const resp = await fetch(url, { method: 'DELETE' });
             if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
           }
@@ -1,6 +1,8 @@
 /**
  * 09_raster_getfeatureinfo.js
- * 目的：为“栅格/WMS 图层”提供合理的“图查属性”——点查像元/coverage 信息（WMS GetFeatureInfo）。
+ * 目的：为“栅格/WMS 图层”提供合理的“图查属性”——点查像元/coverage 信息。
+ *  - rasterops 图层（带 __assetId，含 XYZ 预览）直接调 rasterops 取值接口 /api/assets/{id}/sample
+ *  - 其他 WMS 图层走 WMS GetFeatureInfo
  *
  * 设计原则：
  *  - 不破坏你现有的矢量（WFS）图查属性逻辑
@@ -23,12 +25,25 @@
     const arr = og.getLayers().getArray();
     return arr.filter(l => {
       if (!l || !l.getVisible || !l.getVisible()) return false;
+      if (l.get && l.get('__assetId')) return true;
       const src = l.getSource && l.getSource();
       // TileWMS / ImageWMS 都支持 getFeatureInfoUrl（ImageWMS 在 source 上也有）
       return src && typeof src.getFeatureInfoUrl === 'function';
     });
   }
 
+  // rasterops 资产点查：返回与 GetFeatureInfo text/plain 类似的文本
+  async function sampleRasteropsAt(assetId, coordinate, crs) {
+    const Api = window.RasterOpsAPI;
+    if (typeof Api !== 'function') throw new Error('RasterOpsAPI 未加载');
+    const r = await new Api().sample(assetId, { points: [coordinate], crs });
+    const vals = r.values && r.values[0];
+    if (!vals) return '';
+    const lines = r.bands.map((b, i) => `band_${b} = ${vals[i] === null ? 'nodata' : vals[i]}`);
+    lines.unshift(`pixel (col, row) = ${r.col[0]}, ${r.row[0]}`);
+    return lines.join('\n');
+  }
+
   function pickTopLayer(layers) {
     if (!layers.length) return null;
     // 规则：优先 zIndex 大的；若无 zIndex，就取数组最后一个（通常是最上层）
@@ -66,6 +81,18 @@
     const layer = pickTopLayer(candidates);
     if (!layer) return;
 
+    const assetId = layer.get && layer.get('__assetId');
+    if (assetId) {
+      let text = '';
+      try {
+        text = await sampleRasteropsAt(assetId, evt.coordinate, map.getView().getProjection().getCode());
+      } catch (e) {
+        text = `取值请求失败：${e.message || e}`;
+      }
+      renderResult(layer.get('title') || assetId, '栅格点查（rasterops）', evt.coordinate, text);
+      return;
+    }
+
     const src = layer.getSource();
     const view = map.getView();
     const resolution = view.getResolution();
@@ -98,15 +125,18 @@
       text = `GetFeatureInfo 请求失败：${e.message || e}`;
     }
 
-    // 输出到你现有的弹窗容器
+    renderResult(layer.get('title') || layersParam || 'Raster/WMS', '栅格点查（WMS GetFeatureInfo）', evt.coordinate, text);
+  }
+
+  // 输出到你现有的弹窗容器
+  function renderResult(title, heading, coordinate, text) {
     try {
-      const title = layer.get('title') || layersParam || 'Raster/WMS';
-      const lonlat = ol.proj.toLonLat(evt.coordinate);
+      const lonlat = ol.proj.toLonLat(coordinate);
       const header = `
-        <div style="font-weight:600;margin-bottom:6px;">栅格点查（WMS GetFeatureInfo）</div>
+        <div style="font-weight:600;margin-bottom:6px;">${htmlEscape(heading)}</div>
         <div style="font-size:12px;color:#666;margin-bottom:8px;">
           图层：${htmlEscape(title)}<br/>
-          坐标(EPSG:3857)：${evt.coordinate.map(v => v.toFixed(2)).join(', ')}<br/>
+          坐标(EPSG:3857)：${coordinate.map(v => v.toFixed(2)).join(', ')}<br/>
           坐标(经纬度)：${lonlat.map(v => v.toFixed(6)).join(', ')}
         </div>
       `;
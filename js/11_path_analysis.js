@@ -153,15 +153,65 @@
                 document.getElementById('path-distance').innerText = (route.distance / 1000).toFixed(2);
                 document.getElementById('path-duration').innerText = Math.ceil(route.duration / 60);
                 setOperationTip('✅ 规划成功', true);
+                showRasterProfile(route.geometry.coordinates);
             }
         } catch (e) {
             setOperationTip('❌ API 请求失败', true);
         }
     });
 
+    // 沿路线的栅格剖面：取最上层可见的 rasterops 图层，一次请求 /api/assets/{id}/sample
+    function topRasteropsAssetId() {
+        const og = window.webgisOverlayGroup;
+        if (!og || !og.getLayers) return null;
+        const layers = og.getLayers().getArray().filter(l => l.getVisible && l.getVisible() && l.get('__assetId'));
+        return layers.length ? layers[layers.length - 1].get('__assetId') : null;
+    }
+
+    function profileBox() {
+        let box = document.getElementById('path-raster-profile');
+        if (!box) {
+            box = document.createElement('div');
+            box.id = 'path-raster-profile';
+            box.style.cssText = 'margin-top:6px;font-size:12px;color:#555;';
+            document.getElementById('path-results-section').appendChild(box);
+        }
+        return box;
+    }
+
+    async function showRasterProfile(lonlats) {
+        const assetId = topRasteropsAssetId();
+        const box = profileBox();
+        if (!assetId || typeof window.RasterOpsAPI !== 'function') {
+            box.innerText = '';
+            return;
+        }
+        // 顶点过多时抽稀（服务端还会按像元大小加密）
+        const k = Math.ceil(lonlats.length / 2000);
+        const line = lonlats.filter((_, i) => i % k === 0 || i === lonlats.length - 1);
+        try {
+            const r = await new window.RasterOpsAPI().sample(assetId, { line, crs: 'EPSG:4326', bands: [1] });
+            const vals = r.values.map(v => (v ? v[0] : null)).filter(v => v !== null);
+            if (!vals.length) {
+                box.innerText = '沿线栅格值：路线不在栅格范围内';
+                return;
+            }
+            const min = Math.min(...vals);
+            const max = Math.max(...vals);
+            const first = r.values[0] ? r.values[0][0] : '-';
+            const last = r.values[r.count - 1] ? r.values[r.count - 1][0] : '-';
+            box.innerText = `沿线栅格值（${r.count} 个采样点）：起 ${first} / 终 ${last} / 最低 ${min} / 最高 ${max}`;
+            window.lastPathProfile = r;
+        } catch (e) {
+            box.innerText = `沿线栅格取值失败：${e.message || e}`;
+        }
+    }
+
     function clearAll() {
         pathSource.clear();
         pathPoints = { start: null, end: null, waypoints: [], barriers: [] };
+        const profile = document.getElementById('path-raster-profile');
+        if (profile) profile.innerText = '';
         document.getElementById('path-results-section').style.display = 'none';
     }
 
@@ -1,4 +1,10 @@
 (function () {
+  const TERMINAL_STATUSES = ['done', 'error', 'cancelled'];
+
+  function isTerminalStatus(status) {
+    return TERMINAL_STATUSES.indexOf(status) >= 0;
+  }
+
   function joinUrl(base, path) {
     if (base.endsWith('/')) base = base.slice(0, -1);
     if (!path.startsWith('/')) path = '/' + path;
@@ -10,10 +16,23 @@
       this.baseUrl = baseUrl || window.RASTEROPS_BASE_URL;
     }
 
-    async listAssets() {
-      const r = await fetch(joinUrl(this.baseUrl, '/api/assets'));
+    async listAssets(opts) {
+      // opts（可选）：limit / cursor / kind / published / prefix / created_from / created_to / slim
+      // 分页时下一页游标在响应头 X-Next-Cursor，见 listAssetsPage
+      const page = await this.listAssetsPage(opts);
+      return page.items;
+    }
+
+    async listAssetsPage(opts) {
+      opts = opts || {};
+      const qs = new URLSearchParams();
+      Object.keys(opts).forEach((k) => {
+        if (opts[k] !== undefined && opts[k] !== null && opts[k] !== '') qs.set(k, String(opts[k]));
+      });
+      const suffix = qs.toString() ? `?${qs.toString()}` : '';
+      const r = await fetch(joinUrl(this.baseUrl, `/api/assets${suffix}`));
       if (!r.ok) throw new Error(await r.text());
-      return await r.json();
+      return { items: await r.json(), nextCursor: r.headers.get('X-Next-Cursor') };
     }
 
     async upload(file) {
@@ -27,6 +46,7 @@
       return await r.json();
     }
 
+    // 发布到 GeoServer（后台任务）：返回 job，可用 watchJob 等待完成
     async publish(assetId) {
       const r = await fetch(joinUrl(this.baseUrl, `/api/assets/${assetId}/publish`), {
         method: 'POST',
@@ -35,6 +55,60 @@
       return await r.json();
     }
 
+    // 资产预览瓦片：TileJSON（范围/最大级别）与 XYZ URL 模板（可带 bands/vmin/vmax/resampling）
+    async getTileJson(assetId) {
+      const r = await fetch(joinUrl(this.baseUrl, `/api/assets/${assetId}/tiles.json`));
+      if (!r.ok) throw new Error(await r.text());
+      return await r.json();
+    }
+
+    // 波段统计（min/max/mean/std、percentiles、histogram）：默认近似（读 overview），exact=true 只要精确结果
+    async getStats(assetId, opts) {
+      const exact = opts && opts.exact ? '?exact=true' : '';
+      const r = await fetch(joinUrl(this.baseUrl, `/api/assets/${assetId}/stats${exact}`));
+      if (!r.ok) throw new Error(await r.text());
+      return await r.json();
+    }
+
+    // 提交全量统计任务，返回 job
+    async computeStats(assetId) {
+      const r = await fetch(joinUrl(this.baseUrl, `/api/assets/${assetId}/stats`), { method: 'POST' });
+      if (!r.ok) throw new Error(await r.text());
+      return await r.json();
+    }
+
+    // 批量取值：body = { points: [[x,y],...] } 或 { line: [[x,y],...], step }，可带 crs（默认 EPSG:4326）/ bands。
+    // 返回 { x, y, col, row, values: [[各波段值]|null, ...], distance（折线，米） }
+    async sample(assetId, body) {
+      const r = await fetch(joinUrl(this.baseUrl, `/api/assets/${assetId}/sample`), {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body),
+      });
+      if (!r.ok) throw new Error(await r.text());
+      return await r.json();
+    }
+
+    tileUrlTemplate(assetId, opts) {
+      const qs = new URLSearchParams();
+      Object.entries(opts || {}).forEach(([k, v]) => {
+        if (v !== undefined && v !== null && v !== '') qs.set(k, String(v));
+      });
+      const suffix = qs.toString() ? `?${qs.toString()}` : '';
+      return joinUrl(this.baseUrl, `/api/assets/${assetId}/tiles/{z}/{x}/{y}.png${suffix}`);
+    }
+
+    // 裁剪下载 URL（GeoTIFF）：opts 可含 bbox（[minx,miny,maxx,maxy] 或字符串）/ bbox_crs / bands / res / resampling
+    subsetUrl(assetId, opts) {
+      const qs = new URLSearchParams();
+      Object.entries(opts || {}).forEach(([k, v]) => {
+        if (v === undefined || v === null || v === '') return;
+        qs.set(k, Array.isArray(v) ? v.join(',') : String(v));
+      });
+      const suffix = qs.toString() ? `?${qs.toString()}` : '';
+      return joinUrl(this.baseUrl, `/api/assets/${assetId}/subset${suffix}`);
+    }
+
     async deleteAsset(assetId, opts) {
       opts = opts || {};
       const qs = new URLSearchParams();
@@ -49,6 +123,18 @@
       return await r.json();
     }
 
+    // 批量操作（后台任务）：action = publish / unpublish / delete；
+    // opts（可选）：purge / unpublish / delete_files。返回 job，完成后逐项结果在 job.result.items
+    async bulkAssets(action, assetIds, opts) {
+      const r = await fetch(joinUrl(this.baseUrl, '/api/assets/bulk'), {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(Object.assign({ action, asset_ids: assetIds }, opts || {})),
+      });
+      if (!r.ok) throw new Error(await r.text());
+      return await r.json();
+    }
+
     async createCalcJob(payload) {
       const r = await fetch(joinUrl(this.baseUrl, '/api/raster/calc'), {
         method: 'POST',
@@ -74,6 +160,46 @@
       if (!r.ok) throw new Error(await r.text());
       return await r.json();
     }
+
+    // 取消任务：排队中的立即取消，运行中的会在下一个检查点退出（返回更新后的 job）
+    async cancelJob(jobId) {
+      const r = await fetch(joinUrl(this.baseUrl, `/api/jobs/${jobId}`), { method: 'DELETE' });
+      if (!r.ok) throw new Error(await r.text());
+      return await r.json();
+    }
+
+    // 订阅任务进度（SSE）：每次状态/进度变化回调 onUpdate，到达终态（done/error/cancelled）时 resolve 最终 job。
+    // 浏览器不支持 EventSource 或连接失败时退回轮询。
+    watchJob(jobId, onUpdate, intervalMs) {
+      const poll = async () => {
+        for (;;) {
+          const j = await this.getJob(jobId);
+          if (onUpdate) onUpdate(j);
+          if (isTerminalStatus(j.status)) return j;
+          await new Promise((r) => setTimeout(r, intervalMs || 1000));
+        }
+      };
+      if (typeof window.EventSource !== 'function') return poll();
+
+      return new Promise((resolve, reject) => {
+        const es = new EventSource(joinUrl(this.baseUrl, `/api/jobs/${jobId}/events`));
+        let finished = false;
+        es.addEventListener('job', (ev) => {
+          const j = JSON.parse(ev.data);
+          if (onUpdate) onUpdate(j);
+          if (isTerminalStatus(j.status)) {
+            finished = true;
+            es.close();
+            resolve(j);
+          }
+        });
+        es.onerror = () => {
+          if (finished) return;
+          es.close();
+          poll().then(resolve, reject);
+        };
+      });
+    }
   }
 
   window.RasterOpsAPI = RasterOpsAPI;
@@ -99,6 +99,65 @@
     return layer;
 }
 
+  // 按波段统计的 2%/98% 分位数给出拉伸区间 {bands, vmin, vmax}；统计不可用时返回 null
+  function stretchFromStats(stats, bands) {
+    const byBand = {};
+    ((stats && stats.bands) || []).forEach((b) => { byBand[b.band] = b; });
+    const lo = [];
+    const hi = [];
+    for (const b of bands) {
+      const s = byBand[b];
+      if (!s || !s.percentiles || s.percentiles['2'] === undefined) return null;
+      lo.push(s.percentiles['2']);
+      hi.push(s.percentiles['98'] > s.percentiles['2'] ? s.percentiles['98'] : s.max);
+    }
+    return { bands: bands.join(','), vmin: lo.join(','), vmax: hi.join(',') };
+  }
+
+  // 直接用 rasterops 的 XYZ 瓦片预览资产（无需发布到 GeoServer）
+  // 未指定 vmin/vmax 时用资产统计做 2%/98% 拉伸
+  async function addPreviewLayerToMap(api, asset, opts) {
+    const map = window.map;
+    if (!map) {
+      alert("window.map 未找到：请在地图初始化后设置 window.map = map;");
+      return null;
+    }
+    opts = Object.assign({}, opts);
+    if (opts.vmin === undefined && opts.vmax === undefined) {
+      const nb = (asset.meta && asset.meta.bands) || 1;
+      const bands = opts.bands ? String(opts.bands).split(',').map(Number) : (nb >= 3 ? [1, 2, 3] : [1]);
+      try {
+        Object.assign(opts, stretchFromStats(await api.getStats(asset.id), bands) || {});
+      } catch (e) {
+        // 统计失败时退回服务端默认拉伸
+      }
+    }
+    const tj = await api.getTileJson(asset.id);
+    const layer = new ol.layer.Tile({
+      title: `${asset.filename}（预览）`,
+      source: new ol.source.XYZ({
+        url: api.tileUrlTemplate(asset.id, opts),
+        maxZoom: tj.maxzoom,
+        crossOrigin: 'anonymous',
+      }),
+    });
+    layer.setZIndex(9999);
+    layer.set('__assetId', asset.id);
+    layer.set('__source', 'rasterops');
+
+    const og = window.webgisOverlayGroup;
+    if (og && og.getLayers) og.getLayers().push(layer);
+    else map.addLayer(layer);
+    try { if (typeof window.refreshLayerManager === 'function') window.refreshLayerManager(); } catch (e) {}
+
+    if (Array.isArray(tj.bounds) && tj.bounds.length === 4) {
+      const mapProj = map.getView().getProjection();
+      const extent = ol.proj.transformExtent(tj.bounds, 'EPSG:4326', mapProj);
+      map.getView().fit(extent, { padding: [30, 30, 30, 30], duration: 300, maxZoom: tj.maxzoom });
+    }
+    return layer;
+  }
+
   async function fitToWmsLayerSmart(ws, layerName, statusEl) {
     try {
       const map = window.map;
@@ -197,13 +256,79 @@
   }
 
   async function pollJob(api, jobId, onUpdate, intervalMs) {
-    intervalMs = intervalMs || 1000;
-    for (;;) {
-      const j = await api.getJob(jobId);
-      if (onUpdate) onUpdate(j);
-      if (j.status === 'done' || j.status === 'error') return j;
-      await new Promise((r) => setTimeout(r, intervalMs));
+    // 优先用 SSE 推送（api.watchJob），不可用时内部退回轮询
+    return api.watchJob(jobId, onUpdate, intervalMs || 1000);
+  }
+
+  // 从地图（优先 overlayGroup）移除这些资产对应的图层（WMS 或预览）
+  function removeAssetLayersFromMap(assets) {
+    const og = window.webgisOverlayGroup;
+    const map = window.map;
+    const ids = new Set(assets.map((a) => a.id));
+    const qualified = new Set(assets
+      .filter((a) => a.geoserver_layer)
+      .map((a) => `${window.RASTEROPS_WORKSPACE}:${a.geoserver_layer}`));
+    const hit = (lyr) => lyr && lyr.get && (ids.has(lyr.get('__assetId')) || qualified.has(lyr.get('__qualifiedName')));
+
+    if (og && og.getLayers) {
+      og.getLayers().getArray().slice().forEach((lyr) => {
+        if (hit(lyr)) og.getLayers().remove(lyr);
+      });
+    } else if (map && map.getLayers) {
+      map.getLayers().getArray().slice().forEach((lyr) => {
+        if (hit(lyr)) map.removeLayer(lyr);
+      });
+    }
+    try { if (typeof window.refreshLayerManager === 'function') window.refreshLayerManager(); } catch (e) {}
+  }
+
+  // 批量任务结果汇总：“成功 n/m”，附第一条失败原因
+  function fmtBulkFinal(j) {
+    if (j.status !== 'done') return fmtJobFinal(j);
+    const items = (j.result && j.result.items) || {};
+    const ids = Object.keys(items);
+    const failed = ids.filter((id) => !items[id].ok);
+    let msg = `完成：成功 ${ids.length - failed.length}/${ids.length}`;
+    if (failed.length) msg += `；${shortId(failed[0])} 失败：${items[failed[0]].error}`;
+    return msg;
+  }
+
+  function fmtJobStatus(j) {
+    if (j.status === 'running' && j.cancel_requested) return 'cancelling';
+    if (j.status === 'running' && typeof j.progress === 'number') {
+      return `${j.status} ${Math.round(j.progress * 100)}%`;
     }
+    return j.status;
+  }
+
+  function fmtJobFinal(j) {
+    if (j.status === 'done') return `完成。输出 asset=${shortId(j.output_asset_id)}。建议去“资产”页发布并加到地图。`;
+    if (j.status === 'cancelled') return `已取消：任务 ${shortId(j.id)}`;
+    return `失败：${j.message}`;
+  }
+
+  // 运行中任务的“取消”按钮：任务开始时显示，结束后隐藏
+  function makeCancelButton(api, status) {
+    const btn = el('button', { style: 'padding:8px 12px;cursor:pointer;display:none;' }, ['取消任务']);
+    let jobId = null;
+    btn.onclick = async () => {
+      if (!jobId) return;
+      btn.disabled = true;
+      try {
+        await api.cancelJob(jobId);
+      } catch (e) {
+        status.textContent = `取消失败：${e.message || e}`;
+        btn.disabled = false;
+      }
+    };
+    return {
+      el: btn,
+      track(id) {
+        jobId = id;
+        btn.disabled = false;
+        btn.style.display = id ? '' : 'none';
+      },
+    };
   }
 
   function buildUI() {
@@ -293,23 +418,81 @@
       const status = el('div', { style: 'font-size:12px;color:#333;margin:6px 0;' });
       container.appendChild(status);
 
+      // 批量操作：勾选资产后一次提交为一个后台任务
+      const selected = new Map();
+      const bulkRow = el('div', { style: 'display:flex;gap:6px;align-items:center;margin-bottom:8px;font-size:12px;' });
+      const selInfo = el('span', { style: 'flex:1;color:#555;' }, ['已选 0 个']);
+      const bulkPublishBtn = el('button', { style: 'padding:4px 8px;cursor:pointer;' }, ['批量发布']);
+      const bulkUnpublishBtn = el('button', { style: 'padding:4px 8px;cursor:pointer;' }, ['批量取消发布']);
+      const bulkDeleteBtn = el('button', {
+        style: 'padding:4px 8px;cursor:pointer;background:#e53e3e;color:#fff;border:none;border-radius:3px;',
+      }, ['批量删除']);
+      const bulkCancel = makeCancelButton(api, status);
+      [selInfo, bulkPublishBtn, bulkUnpublishBtn, bulkDeleteBtn, bulkCancel.el].forEach((n) => bulkRow.appendChild(n));
+      container.appendChild(bulkRow);
+
+      function updateSelInfo() {
+        selInfo.textContent = `已选 ${selected.size} 个`;
+      }
+
+      async function runBulk(action, title) {
+        const assets = [...selected.values()];
+        if (!assets.length) {
+          status.textContent = '请先勾选资产。';
+          return;
+        }
+        if (action === 'delete') {
+          const ok = confirm(`确认删除 ${assets.length} 个资产？\n\n这会尝试：取消发布 GeoServer + 删除后端文件。`);
+          if (!ok) return;
+        }
+        try {
+          status.textContent = `${title}中：${assets.length} 个资产 ...`;
+          const job = await api.bulkAssets(action, assets.map((a) => a.id), { purge: 'all' });
+          bulkCancel.track(job.id);
+          const final = await pollJob(api, job.id, (j) => {
+            status.textContent = `${title}中：${assets.length} 个资产（${fmtJobStatus(j)}）`;
+          }, 1000);
+          bulkCancel.track(null);
+          const items = (final.result && final.result.items) || {};
+          if (action !== 'publish') removeAssetLayersFromMap(assets.filter((a) => items[a.id] && items[a.id].ok));
+          status.textContent = `${title}${fmtBulkFinal(final)}`;
+          await load(false);
+        } catch (e) {
+          bulkCancel.track(null);
+          status.textContent = `${title}失败：${e.message || e}`;
+        }
+      }
+
+      bulkPublishBtn.onclick = () => runBulk('publish', '批量发布');
+      bulkUnpublishBtn.onclick = () => runBulk('unpublish', '批量取消发布');
+      bulkDeleteBtn.onclick = () => runBulk('delete', '批量删除');
+
       const list = el('div', null, []);
       container.appendChild(list);
 
-      async function load() {
+      async function load(keepStatus) {
         list.innerHTML = '';
-        status.textContent = '加载中...';
+        selected.clear();
+        updateSelInfo();
+        if (!keepStatus) status.textContent = '加载中...';
         try {
           const assets = await api.listAssets();
-          status.textContent = `共 ${assets.length} 个资产（仅 GeoTIFF / Shapefile(zip)）`;
+          if (!keepStatus) status.textContent = `共 ${assets.length} 个资产（仅 GeoTIFF / Shapefile(zip)）`;
           assets.forEach((a) => {
             const row = el('div', {
               style:
                 'border:1px solid #eee;border-radius:6px;padding:8px;margin-bottom:8px;'
                 + 'display:flex;flex-direction:column;gap:6px;',
             });
+            const check = el('input', { type: 'checkbox', style: 'margin:2px 6px 0 0;' });
+            check.onchange = () => {
+              if (check.checked) selected.set(a.id, a);
+              else selected.delete(a.id);
+              updateSelInfo();
+            };
             const line1 = el('div', { style: 'display:flex;justify-content:space-between;gap:10px;' }, [
-              el('div', null, [
+              check,
+              el('div', { style: 'flex:1;' }, [
                 el('div', { style: 'font-weight:bold;' }, [`${a.filename}`]),
                 el('div', { style: 'font-size:12px;color:#555;' }, [`${a.kind} / ${fmtMeta(a.meta)} / id=${shortId(a.id)}`])
               ]),
@@ -317,8 +500,12 @@
                 el('button', { style: 'padding:4px 8px;cursor:pointer;', onclick: async () => {
                   try {
                     status.textContent = `发布中: ${a.filename} ...`;
-                    const pub = await api.publish(a.id);
-                    status.textContent = `已发布：${pub.workspace}:${pub.layer}`;
+                    const job = await api.publish(a.id);
+                    const final = await pollJob(api, job.id, (j) => {
+                      status.textContent = `发布中: ${a.filename}（${fmtJobStatus(j)}）`;
+                    }, 1000);
+                    if (final.status !== 'done') throw new Error(final.message || final.status);
+                    status.textContent = `已发布：${final.message}`;
                     await load();
                   } catch (e) {
                     status.textContent = `发布失败：${e.message || e}`;
@@ -333,27 +520,8 @@
                   try {
                     status.textContent = `删除中：${a.filename} ...`;
 
-                    // 如果该资产已加到地图：优先从 overlayGroup 移除
-                    const og = window.webgisOverlayGroup;
-                    const map = window.map;
-                    const qualified = `${window.RASTEROPS_WORKSPACE}:${a.geoserver_layer || ''}`;
-
-                    if (og && og.getLayers) {
-                      const layers = og.getLayers().getArray().slice();
-                      layers.forEach((lyr) => {
-                        if (lyr && lyr.get && (lyr.get('__assetId') === a.id || lyr.get('__qualifiedName') === qualified)) {
-                          og.getLayers().remove(lyr);
-                        }
-                      });
-                    } else if (map && map.getLayers && qualified) {
-                      const layers = map.getLayers().getArray().slice();
-                      layers.forEach((lyr) => {
-                        if (lyr && lyr.get && (lyr.get('__assetId') === a.id || lyr.get('__qualifiedName') === qualified)) {
-                          map.removeLayer(lyr);
-                        }
-                      });
-                    }
-                    try { if (typeof window.refreshLayerManager === 'function') window.refreshLayerManager(); } catch (e) {}
+                    // 如果该资产已加到地图：先从地图移除
+                    removeAssetLayersFromMap([a]);
 
                     // 调后端删除
                     await api.deleteAsset(a.id, { unpublish: true, delete_files: true, purge: 'all' });
@@ -376,6 +544,14 @@
                     status.textContent = `添加 WMS 失败：${e.message || e}`;
                   }
                 } }, ['加到地图']),
+                a.kind === 'raster' ? el('button', { style: 'padding:4px 8px;cursor:pointer;', onclick: async () => {
+                  try {
+                    await addPreviewLayerToMap(api, a);
+                    status.textContent = `已添加预览：${a.filename}`;
+                  } catch (e) {
+                    status.textContent = `预览失败：${e.message || e}`;
+                  }
+                } }, ['预览']) : null,
               ]),
             ]);
 
@@ -408,7 +584,7 @@
         }
       };
 
-      refreshBtn.onclick = load;
+      refreshBtn.onclick = () => load();
       load();
     }
 
@@ -443,6 +619,7 @@
       const bBand = el('input', { type: 'number', min: 1, value: 1, style: 'width:80px;padding:4px;' });
 
       const runBtn = el('button', { style: 'padding:8px 12px;cursor:pointer;' }, ['运行']);
+      const cancelBtn = makeCancelButton(api, status);
 
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['输入 A（raster）']), aSelWrap]));
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['输入 B（raster）']), bSelWrap]));
@@ -453,7 +630,7 @@
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['表达式（numpy 风格，变量用 A/B/C...）']), expr]));
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['输出名称（不含扩展名）']), outName]));
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['输出类型']), outDtype]));
-      form.appendChild(runBtn);
+      form.appendChild(el('div', { style: 'display:flex;gap:8px;' }, [runBtn, cancelBtn.el]));
 
       async function init() {
         status.textContent = '加载资产列表...';
@@ -482,16 +659,15 @@
             try {
               const job = await api.createCalcJob(payload);
               status.textContent = `已创建任务 ${shortId(job.id)}，正在运行...`;
+              cancelBtn.track(job.id);
               const final = await pollJob(api, job.id, (j) => {
-                status.textContent = `任务 ${shortId(j.id)} 状态：${j.status}`;
+                status.textContent = `任务 ${shortId(j.id)} 状态：${fmtJobStatus(j)}`;
               }, 1200);
-              if (final.status === 'done') {
-                status.textContent = `完成。输出 asset=${shortId(final.output_asset_id)}。建议去“资产”页发布并加到地图。`;
-              } else {
-                status.textContent = `失败：${final.message}`;
-              }
+              status.textContent = fmtJobFinal(final);
             } catch (e) {
               status.textContent = `创建/运行失败：${e.message || e}`;
+            } finally {
+              cancelBtn.track(null);
             }
           };
 
@@ -524,6 +700,7 @@
       ]);
 
       const runBtn = el('button', { style: 'padding:8px 12px;cursor:pointer;' }, ['运行融合']);
+      const cancelBtn = makeCancelButton(api, status);
 
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['高光谱 HS（tif）']), hsWrap]));
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['可见光 RGB（tif，至少 3 波段）']), rgbWrap]));
@@ -534,7 +711,7 @@
       ]));
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['输出名称（不含扩展名）']), outName]));
       form.appendChild(el('div', null, [el('div', { style: 'font-weight:bold;' }, ['输出类型']), outDtype]));
-      form.appendChild(runBtn);
+      form.appendChild(el('div', { style: 'display:flex;gap:8px;' }, [runBtn, cancelBtn.el]));
 
       const hint = el('div', { style: 'font-size:12px;color:#666;line-height:1.4;' }, [
         '融合方法：把 RGB 下采样到 HS 网格做回归（HS→RGB），再把 HS 上采样到 RGB 网格并注入 RGB 细节（RGB - 低通 RGB）。',
@@ -572,16 +749,15 @@
             try {
               const job = await api.createFuseJob(payload);
               status.textContent = `已创建任务 ${shortId(job.id)}，正在运行...`;
+              cancelBtn.track(job.id);
               const final = await pollJob(api, job.id, (j) => {
-                status.textContent = `任务 ${shortId(j.id)} 状态：${j.status}`;
+                status.textContent = `任务 ${shortId(j.id)} 状态：${fmtJobStatus(j)}`;
               }, 1500);
-              if (final.status === 'done') {
-                status.textContent = `完成。输出 asset=${shortId(final.output_asset_id)}。建议去“资产”页发布并加到地图。`;
-              } else {
-                status.textContent = `失败：${final.message}`;
-              }
+              status.textContent = fmtJobFinal(final);
             } catch (e) {
               status.textContent = `创建/运行失败：${e.message || e}`;
+            } finally {
+              cancelBtn.track(null);
             }
           };
 
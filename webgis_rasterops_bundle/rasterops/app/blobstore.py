@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from typing import BinaryIO, Dict, Tuple
+
+from config import settings
+from db import DB, utc_now_iso
+
+
+# release 时 blob 目录先改名为 tmp/<前缀><sha>_<随机>，提交后再删除
+_TOMBSTONE_PREFIX = ".deleted_"
+
+
+class BlobTooLarge(RuntimeError):
+    """上传内容超过 UPLOAD_MAX_BYTES。"""
+
+
+class BlobWriter:
+    """分块写入 blob 临时目录并同时计算 sha256；超过 UPLOAD_MAX_BYTES 时立即抛 BlobTooLarge。"""
+
+    def __init__(self, tmp_dir: str):
+        self._h = hashlib.sha256()
+        self.size = 0
+        fd, self.path = tempfile.mkstemp(prefix=".upload_", suffix=".part", dir=tmp_dir)
+        self._f = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if settings.UPLOAD_MAX_BYTES > 0 and self.size > settings.UPLOAD_MAX_BYTES:
+            raise BlobTooLarge(f"文件超过上限 {settings.UPLOAD_MAX_BYTES} 字节")
+        self._h.update(chunk)
+        self._f.write(chunk)
+
+    def finish(self) -> Tuple[str, int, str]:
+        """关闭文件，返回 (临时路径, 字节数, sha256)。"""
+        self._f.close()
+        return self.path, self.size, self._h.hexdigest()
+
+    def abort(self) -> None:
+        self._f.close()
+        _remove_quietly(self.path)
+
+
+class BlobStore:
+    """按内容寻址（sha256）的上传文件存储，带引用计数。
+
+    目录：<root>/<sha[:2]>/<sha>/data<ext>；同一内容只存一份，
+    多个 asset 共享同一个 blob，最后一个引用释放时才删除文件。
+    """
+
+    def __init__(self, db: DB, root: str):
+        self.db = db
+        self.root = root
+        self._tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        # 清理上次进程退出前没删完的墓碑目录
+        for name in os.listdir(self._tmp_dir):
+            if name.startswith(_TOMBSTONE_PREFIX):
+                shutil.rmtree(os.path.join(self._tmp_dir, name), ignore_errors=True)
+        # 同进程内入库/释放的串行化；跨进程由 sqlite 写事务保证（见 ingest_written / release）
+        self._lock = threading.Lock()
+
+    def _blob_path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256, f"data{ext}")
+
+    def writer(self) -> BlobWriter:
+        """在 blob 临时目录下新建一个写入器（写完后交给 ingest_written 入库，出错时 abort）。"""
+        return BlobWriter(self._tmp_dir)
+
+    def _stream_to_temp(self, fileobj: BinaryIO) -> Tuple[str, int, str]:
+        """分块写入临时文件并计算 sha256，返回 (临时路径, 字节数, sha256)。"""
+        w = self.writer()
+        try:
+            while True:
+                chunk = fileobj.read(settings.UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                w.write(chunk)
+        except BaseException:
+            w.abort()
+            raise
+        return w.finish()
+
+    def ingest(self, fileobj: BinaryIO, ext: str) -> Tuple[Dict, bool]:
+        """流式写入并按内容去重，返回 (blob, 是否新建)；调用方持有一个引用。"""
+        tmp_path, size, sha256 = self._stream_to_temp(fileobj)
+        return self.ingest_written(tmp_path, size, sha256, ext)
+
+    def ingest_written(self, tmp_path: str, size: int, sha256: str, ext: str) -> Tuple[Dict, bool]:
+        """把 BlobWriter.finish() 得到的临时文件按内容去重入库，返回 (blob, 是否新建)。
+
+        查重、放置文件与插入记录在同一个 sqlite 写事务里完成，与其它进程的 release 互斥。
+        """
+        path = self._blob_path(sha256, ext)
+
+        def _place() -> None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+
+        new_blob = {
+            "sha256": sha256,
+            "path": path,
+            "size_bytes": size,
+            "refcount": 1,
+            "meta": {},
+            "created_at": utc_now_iso(),
+        }
+        try:
+            with self._lock:
+                blob, created = self.db.acquire_blob(new_blob, _place)
+        finally:
+            _remove_quietly(tmp_path)  # 已存在（或出错）时丢弃临时文件；放置成功时已不存在
+        return blob, created
+
+    def release(self, sha256: str) -> None:
+        """释放一个引用；引用数归零时删除 blob 记录与目录。
+
+        目录在删除记录的同一个写事务里改名为 tmp 下的墓碑（跨进程原子：并发的 ingest 要么看到记录仍在，
+        要么看到目录已移走后重新放置），提交后再删除墓碑，不会误删新放置的文件。
+        """
+        tombstones = []
+
+        def _retire(blob: Dict) -> None:
+            tomb = os.path.join(self._tmp_dir, f"{_TOMBSTONE_PREFIX}{sha256}_{uuid.uuid4().hex}")
+            try:
+                os.replace(os.path.dirname(blob["path"]), tomb)
+            except FileNotFoundError:
+                return
+            tombstones.append(tomb)
+
+        with self._lock:
+            self.db.decref_blob(sha256, _retire)
+        for tomb in tombstones:
+            shutil.rmtree(tomb, ignore_errors=True)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+from typing import Dict
 
 
 def _env(key: str, default: str | None = None) -> str | None:
@@ -10,19 +11,119 @@ def _env(key: str, default: str | None = None) -> str | None:
     return v
 
 
+def _env_int(key: str, default: int) -> int:
+    v = _env(key)
+    return int(v) if v is not None else default
+
+
+def _env_bool(key: str, default: bool) -> bool:
+    v = _env(key)
+    return v.strip().lower() in ("1", "true", "yes", "on") if v is not None else default
+
+
+def _env_kv_str(key: str, default: str) -> Dict[str, str]:
+    """解析 "a=b,c=d" 形式的配置。"""
+    out: Dict[str, str] = {}
+    for item in (_env(key, default) or "").split(","):
+        k, sep, v = item.partition("=")
+        if sep and k.strip():
+            out[k.strip()] = v.strip()
+    return out
+
+
+def _env_kv_int(key: str, default: str) -> Dict[str, int]:
+    """解析 "calc=10,fuse=0" 形式的配置。"""
+    out: Dict[str, int] = {}
+    for item in (_env(key, default) or "").split(","):
+        k, sep, v = item.partition("=")
+        if sep and k.strip():
+            out[k.strip()] = int(v)
+    return out
+
+
 class Settings:
     # GeoServer
     GEOSERVER_URL: str = _env("GEOSERVER_URL", "http://10.8.49.5:8080/geoserver")
     GEOSERVER_USER: str = _env("GEOSERVER_USER", "admin")
     GEOSERVER_PASSWORD: str = _env("GEOSERVER_PASSWORD", "geoserver")
     GEOSERVER_WORKSPACE: str = _env("GEOSERVER_WORKSPACE", "webgis")
+    # REST 客户端：连接池大小、单次请求超时（秒）、502/503/504 与连接错误重试次数、退避基数（秒）、
+    # 已确认存在的 workspace 缓存时长（秒）
+    GEOSERVER_POOL_SIZE: int = _env_int("GEOSERVER_POOL_SIZE", 10)
+    GEOSERVER_TIMEOUT_S: int = _env_int("GEOSERVER_TIMEOUT_S", 600)
+    GEOSERVER_RETRIES: int = _env_int("GEOSERVER_RETRIES", 3)
+    GEOSERVER_RETRY_BACKOFF_S: float = float(_env("GEOSERVER_RETRY_BACKOFF_S", "0.5"))
+    GEOSERVER_CACHE_TTL_S: int = _env_int("GEOSERVER_CACHE_TTL_S", 300)
+    # 栅格发布方式：upload（上传文件内容）或 external（GeoServer 与 rasterops 共享数据卷，只登记文件路径）
+    GEOSERVER_PUBLISH_MODE: str = _env("GEOSERVER_PUBLISH_MODE", "upload")
+    # external 模式下 rasterops 路径前缀 -> GeoServer 容器内路径前缀，如 "/data=/opt/geoserver_data/rasterops"
+    GEOSERVER_PATH_MAP: Dict[str, str] = _env_kv_str("GEOSERVER_PATH_MAP", "")
 
     # Service
     DATA_DIR: str = _env("RASTEROPS_DATA_DIR", "/data")
     PUBLIC_BASE_URL: str = _env("RASTEROPS_PUBLIC_BASE_URL", "http://10.8.49.5:9001")
 
+    # 上传：分块大小与单文件上限（字节，0 = 不限制）
+    UPLOAD_CHUNK_BYTES: int = _env_int("RASTEROPS_UPLOAD_CHUNK_BYTES", 8 << 20)
+    UPLOAD_MAX_BYTES: int = _env_int("RASTEROPS_UPLOAD_MAX_BYTES", 50 << 30)
+
+    # 栅格处理
+    # GDAL 压缩/解压线程数（GTiff NUM_THREADS），ALL_CPUS 或具体数字
+    GDAL_NUM_THREADS: str = _env("RASTEROPS_GDAL_NUM_THREADS", "ALL_CPUS")
+    # 栅格计算器每次处理的像素上限（控制内存）
+    CALC_BLOCK_PIXELS: int = _env_int("RASTEROPS_CALC_BLOCK_PIXELS", 1 << 20)
+    # 影像融合并行计算块的线程数（1 = 串行），以及最多在途（已提交未写出）的块数
+    FUSE_WORKERS: int = _env_int("RASTEROPS_FUSE_WORKERS", 4)
+    FUSE_MAX_INFLIGHT: int = _env_int("RASTEROPS_FUSE_MAX_INFLIGHT", 16)
+    # GDAL 块缓存上限（MB，每进程，0 = GDAL 默认），以及进程内共享的空闲只读句柄数 / 网格信息条数上限
+    GDAL_CACHE_MB: int = _env_int("RASTEROPS_GDAL_CACHE_MB", 256)
+    DATASET_CACHE_SIZE: int = _env_int("RASTEROPS_DATASET_CACHE_SIZE", 64)
+    GRID_CACHE_SIZE: int = _env_int("RASTEROPS_GRID_CACHE_SIZE", 512)
+
+    # 后台任务队列：并发数、崩溃/重启后最多重试次数、各类任务默认优先级（越大越先）
+    JOB_WORKERS: int = _env_int("RASTEROPS_JOB_WORKERS", 2)
+    JOB_MAX_ATTEMPTS: int = _env_int("RASTEROPS_JOB_MAX_ATTEMPTS", 2)
+    JOB_PRIORITIES: Dict[str, int] = _env_kv_int("RASTEROPS_JOB_PRIORITIES", "publish=20,bulk=20,calc=10,fuse=0,stats=-5,cog=-10")
+    # 执行后端：thread（API 进程内线程）或 process（独立 worker 进程）
+    JOB_BACKEND: str = _env("RASTEROPS_JOB_BACKEND", "process")
+    # 各类任务的并发上限，以及所有运行中任务估算内存之和的上限（MB，0 = 不限制）
+    JOB_KIND_LIMITS: Dict[str, int] = _env_kv_int("RASTEROPS_JOB_KIND_LIMITS", "calc=2,fuse=1,cog=1,publish=2,bulk=1,stats=1")
+    JOB_MEMORY_BUDGET_MB: int = _env_int("RASTEROPS_JOB_MEMORY_BUDGET_MB", 4096)
+    # 批量资产操作（发布/取消发布/删除）的并发数
+    BULK_WORKERS: int = _env_int("RASTEROPS_BULK_WORKERS", 8)
+    BULK_MAX_ITEMS: int = _env_int("RASTEROPS_BULK_MAX_ITEMS", 1000)
+    # 各类任务的运行时限（秒，0 = 不限制），超时的任务在下一个检查点退出并置为 error
+    JOB_TIMEOUTS: Dict[str, int] = _env_kv_int("RASTEROPS_JOB_TIMEOUTS", "calc=1800,fuse=7200,cog=3600,publish=3600,bulk=7200,stats=3600")
+    # 超时/取消后留给任务自行退出的宽限期（秒）；进程后端过了宽限期直接终止 worker 进程
+    JOB_KILL_GRACE_S: int = _env_int("RASTEROPS_JOB_KILL_GRACE_S", 30)
+
+    # Cloud-Optimized GeoTIFF：上传的栅格与任务输出转为带内部金字塔的 COG。
+    # 上传文件的 COG 与原文件并存（原文件用于去重、下载与外部发布），存储约翻倍，因此默认关闭
+    COG_ENABLED: bool = _env_bool("RASTEROPS_COG_ENABLED", False)
+    COG_RESAMPLING: str = _env("RASTEROPS_COG_RESAMPLING", "average")
+
+    # XYZ 预览瓦片缓存：内存 LRU 上限（MB）、是否同时缓存到磁盘 DATA_DIR/tilecache 及磁盘上限（MB，0 = 不限制），
+    # 以及渲染器缓存的源文件信息条数上限
+    TILE_CACHE_MB: int = _env_int("RASTEROPS_TILE_CACHE_MB", 128)
+    TILE_DISK_CACHE: bool = _env_bool("RASTEROPS_TILE_DISK_CACHE", True)
+    TILE_DISK_CACHE_MB: int = _env_int("RASTEROPS_TILE_DISK_CACHE_MB", 2048)
+    TILE_SOURCE_CACHE_SIZE: int = _env_int("RASTEROPS_TILE_SOURCE_CACHE_SIZE", 256)
+
+    # 近似波段统计读取的像素上限（缩小读取，有 overview 时直接读 overview）
+    STATS_APPROX_PIXELS: int = _env_int("RASTEROPS_STATS_APPROX_PIXELS", 1 << 20)
+
+    # 批量取值（/sample）单次最多的点数（折线加密后也不超过此数）
+    SAMPLE_MAX_POINTS: int = _env_int("RASTEROPS_SAMPLE_MAX_POINTS", 10000)
+
+    # 裁剪下载（/subset）的输出像素上限：宽 x 高 x 波段，0 = 不限制
+    SUBSET_MAX_PIXELS: int = _env_int("RASTEROPS_SUBSET_MAX_PIXELS", 64_000_000)
+
     # CORS
     CORS_ALLOW_ORIGINS: str = _env("CORS_ALLOW_ORIGINS", "*")
 
 
 settings = Settings()
+
+
+def data_path(*parts: str) -> str:
+    return os.path.join(settings.DATA_DIR, *parts)
@@ -1,31 +1,66 @@
 from __future__ import annotations
 
+import base64
 import json
 import os
 import sqlite3
 import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+# 列表精简投影：不含 meta_json
+_ASSET_SLIM_COLUMNS = "id, filename, kind, path, created_at, geoserver_layer, geoserver_store, published_at, blob_sha256"
+
+
+def _encode_cursor(created_at: str, asset_id: str) -> str:
+    raw = json.dumps([created_at, asset_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, asset_id = json.loads(raw)
+        return str(created_at), str(asset_id)
+    except Exception:
+        raise ValueError("invalid cursor") from None
+
+
 class DB:
     def __init__(self, db_path: str):
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.db_path = db_path
+        # 只串行化写；WAL 模式下读不加锁，也不会被写阻塞
         self._lock = threading.Lock()
+        self._local = threading.local()
         self._init_schema()
 
     def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
+        """每个线程复用一个持久连接（WAL + synchronous=NORMAL）。"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
         return conn
 
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        """写事务：持写锁，退出时提交（异常回滚）。"""
+        conn = self._connect()
+        with self._lock, conn:
+            yield conn
+
     def _init_schema(self) -> None:
-        with self._connect() as conn:
+        with self._write() as conn:
             conn.executescript(
                 """
                 CREATE TABLE IF NOT EXISTS assets (
@@ -37,7 +72,17 @@ class DB:
                     meta_json TEXT NOT NULL,
                     geoserver_layer TEXT,
                     geoserver_store TEXT,
-                    published_at TEXT
+                    published_at TEXT,
+                    blob_sha256 TEXT
+                );
+
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL,
+                    meta_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL
                 );
 
                 CREATE TABLE IF NOT EXISTS jobs (
@@ -48,18 +93,59 @@ class DB:
                     updated_at TEXT NOT NULL,
                     params_json TEXT NOT NULL,
                     output_asset_id TEXT,
-                    message TEXT
+                    message TEXT,
+                    progress REAL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    mem_mb INTEGER NOT NULL DEFAULT 0,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    cache_key TEXT,
+                    result_json TEXT
                 );
+
+                CREATE TABLE IF NOT EXISTS job_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    output_asset_id TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+                """
+            )
+            # 旧库升级：补列
+            self._ensure_column(conn, "assets", "blob_sha256", "TEXT")
+            self._ensure_column(conn, "jobs", "progress", "REAL")
+            self._ensure_column(conn, "jobs", "priority", "INTEGER NOT NULL DEFAULT 0")
+            self._ensure_column(conn, "jobs", "attempts", "INTEGER NOT NULL DEFAULT 0")
+            self._ensure_column(conn, "jobs", "mem_mb", "INTEGER NOT NULL DEFAULT 0")
+            self._ensure_column(conn, "jobs", "cancel_requested", "INTEGER NOT NULL DEFAULT 0")
+            self._ensure_column(conn, "jobs", "cache_key", "TEXT")
+            self._ensure_column(conn, "jobs", "result_json", "TEXT")
+            conn.executescript(
+                """
+                CREATE INDEX IF NOT EXISTS idx_assets_created_at ON assets(created_at);
+                CREATE INDEX IF NOT EXISTS idx_assets_created_id ON assets(created_at, id);
+                CREATE INDEX IF NOT EXISTS idx_assets_kind_created ON assets(kind, created_at, id);
+                CREATE INDEX IF NOT EXISTS idx_assets_filename ON assets(filename);
+                CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+                CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs(updated_at);
+                CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, priority DESC, created_at);
+                CREATE INDEX IF NOT EXISTS idx_job_cache_output ON job_cache(output_asset_id);
                 """
             )
 
+    @staticmethod
+    def _ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+        cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+        if column not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
     # ---------- Assets ----------
     def insert_asset(self, asset: Dict[str, Any]) -> None:
-        with self._lock, self._connect() as conn:
+        with self._write() as conn:
             conn.execute(
                 """
-                INSERT INTO assets(id, filename, kind, path, created_at, meta_json, geoserver_layer, geoserver_store, published_at)
-                VALUES(?,?,?,?,?,?,?,?,?)
+                INSERT INTO assets(id, filename, kind, path, created_at, meta_json, geoserver_layer, geoserver_store, published_at, blob_sha256)
+                VALUES(?,?,?,?,?,?,?,?,?,?)
                 """,
                 (
                     asset["id"],
@@ -71,23 +157,69 @@ class DB:
                     asset.get("geoserver_layer"),
                     asset.get("geoserver_store"),
                     asset.get("published_at"),
+                    asset.get("blob_sha256"),
                 ),
             )
 
-    def list_assets(self) -> list[Dict[str, Any]]:
-        with self._lock, self._connect() as conn:
-            rows = conn.execute(
-                "SELECT * FROM assets ORDER BY created_at DESC"
-            ).fetchall()
-        return [self._row_to_asset(r) for r in rows]
+    def list_assets(
+        self,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        kind: Optional[str] = None,
+        published: Optional[bool] = None,
+        prefix: Optional[str] = None,
+        created_from: Optional[str] = None,
+        created_to: Optional[str] = None,
+        slim: bool = False,
+    ) -> Tuple[list[Dict[str, Any]], Optional[str]]:
+        """按 created_at 倒序分页列出资产（keyset 游标），返回 (列表, 下一页游标)。
+
+        slim=True 时不查询/解析 meta_json。cursor 非法时抛 ValueError。
+        """
+        where = []
+        params: list[Any] = []
+        if kind:
+            where.append("kind=?")
+            params.append(kind)
+        if published is not None:
+            where.append("geoserver_layer IS NOT NULL" if published else "geoserver_layer IS NULL")
+        if prefix:
+            # 前缀用范围条件，可走 filename 索引
+            where.append("filename >= ? AND filename < ?")
+            params += [prefix, prefix + "\U0010ffff"]
+        if created_from:
+            where.append("created_at >= ?")
+            params.append(created_from)
+        if created_to:
+            where.append("created_at < ?")
+            params.append(created_to)
+        if cursor:
+            c_created, c_id = _decode_cursor(cursor)
+            where.append("(created_at < ? OR (created_at = ? AND id < ?))")
+            params += [c_created, c_created, c_id]
+
+        cols = _ASSET_SLIM_COLUMNS if slim else "*"
+        sql = f"SELECT {cols} FROM assets"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit) + 1)
+
+        rows = self._connect().execute(sql, tuple(params)).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+        return [self._row_to_asset(r) for r in rows], next_cursor
 
     def get_asset(self, asset_id: str) -> Optional[Dict[str, Any]]:
-        with self._lock, self._connect() as conn:
-            row = conn.execute("SELECT * FROM assets WHERE id=?", (asset_id,)).fetchone()
+        row = self._connect().execute("SELECT * FROM assets WHERE id=?", (asset_id,)).fetchone()
         return self._row_to_asset(row) if row else None
 
     def update_asset_publish(self, asset_id: str, layer: str, store: str) -> None:
-        with self._lock, self._connect() as conn:
+        with self._write() as conn:
             conn.execute(
                 """
                 UPDATE assets
@@ -97,10 +229,45 @@ class DB:
                 (layer, store, utc_now_iso(), asset_id),
             )
 
+    def update_assets_publish_many(self, items: list[Tuple[str, str, str, bool]]) -> None:
+        """批量记录发布结果 (asset_id, layer, store, external)，单个事务。"""
+        now = utc_now_iso()
+        with self._write() as conn:
+            for asset_id, layer, store, external in items:
+                row = conn.execute("SELECT meta_json FROM assets WHERE id=?", (asset_id,)).fetchone()
+                if row is None:
+                    continue
+                meta = json.loads(row["meta_json"] or "{}")
+                meta["geoserver_external"] = bool(external)
+                conn.execute(
+                    """
+                    UPDATE assets
+                    SET geoserver_layer=?, geoserver_store=?, published_at=?, meta_json=?
+                    WHERE id=?
+                    """,
+                    (layer, store, now, json.dumps(meta, ensure_ascii=False), asset_id),
+                )
+
+    def clear_assets_publish_many(self, asset_ids: list[str]) -> None:
+        """批量清除发布信息（取消发布后），单个事务。"""
+        with self._write() as conn:
+            conn.executemany(
+                "UPDATE assets SET geoserver_layer=NULL, geoserver_store=NULL, published_at=NULL WHERE id=?",
+                [(a,) for a in asset_ids],
+            )
+
+    def delete_assets(self, asset_ids: list[str]) -> None:
+        """批量删除资产记录（及以其为输出的缓存项），单个事务。"""
+        with self._write() as conn:
+            conn.executemany("DELETE FROM assets WHERE id=?", [(a,) for a in asset_ids])
+            conn.executemany("DELETE FROM job_cache WHERE output_asset_id=?", [(a,) for a in asset_ids])
+
     def delete_asset(self, asset_id: str) -> None:
         """Hard delete an asset row."""
-        with self._lock, self._connect() as conn:
+        with self._write() as conn:
             conn.execute("DELETE FROM assets WHERE id=?", (asset_id,))
+            # 以该资产为输出的缓存项一并失效
+            conn.execute("DELETE FROM job_cache WHERE output_asset_id=?", (asset_id,))
 
     def _row_to_asset(self, row: sqlite3.Row) -> Dict[str, Any]:
         return {
@@ -109,19 +276,119 @@ class DB:
             "kind": row["kind"],
             "path": row["path"],
             "created_at": row["created_at"],
-            "meta": json.loads(row["meta_json"] or "{}"),
+            "meta": json.loads(row["meta_json"] or "{}") if "meta_json" in row.keys() else None,
             "geoserver_layer": row["geoserver_layer"],
             "geoserver_store": row["geoserver_store"],
             "published_at": row["published_at"],
+            "blob_sha256": row["blob_sha256"],
+        }
+
+    # ---------- Blobs（按内容去重的上传文件，引用计数） ----------
+    def get_blob(self, sha256: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("SELECT * FROM blobs WHERE sha256=?", (sha256,)).fetchone()
+        return self._row_to_blob(row) if row else None
+
+    def acquire_blob(self, blob: Dict[str, Any], place: Callable[[], None]) -> Tuple[Dict[str, Any], bool]:
+        """同一个写事务内：blob 已存在则引用数 +1，返回 (已有 blob, False)；
+        否则先调用 place() 把文件放到 blob["path"]，再插入记录，返回 (blob, True)。
+
+        与 decref_blob 在同一把 sqlite 写锁下执行，跨进程也不会与删除交错。
+        """
+        with self._write() as conn:
+            cur = conn.execute("UPDATE blobs SET refcount=refcount+1 WHERE sha256=?", (blob["sha256"],))
+            if cur.rowcount:
+                row = conn.execute("SELECT * FROM blobs WHERE sha256=?", (blob["sha256"],)).fetchone()
+                return self._row_to_blob(row), False
+            place()
+            conn.execute(
+                """
+                INSERT INTO blobs(sha256, path, size_bytes, refcount, meta_json, created_at)
+                VALUES(?,?,?,?,?,?)
+                """,
+                (
+                    blob["sha256"],
+                    blob["path"],
+                    blob["size_bytes"],
+                    blob.get("refcount", 1),
+                    json.dumps(blob.get("meta", {}), ensure_ascii=False),
+                    blob["created_at"],
+                ),
+            )
+        return blob, True
+
+    def decref_blob(
+        self, sha256: str, retire: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """引用数 -1；归零时删除记录并返回该 blob，否则返回 None。
+
+        retire(blob) 在提交前、仍持写锁时调用（用于把文件目录移走）；它抛异常则整个事务回滚。
+        """
+        with self._write() as conn:
+            conn.execute("UPDATE blobs SET refcount=refcount-1 WHERE sha256=?", (sha256,))
+            row = conn.execute("SELECT * FROM blobs WHERE sha256=?", (sha256,)).fetchone()
+            if row is None or row["refcount"] > 0:
+                return None
+            conn.execute("DELETE FROM blobs WHERE sha256=?", (sha256,))
+            blob = self._row_to_blob(row)
+            if retire is not None:
+                retire(blob)
+        return blob
+
+    def update_blob_meta(self, sha256: str, meta: Dict[str, Any]) -> None:
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE blobs SET meta_json=? WHERE sha256=?",
+                (json.dumps(meta, ensure_ascii=False), sha256),
+            )
+
+    def patch_meta(
+        self,
+        patch: Dict[str, Any],
+        asset_id: Optional[str] = None,
+        blob_sha256: Optional[str] = None,
+    ) -> None:
+        """把 patch 合并进 meta：指定 asset_id 时更新该资产；指定 blob_sha256 时更新 blob
+        以及所有引用它的资产（同一内容的多个资产保持一致）。"""
+        with self._write() as conn:
+            if blob_sha256 is not None:
+                targets = [("blobs", "sha256", blob_sha256)]
+                targets += [
+                    ("assets", "id", r["id"])
+                    for r in conn.execute("SELECT id FROM assets WHERE blob_sha256=?", (blob_sha256,))
+                ]
+            else:
+                targets = [("assets", "id", asset_id)]
+            for table, key_col, key in targets:
+                row = conn.execute(f"SELECT meta_json FROM {table} WHERE {key_col}=?", (key,)).fetchone()
+                if row is None:
+                    continue
+                meta = json.loads(row["meta_json"] or "{}")
+                meta.update(patch)
+                conn.execute(
+                    f"UPDATE {table} SET meta_json=? WHERE {key_col}=?",
+                    (json.dumps(meta, ensure_ascii=False), key),
+                )
+
+    def _row_to_blob(self, row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "sha256": row["sha256"],
+            "path": row["path"],
+            "size_bytes": row["size_bytes"],
+            "refcount": row["refcount"],
+            "meta": json.loads(row["meta_json"] or "{}"),
+            "created_at": row["created_at"],
         }
 
     # ---------- Jobs ----------
     def insert_job(self, job: Dict[str, Any]) -> None:
-        with self._lock, self._connect() as conn:
+        with self._write() as conn:
             conn.execute(
                 """
-                INSERT INTO jobs(id, kind, status, created_at, updated_at, params_json, output_asset_id, message)
-                VALUES(?,?,?,?,?,?,?,?)
+                INSERT INTO jobs(
+                    id, kind, status, created_at, updated_at, params_json, output_asset_id, message,
+                    progress, priority, mem_mb, cache_key
+                )
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
                 """,
                 (
                     job["id"],
@@ -132,29 +399,167 @@ class DB:
                     json.dumps(job.get("params", {}), ensure_ascii=False),
                     job.get("output_asset_id"),
                     job.get("message"),
+                    job.get("progress", 0.0),
+                    job.get("priority", 0),
+                    job.get("mem_mb", 0),
+                    job.get("cache_key"),
                 ),
             )
 
     def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
-        with self._lock, self._connect() as conn:
-            row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        row = self._connect().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
         return self._row_to_job(row) if row else None
 
     def update_job(self, job_id: str, **fields: Any) -> None:
-        allowed = {"status", "updated_at", "output_asset_id", "message"}
+        allowed = {"status", "updated_at", "output_asset_id", "message", "progress", "result"}
         sets = []
         params = []
         for k, v in fields.items():
             if k not in allowed:
                 continue
+            if k == "result":
+                k, v = "result_json", json.dumps(v, ensure_ascii=False) if v is not None else None
             sets.append(f"{k}=?")
             params.append(v)
         if not sets:
             return
         params.append(job_id)
-        with self._lock, self._connect() as conn:
+        with self._write() as conn:
             conn.execute(f"UPDATE jobs SET {', '.join(sets)} WHERE id=?", tuple(params))
 
+    def claim_next_job(
+        self,
+        exclude_kinds: Optional[list[str]] = None,
+        max_mem_mb: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """取优先级最高（同级 FIFO）的 queued 任务并原子地置为 running；没有则返回 None。
+
+        exclude_kinds：已达并发上限的 kind；max_mem_mb：剩余内存预算（None 表示不限）。
+        """
+        where = ["status='queued'"]
+        params: list[Any] = []
+        if exclude_kinds:
+            where.append(f"kind NOT IN ({','.join('?' * len(exclude_kinds))})")
+            params += list(exclude_kinds)
+        if max_mem_mb is not None:
+            where.append("mem_mb <= ?")
+            params.append(int(max_mem_mb))
+        with self._write() as conn:
+            row = conn.execute(
+                f"SELECT id FROM jobs WHERE {' AND '.join(where)} ORDER BY priority DESC, created_at, rowid LIMIT 1",
+                tuple(params),
+            ).fetchone()
+            if row is None:
+                return None
+            cur = conn.execute(
+                """
+                UPDATE jobs SET status='running', attempts=attempts+1, updated_at=?, message=NULL
+                WHERE id=? AND status='queued'
+                """,
+                (utc_now_iso(), row["id"]),
+            )
+            if cur.rowcount == 0:
+                return None
+            row = conn.execute("SELECT * FROM jobs WHERE id=?", (row["id"],)).fetchone()
+        return self._row_to_job(row)
+
+    def request_job_cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取消任务：queued 直接置为 cancelled；running 只打上 cancel_requested 标记，
+        由任务在下一个检查点自行退出。返回更新后的 job（不存在返回 None）。"""
+        with self._write() as conn:
+            now = utc_now_iso()
+            cur = conn.execute(
+                """
+                UPDATE jobs SET status='cancelled', updated_at=?, message='cancelled by user'
+                WHERE id=? AND status='queued'
+                """,
+                (now, job_id),
+            )
+            if cur.rowcount == 0:
+                conn.execute(
+                    "UPDATE jobs SET cancel_requested=1, updated_at=? WHERE id=? AND status='running'",
+                    (now, job_id),
+                )
+            row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def is_job_cancel_requested(self, job_id: str) -> bool:
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def recover_orphaned_jobs(self, max_attempts: int) -> List[str]:
+        """进程启动时调用：上次遗留的 running 任务重新排队，已尝试 max_attempts 次的置为 error。
+
+        返回这些任务的 id（它们的半成品输出需要清理）。
+        """
+        with self._write() as conn:
+            now = utc_now_iso()
+            orphaned = [r["id"] for r in conn.execute("SELECT id FROM jobs WHERE status='running'")]
+            conn.execute(
+                """
+                UPDATE jobs SET status='cancelled', updated_at=?, message='cancelled by user'
+                WHERE status='running' AND cancel_requested=1
+                """,
+                (now,),
+            )
+            conn.execute(
+                """
+                UPDATE jobs SET status='error', updated_at=?, message='interrupted by restart (max attempts reached)'
+                WHERE status='running' AND attempts >= ?
+                """,
+                (now, max_attempts),
+            )
+            conn.execute(
+                "UPDATE jobs SET status='queued', updated_at=?, progress=0 WHERE status='running'",
+                (now,),
+            )
+        return orphaned
+
+    def requeue_interrupted_job(self, job_id: str, max_attempts: int, message: str) -> Optional[Dict[str, Any]]:
+        """运行中的任务因 worker 进程意外退出而中断：重新排队；
+        已请求取消的置为 cancelled，已尝试 max_attempts 次的置为 error。返回更新后的 job。"""
+        with self._write() as conn:
+            now = utc_now_iso()
+            conn.execute(
+                """
+                UPDATE jobs SET status='cancelled', updated_at=?, message='cancelled by user'
+                WHERE id=? AND status='running' AND cancel_requested=1
+                """,
+                (now, job_id),
+            )
+            conn.execute(
+                "UPDATE jobs SET status='error', updated_at=?, message=? WHERE id=? AND status='running' AND attempts >= ?",
+                (now, f"{message} (max attempts reached)", job_id, max_attempts),
+            )
+            conn.execute(
+                "UPDATE jobs SET status='queued', updated_at=?, progress=0, message=? WHERE id=? AND status='running'",
+                (now, message, job_id),
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    # ---- job result cache ----
+    def get_cached_output(self, cache_key: str) -> Optional[str]:
+        """命中且输出资产仍存在时返回 output_asset_id。"""
+        row = self._connect().execute(
+            """
+            SELECT c.output_asset_id FROM job_cache c JOIN assets a ON a.id = c.output_asset_id
+            WHERE c.cache_key=?
+            """,
+            (cache_key,),
+        ).fetchone()
+        return row["output_asset_id"] if row else None
+
+    def put_cached_output(self, cache_key: str, kind: str, output_asset_id: str) -> None:
+        with self._write() as conn:
+            conn.execute(
+                """
+                INSERT INTO job_cache(cache_key, kind, output_asset_id, created_at) VALUES(?,?,?,?)
+                ON CONFLICT(cache_key) DO UPDATE SET output_asset_id=excluded.output_asset_id, created_at=excluded.created_at
+                """,
+                (cache_key, kind, output_asset_id, utc_now_iso()),
+            )
+
     def _row_to_job(self, row: sqlite3.Row) -> Dict[str, Any]:
         return {
             "id": row["id"],
@@ -165,4 +570,11 @@ class DB:
             "params": json.loads(row["params_json"] or "{}"),
             "output_asset_id": row["output_asset_id"],
             "message": row["message"],
+            "progress": row["progress"],
+            "priority": row["priority"],
+            "attempts": row["attempts"],
+            "mem_mb": row["mem_mb"],
+            "cancel_requested": bool(row["cancel_requested"]),
+            "cache_key": row["cache_key"],
+            "result": json.loads(row["result_json"]) if row["result_json"] else None,
         }
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from osgeo import gdal
+
+from config import settings
+
+# 进程内共享的只读 dataset 句柄池 + 网格信息缓存，按 (路径, mtime, 大小) 做键：
+# 文件被替换（如原地转 COG）后键自然失效；删除时显式 invalidate。
+# GDAL dataset 不能跨线程并发使用，因此句柄按“借出/归还”使用：同一时刻只属于一个线程，
+# 归还后可被任意线程复用；空闲句柄总数有上限（LRU）。
+
+gdal.UseExceptions()
+
+# GDAL 块缓存（进程级，所有 dataset 共享）；0 = 保持 GDAL 默认（GDAL_CACHEMAX 或约 5% 内存）
+if settings.GDAL_CACHE_MB > 0:
+    gdal.SetCacheMax(settings.GDAL_CACHE_MB << 20)
+
+_Key = Tuple[str, int, int]
+
+
+@dataclass(frozen=True)
+class GridInfo:
+    """解析一次即可复用的栅格网格描述（只读、可跨线程共享）。"""
+
+    driver: Optional[str]
+    xsize: int
+    ysize: int
+    band_count: int
+    geotransform: Optional[Tuple[float, ...]]
+    projection: str
+    dtypes: Tuple[str, ...]  # 各波段数据类型名
+    nodata: Tuple[Optional[float], ...]  # 各波段 nodata
+    block_size: Tuple[int, int]  # 第 1 波段的块大小
+    overviews: int  # 第 1 波段的 overview 层数
+
+    @classmethod
+    def from_dataset(cls, ds: gdal.Dataset) -> "GridInfo":
+        gt = ds.GetGeoTransform(can_return_null=True)
+        bands = [ds.GetRasterBand(i) for i in range(1, ds.RasterCount + 1)]
+        return cls(
+            driver=ds.GetDriver().ShortName if ds.GetDriver() else None,
+            xsize=ds.RasterXSize,
+            ysize=ds.RasterYSize,
+            band_count=ds.RasterCount,
+            geotransform=tuple(gt) if gt is not None else None,
+            projection=ds.GetProjectionRef() or "",
+            dtypes=tuple(gdal.GetDataTypeName(b.DataType) for b in bands),
+            nodata=tuple(b.GetNoDataValue() for b in bands),
+            block_size=tuple(bands[0].GetBlockSize()) if bands else (0, 0),
+            overviews=bands[0].GetOverviewCount() if bands else 0,
+        )
+
+    @property
+    def bbox(self) -> Optional[Tuple[float, float, float, float]]:
+        """(minx, miny, maxx, maxy)；无 geotransform 或带旋转项时为 None。"""
+        if self.geotransform is None:
+            return None
+        origin_x, px_w, rot1, origin_y, rot2, px_h = self.geotransform
+        if abs(rot1) >= 1e-12 or abs(rot2) >= 1e-12:
+            return None
+        x0, x1 = origin_x, origin_x + px_w * self.xsize
+        y0, y1 = origin_y, origin_y + px_h * self.ysize
+        return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def _key(path: str) -> _Key:
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def _under(path: str, prefix: str) -> bool:
+    return path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep)
+
+
+class DatasetCache:
+    """空闲句柄池（上限 max_handles 个）+ GridInfo LRU（上限 max_grids 个）。"""
+
+    def __init__(self, max_handles: int, max_grids: int):
+        self.max_handles = max_handles
+        self.max_grids = max_grids
+        self._idle: "OrderedDict[_Key, List[gdal.Dataset]]" = OrderedDict()
+        self._idle_count = 0
+        self._grids: "OrderedDict[_Key, GridInfo]" = OrderedDict()
+        self._epoch = 0  # 每次 invalidate 递增：借出期间发生失效的句柄不再归还
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def dataset(self, path: str) -> Iterator[gdal.Dataset]:
+        """借出 path 的只读句柄，with 结束后归还（不要把句柄或由它建的 VRT 带出 with）。"""
+        try:
+            key = _key(path)
+        except OSError:
+            self.invalidate(path)
+            raise RuntimeError(f"Cannot open raster: {path}")
+        ds = None
+        with self._lock:
+            pool = self._idle.get(key)
+            if pool:
+                ds = pool.pop()
+                self._idle_count -= 1
+                if not pool:
+                    del self._idle[key]
+            epoch = self._epoch
+        if ds is None:
+            self._prune_missing()
+            ds = gdal.Open(path, gdal.GA_ReadOnly)
+            if ds is None:
+                raise RuntimeError(f"Cannot open raster: {path}")
+        # 出错时不归还：异常栈里可能还留着引用该句柄的 VRT
+        yield ds
+        self._release(key, ds, epoch)
+
+    def _release(self, key: _Key, ds: gdal.Dataset, epoch: int) -> None:
+        if self.max_handles <= 0:
+            return
+        evicted = []  # 被淘汰的句柄在函数返回时（锁外）关闭
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._idle.setdefault(key, []).append(ds)
+            self._idle.move_to_end(key)
+            self._idle_count += 1
+            while self._idle_count > self.max_handles:
+                old_key, pool = next(iter(self._idle.items()))
+                evicted.append(pool.pop(0))
+                self._idle_count -= 1
+                if not pool:
+                    del self._idle[old_key]
+
+    def grid(self, path: str) -> GridInfo:
+        """path 的网格描述；同一文件版本只解析一次。"""
+        try:
+            key = _key(path)
+        except OSError:
+            self.invalidate(path)
+            raise RuntimeError(f"Cannot open raster: {path}")
+        with self._lock:
+            g = self._grids.get(key)
+            if g is not None:
+                self._grids.move_to_end(key)
+                return g
+        with self.dataset(path) as ds:
+            g = GridInfo.from_dataset(ds)
+        with self._lock:
+            self._grids[key] = g
+            while len(self._grids) > self.max_grids:
+                self._grids.popitem(last=False)
+        return g
+
+    def invalidate(self, path: str) -> None:
+        """丢弃 path（文件或目录，目录则包括其下所有文件）的全部缓存句柄与网格信息。"""
+        prefix = os.path.abspath(path)
+        dropped = []
+        with self._lock:
+            self._epoch += 1
+            for key in [k for k in self._idle if _under(k[0], prefix)]:
+                pool = self._idle.pop(key)
+                self._idle_count -= len(pool)
+                dropped.extend(pool)
+            for key in [k for k in self._grids if _under(k[0], prefix)]:
+                del self._grids[key]
+
+    def _prune_missing(self) -> None:
+        """丢弃文件已不存在或已被替换的空闲句柄（如其它进程删除了资产），避免长期占着已删文件的空间。"""
+        with self._lock:
+            keys = list(self._idle)
+        stale = []
+        for key in keys:
+            try:
+                if _key(key[0]) != key:
+                    stale.append(key)
+            except OSError:
+                stale.append(key)
+        if not stale:
+            return
+        dropped = []
+        with self._lock:
+            for key in stale:
+                pool = self._idle.pop(key, None)
+                if pool:
+                    self._idle_count -= len(pool)
+                    dropped.extend(pool)
+            for key in stale:
+                self._grids.pop(key, None)
+
+
+_cache = DatasetCache(settings.DATASET_CACHE_SIZE, settings.GRID_CACHE_SIZE)
+
+open_dataset = _cache.dataset
+grid_info = _cache.grid
+invalidate = _cache.invalidate
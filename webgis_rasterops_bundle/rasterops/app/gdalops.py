@@ -1,76 +1,111 @@
 from __future__ import annotations
 
+import ast
 import math
+import operator
 import os
-import shutil
-import subprocess
-import tempfile
-from typing import Dict, Tuple
+import queue
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from types import SimpleNamespace
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
 
 import numpy as np
-from osgeo import gdal
+from osgeo import gdal, osr
+
+from config import settings
+from dscache import GridInfo, grid_info, invalidate, open_dataset
 
 
 gdal.UseExceptions()
 
 
-def _dtype_name_from_gdal(gdal_dtype: int) -> str:
-    return gdal.GetDataTypeName(gdal_dtype)
+def gdal_info(path: str) -> Dict:
+    g = grid_info(path)
+    bbox = g.bbox  # 忽略旋转项：带旋转时为 None
+    return {
+        "driver": g.driver,
+        "xsize": g.xsize,
+        "ysize": g.ysize,
+        "bands": g.band_count,
+        "dtype": g.dtypes[0] if g.dtypes else None,
+        "nodata": g.nodata[0] if g.nodata else None,
+        "geotransform": list(g.geotransform) if g.geotransform is not None else None,
+        "projection": g.projection,
+        "bbox": dict(zip(("minx", "miny", "maxx", "maxy"), bbox)) if bbox is not None else None,
+        "overviews": g.overviews,
+    }
 
 
-def gdal_info(path: str) -> Dict:
-    ds = gdal.Open(path, gdal.GA_ReadOnly)
-    if ds is None:
-        raise RuntimeError(f"Cannot open raster: {path}")
-
-    gt = ds.GetGeoTransform(can_return_null=True)
-    proj = ds.GetProjectionRef()
-    xsize = ds.RasterXSize
-    ysize = ds.RasterYSize
-    bands = ds.RasterCount
-
-    # bbox（忽略旋转项）
-    bbox = None
-    if gt is not None:
-        origin_x, px_w, rot1, origin_y, rot2, px_h = gt
-        if abs(rot1) < 1e-12 and abs(rot2) < 1e-12:
-            minx = origin_x
-            maxy = origin_y
-            maxx = origin_x + px_w * xsize
-            miny = origin_y + px_h * ysize
-            bbox = {
-                "minx": min(minx, maxx),
-                "miny": min(miny, maxy),
-                "maxx": max(minx, maxx),
-                "maxy": max(miny, maxy),
-            }
+_RESAMPLE_ALGS = {
+    "nearest": gdal.GRA_NearestNeighbour,
+    "bilinear": gdal.GRA_Bilinear,
+    "cubic": gdal.GRA_Cubic,
+    "average": gdal.GRA_Average,
+    "lanczos": gdal.GRA_Lanczos,
+}
 
-    band1 = ds.GetRasterBand(1)
-    dtype = _dtype_name_from_gdal(band1.DataType)
-    nodata = band1.GetNoDataValue()
 
-    return {
-        "driver": ds.GetDriver().ShortName if ds.GetDriver() else None,
-        "xsize": xsize,
-        "ysize": ysize,
-        "bands": bands,
-        "dtype": dtype,
-        "nodata": nodata,
-        "geotransform": list(gt) if gt is not None else None,
-        "projection": proj,
-        "bbox": bbox,
-    }
+ProgressFn = Callable[[float], None]
 
 
-def warp_to_match(src_path: str, ref_path: str, out_path: str, resample: str = "bilinear") -> str:
-    """把 src warp 到与 ref 完全一致的网格（CRS/extent/resolution/size）。"""
-    ref = gdal.Open(ref_path, gdal.GA_ReadOnly)
-    if ref is None:
-        raise RuntimeError(f"Cannot open ref raster: {ref_path}")
+def _scaled_progress(progress: Optional[ProgressFn], lo: float, hi: float) -> Optional[ProgressFn]:
+    """把子阶段的 0~1 进度映射到整体进度的 [lo, hi] 区间。"""
+    if progress is None:
+        return None
+    return lambda frac: progress(lo + (hi - lo) * min(max(frac, 0.0), 1.0))
 
-    gt = ref.GetGeoTransform()
-    proj = ref.GetProjection()
-    xsize, ysize = ref.RasterXSize, ref.RasterYSize
+
+class _GdalProgress:
+    """把 progress(frac) 包装成 GDAL 进度回调。
+
+    progress 抛出的异常（如任务取消）不能穿过 GDAL 的 C 层：先记下并返回 0 让 GDAL 中止，
+    GDAL 调用返回后再由 reraise() 抛出原异常。
+    """
+
+    def __init__(self, progress: ProgressFn):
+        self.progress = progress
+        self.error: Optional[BaseException] = None
+
+    def __call__(self, complete: float, message, data) -> int:
+        try:
+            self.progress(complete)
+        except BaseException as e:  # noqa
+            self.error = e
+            return 0
+        return 1
+
+    def reraise(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+
+def _run_with_progress(fn: Callable[[Optional[_GdalProgress]], gdal.Dataset], progress: Optional[ProgressFn]):
+    """执行 fn(callback)（一次 GDAL 调用）；进度回调中止时抛出回调里的原异常。"""
+    cb = _GdalProgress(progress) if progress is not None else None
+    try:
+        ds = fn(cb)
+    except RuntimeError:
+        if cb is not None:
+            cb.reraise()
+        raise
+    if cb is not None:
+        cb.reraise()
+    return ds
+
+
+def _warp_options(
+    ref: GridInfo,
+    fmt: str,
+    resample: str,
+    callback: Optional[_GdalProgress] = None,
+) -> gdal.WarpOptions:
+    """构造把任意源 warp 到 ref 网格（CRS/extent/resolution/size）的参数。"""
+    gt = ref.geotransform or (0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+    proj = ref.projection
+    xsize, ysize = ref.xsize, ref.ysize
 
     # output bounds
     origin_x, px_w, _, origin_y, _, px_h = gt
@@ -79,114 +114,766 @@ def warp_to_match(src_path: str, ref_path: str, out_path: str, resample: str = "
     maxx = origin_x + px_w * xsize
     miny = origin_y + px_h * ysize
 
-    resample_alg = {
-        "nearest": gdal.GRA_NearestNeighbour,
-        "bilinear": gdal.GRA_Bilinear,
-        "cubic": gdal.GRA_Cubic,
-        "average": gdal.GRA_Average,
-        "lanczos": gdal.GRA_Lanczos,
-    }.get(resample.lower(), gdal.GRA_Bilinear)
-
-    opts = gdal.WarpOptions(
-        format="GTiff",
+    return gdal.WarpOptions(
+        format=fmt,
         outputBounds=(min(minx, maxx), min(miny, maxy), max(minx, maxx), max(miny, maxy)),
         width=xsize,
         height=ysize,
         dstSRS=proj,
-        resampleAlg=resample_alg,
+        resampleAlg=_RESAMPLE_ALGS.get(resample.lower(), gdal.GRA_Bilinear),
         multithread=True,
         warpMemoryLimit=512,
+        callback=callback,
     )
 
-    gdal.Warp(out_path, src_path, options=opts)
+
+def warp_to_match(
+    src_path: str,
+    ref_path: str,
+    out_path: str,
+    resample: str = "bilinear",
+    progress: Optional[ProgressFn] = None,
+) -> str:
+    """把 src warp 到与 ref 完全一致的网格（CRS/extent/resolution/size）。"""
+    ref = grid_info(ref_path)
+    _run_with_progress(
+        lambda cb: gdal.Warp(out_path, src_path, options=_warp_options(ref, "GTiff", resample, cb)), progress
+    )
     return out_path
 
 
-def _find_gdal_calc() -> list[str]:
-    """返回可执行命令列表前缀（用于 subprocess）。"""
-    for candidate in ["gdal_calc.py", "/usr/bin/gdal_calc.py", "/usr/local/bin/gdal_calc.py"]:
-        if shutil.which(candidate) or os.path.exists(candidate):
-            return [candidate]
-    # 在某些镜像里 gdal_calc 可能作为 python 模块
-    return ["python3", "-m", "osgeo_utils.gdal_calc"]
+def convert_to_cog(
+    src_path: str,
+    out_path: str,
+    resampling: str = "average",
+    progress: Optional[ProgressFn] = None,
+) -> str:
+    """转换为 Cloud-Optimized GeoTIFF：512 分块 + DEFLATE + 内部金字塔（overview 用 resampling 重采样）。
+
+    先写临时文件再原子替换，因此 out_path 可以等于 src_path（原地转换）。
+    """
+    tmp_path = out_path + ".cog.part"
+
+    def _translate(cb: Optional[_GdalProgress]) -> gdal.Dataset:
+        opts = gdal.TranslateOptions(
+            format="COG",
+            creationOptions=[
+                "COMPRESS=DEFLATE",
+                "PREDICTOR=YES",
+                f"OVERVIEW_RESAMPLING={resampling.upper()}",
+                "BIGTIFF=IF_SAFER",
+                f"NUM_THREADS={settings.GDAL_NUM_THREADS}",
+            ],
+            callback=cb,
+        )
+        return gdal.Translate(tmp_path, src_path, options=opts)
+
+    try:
+        ds = _run_with_progress(_translate, progress)
+        if ds is None:
+            raise RuntimeError(f"COG conversion failed: {src_path}")
+        ds = None  # 关闭以落盘
+        os.replace(tmp_path, out_path)
+        invalidate(out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return out_path
 
 
-def run_gdal_calc(
-    inputs: Dict[str, str],
+def _same_grid(g: GridInfo, ref: GridInfo) -> bool:
+    """判断 g 是否已在 ref 网格上：大小、geotransform（容差 1e-3 像元）与 CRS 一致。"""
+    if (g.xsize, g.ysize) != (ref.xsize, ref.ysize):
+        return False
+    gt, rgt = g.geotransform, ref.geotransform
+    if gt is None or rgt is None:
+        return gt is None and rgt is None
+    tol_x = abs(rgt[1]) * 1e-3
+    tol_y = abs(rgt[5]) * 1e-3
+    if not (math.isclose(gt[0], rgt[0], abs_tol=tol_x) and math.isclose(gt[3], rgt[3], abs_tol=tol_y)):
+        return False
+    for i in (1, 2, 4, 5):
+        if not math.isclose(gt[i], rgt[i], rel_tol=1e-9, abs_tol=1e-12):
+            return False
+
+    wkt, rwkt = g.projection, ref.projection
+    if not wkt or not rwkt:
+        return not wkt and not rwkt
+    srs, rsrs = osr.SpatialReference(), osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    rsrs.ImportFromWkt(rwkt)
+    return bool(srs.IsSame(rsrs))
+
+
+def open_aligned(src_path: str, ref_path: str, resample: str = "bilinear") -> gdal.Dataset:
+    """以 ref 网格打开 src：已对齐则直接打开，否则返回内存中的 warped VRT。
+
+    VRT 不落盘，读取时按块即时重采样，避免生成 aligned_*.tif 中间文件。
+    对齐判断只用缓存的网格信息；返回的 dataset 归调用方所有（不取自共享句柄池）。
+    """
+    ref = grid_info(ref_path)
+    if _same_grid(grid_info(src_path), ref):
+        src = gdal.Open(src_path, gdal.GA_ReadOnly)
+        if src is None:
+            raise RuntimeError(f"Cannot open raster: {src_path}")
+        return src
+    # 按路径建 VRT：源由 VRT 自己打开并持有，不依赖这里的 Python 句柄存活
+    vrt = gdal.Warp("", src_path, options=_warp_options(ref, "VRT", resample))
+    if vrt is None:
+        raise RuntimeError(f"Cannot build warped VRT: {src_path}")
+    return vrt
+
+
+# ---------------- 栅格计算器（进程内、分块流式） ----------------
+
+# 表达式里允许调用的 numpy 函数（gdal_calc 语法里常用的子集）
+_CALC_FUNCS = {
+    name: getattr(np, name)
+    for name in (
+        "abs", "absolute", "sqrt", "square", "power", "exp", "log", "log10", "log2", "log1p",
+        "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh",
+        "degrees", "radians", "hypot", "floor", "ceil", "round", "rint", "trunc", "sign",
+        "mod", "fmod", "minimum", "maximum", "fmin", "fmax", "clip", "where",
+        "isnan", "isfinite", "isinf", "nan_to_num",
+        "logical_and", "logical_or", "logical_not", "logical_xor",
+    )
+}
+_CALC_CONSTS = {"pi": math.pi, "e": math.e, "nan": float("nan"), "inf": float("inf")}
+# gdal_calc 习惯写 numpy.where(...)，这里只暴露白名单函数
+_CALC_MODULE_ALIASES = ("numpy", "np")
+
+_CALC_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.keyword,
+    ast.Name, ast.Load, ast.Constant, ast.Attribute,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.BitAnd, ast.BitOr, ast.BitXor, ast.Invert, ast.USub, ast.UAdd,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+# 纯常量子表达式由 Python 按整数精确计算（如 9**9**9**9），可能在 eval 里卡死且无法被取消/超时打断，
+# 校验时先用浮点估算，超出 float 范围的直接拒绝
+_CONST_BINOPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+}
+_CONST_BITOPS = {ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor}
+_CONST_CMPOPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+
+
+def _const_value(node: ast.AST) -> Optional[float]:
+    """纯常量子表达式的浮点估算值；不是纯常量、含不支持的运算符（留给白名单校验报错）
+    或估算本身出错时返回 None。
+
+    结果超出 float 范围时抛 ValueError。
+    """
+    try:
+        if isinstance(node, ast.Constant):
+            return float(node.value) if isinstance(node.value, (int, float)) else None
+        if isinstance(node, ast.UnaryOp):
+            v = _const_value(node.operand)
+            if v is None:
+                return None
+            if isinstance(node.op, ast.USub):
+                return -v
+            if isinstance(node.op, ast.Invert):
+                return float(~int(v)) if v.is_integer() else None
+            return v
+        if isinstance(node, ast.Compare):
+            values = [_const_value(node.left)] + [_const_value(c) for c in node.comparators]
+            ops = [_CONST_CMPOPS.get(type(op)) for op in node.ops]
+            if any(v is None for v in values) or any(op is None for op in ops):
+                return None
+            return float(all(op(a, b) for op, a, b in zip(ops, values, values[1:])))
+        if isinstance(node, ast.BinOp):
+            a, b = _const_value(node.left), _const_value(node.right)
+            if a is None or b is None:
+                return None
+            if type(node.op) in _CONST_BITOPS:
+                if not (a.is_integer() and b.is_integer()):
+                    return None
+                return float(_CONST_BITOPS[type(node.op)](int(a), int(b)))
+            fn = _CONST_BINOPS.get(type(node.op))
+            if fn is None:
+                return None
+            v = fn(a, b)
+            if isinstance(v, complex):
+                return None
+            if math.isinf(v) and math.isfinite(a) and math.isfinite(b):
+                raise OverflowError
+            return v
+    except OverflowError:
+        raise ValueError("表达式中的常量运算结果过大") from None
+    except (ZeroDivisionError, TypeError):
+        return None
+    return None
+
+
+def compile_calc_expr(expr: str, variables) -> Callable[[Dict[str, np.ndarray]], np.ndarray]:
+    """把 gdal_calc 风格表达式编译成受限的 numpy 求值函数（只编译一次）。
+
+    只允许：算术/比较/位运算、数字常量、输入变量、白名单 numpy 函数。
+    非法表达式抛 ValueError。
+    """
+    variables = set(variables)
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"表达式语法错误: {e.msg}") from None
+
+    for node in ast.walk(tree):
+        if not isinstance(node, _CALC_ALLOWED_NODES):
+            raise ValueError(f"表达式不支持的语法: {type(node).__name__}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"表达式不支持的常量: {node.value!r}")
+        if isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id in _CALC_MODULE_ALIASES):
+                raise ValueError("表达式只允许 numpy.<函数> 形式的属性访问")
+            if node.attr not in _CALC_FUNCS:
+                raise ValueError(f"表达式不支持的函数: {node.attr}")
+        if isinstance(node, ast.Call) and not isinstance(node.func, (ast.Name, ast.Attribute)):
+            raise ValueError("表达式只允许直接调用函数")
+        if isinstance(node, ast.BinOp):
+            _const_value(node)
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name in variables or name in _CALC_CONSTS or name in _CALC_MODULE_ALIASES:
+                continue
+            if name in _CALC_FUNCS:
+                continue
+            raise ValueError(f"表达式引用了未知变量或函数: {name}")
+
+    code = compile(tree, "<calc>", "eval")
+    module = SimpleNamespace(**_CALC_FUNCS)
+    base_ns: Dict[str, object] = {**_CALC_FUNCS, **_CALC_CONSTS}
+    for alias in _CALC_MODULE_ALIASES:
+        base_ns[alias] = module
+
+    def _evaluate(arrays: Dict[str, np.ndarray]) -> np.ndarray:
+        ns = dict(base_ns)
+        ns.update(arrays)
+        with np.errstate(all="ignore"):
+            return eval(code, {"__builtins__": {}}, ns)  # noqa: S307  已做 AST 白名单校验
+
+    return _evaluate
+
+
+def _gtiff_creation_options(gdal_dtype: int) -> list[str]:
+    """派生结果统一的 GTiff 创建参数：分块 + DEFLATE + 多线程压缩。"""
+    is_float = gdal_dtype in (gdal.GDT_Float32, gdal.GDT_Float64)
+    return [
+        "TILED=YES",
+        "COMPRESS=DEFLATE",
+        f"PREDICTOR={3 if is_float else 2}",
+        "BIGTIFF=IF_SAFER",
+        f"NUM_THREADS={settings.GDAL_NUM_THREADS}",
+    ]
+
+
+def _window_shape(xsize: int, ysize: int, max_pixels: int, align: int = 256) -> Tuple[int, int]:
+    """按像素上限选择读写窗口：优先整行条带，高宽都对齐到 align（输出 tile 大小）。"""
+    max_pixels = max(int(max_pixels), align * align)
+    if xsize * align <= max_pixels:
+        wx = xsize
+    else:
+        wx = max(align, (max_pixels // align) // align * align)
+    wy = max(align, (max_pixels // wx) // align * align)
+    return min(wx, xsize), min(wy, ysize)
+
+
+def _iter_windows(xsize: int, ysize: int, wx: int, wy: int) -> Iterator[Tuple[int, int, int, int]]:
+    for y0 in range(0, ysize, wy):
+        ys = min(wy, ysize - y0)
+        for x0 in range(0, xsize, wx):
+            yield x0, y0, min(wx, xsize - x0), ys
+
+
+def run_raster_calc(
+    inputs: Dict[str, str | gdal.Dataset],
     bands: Dict[str, int],
     expr: str,
     out_path: str,
     out_dtype: str = "Float32",
     nodata: float | int | None = None,
+    progress: Optional[ProgressFn] = None,
 ) -> str:
-    """栅格计算器：多输入、多 band、表达式。"""
-
-    cmd = _find_gdal_calc()
-    for var, path in inputs.items():
-        cmd += [f"-{var}", path]
-        if var in bands:
-            cmd += [f"--{var}_band", str(int(bands[var]))]
-
-    cmd += [
-        "--calc",
-        expr,
-        "--outfile",
-        out_path,
-        "--type",
-        out_dtype,
-        "--overwrite",
-    ]
+    """栅格计算器：多输入、多 band、表达式（进程内分块计算）。
+
+    inputs 的值可以是路径或已打开的 dataset（如 open_aligned 返回的 VRT）。
+    所有输入必须已在同一网格上；以第一个变量（字母序）为输出网格。
+    按窗口逐块读取各输入 -> 表达式求值 -> 写出，内存占用与影像大小无关。
+    nodata 非空时：任一输入为 nodata 或结果非有限值的像元写为 nodata。
+    """
+    if not inputs:
+        raise ValueError("inputs 不能为空")
+    paths = {var: src for var, src in inputs.items() if isinstance(src, str)}
+    if paths:
+        # 路径输入从共享句柄池借出，计算结束后归还
+        with ExitStack() as stack:
+            opened = {var: stack.enter_context(open_dataset(p)) for var, p in paths.items()}
+            return run_raster_calc({**inputs, **opened}, bands, expr, out_path, out_dtype, nodata, progress)
+
+    evaluate = compile_calc_expr(expr, inputs.keys())
+
+    out_type = gdal.GetDataTypeByName(out_dtype)
+    if out_type == gdal.GDT_Unknown:
+        raise ValueError(f"不支持的输出类型: {out_dtype}")
+
+    variables = sorted(inputs.keys())
+    srcs: Dict[str, gdal.Band] = {}
+    src_nodata: Dict[str, Optional[float]] = {}
+    keep = []  # 持有 dataset 引用，避免 band 失效
+    for var in variables:
+        ds = inputs[var]
+        bi = int(bands.get(var, 1))
+        if bi < 1 or bi > ds.RasterCount:
+            raise ValueError(f"{var} 的 band={bi} 超出范围（共 {ds.RasterCount} 个 band）")
+        keep.append(ds)
+        srcs[var] = ds.GetRasterBand(bi)
+        src_nodata[var] = srcs[var].GetNoDataValue()
+
+    ref_ds = keep[0]
+    xsize, ysize = ref_ds.RasterXSize, ref_ds.RasterYSize
+    for var, ds in zip(variables, keep):
+        if (ds.RasterXSize, ds.RasterYSize) != (xsize, ysize):
+            raise RuntimeError(f"输入 {var} 与 {variables[0]} 的网格大小不一致，需先对齐")
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    drv = gdal.GetDriverByName("GTiff")
+    out_ds = drv.Create(out_path, xsize, ysize, 1, out_type, options=_gtiff_creation_options(out_type))
+    if out_ds is None:
+        raise RuntimeError("Cannot create output")
+    gt = ref_ds.GetGeoTransform(can_return_null=True)
+    if gt is not None:
+        out_ds.SetGeoTransform(gt)
+    out_ds.SetProjection(ref_ds.GetProjectionRef())
+    out_band = out_ds.GetRasterBand(1)
     if nodata is not None:
-        cmd += ["--NoDataValue", str(nodata)]
+        out_band.SetNoDataValue(float(nodata))
+
+    wx, wy = _window_shape(xsize, ysize, settings.CALC_BLOCK_PIXELS)
+    total = math.ceil(xsize / wx) * math.ceil(ysize / wy)
+    for i, (x0, y0, xs, ys) in enumerate(_iter_windows(xsize, ysize, wx, wy)):
+        arrays: Dict[str, np.ndarray] = {}
+        invalid = None
+        for var in variables:
+            # 统一提升到 float64 计算，避免整型溢出/整除截断
+            a = srcs[var].ReadAsArray(x0, y0, xs, ys, buf_type=gdal.GDT_Float64)
+            arrays[var] = a
+            nd = src_nodata[var]
+            if nodata is not None and nd is not None:
+                m = np.isnan(a) if math.isnan(nd) else (a == nd)
+                invalid = m if invalid is None else (invalid | m)
+
+        res = np.asarray(evaluate(arrays), dtype=np.float64)
+        res = np.broadcast_to(res, (ys, xs))
+        if nodata is not None:
+            res = np.where(np.isfinite(res), res, float(nodata))
+            if invalid is not None:
+                res[invalid] = float(nodata)
+        out_band.WriteArray(res, xoff=x0, yoff=y0)
+
+        if progress is not None:
+            progress((i + 1) / total)
+
+    out_ds.FlushCache()
+    out_ds = None
+    return out_path
 
-    # quiet，避免刷屏
-    cmd += ["--quiet"]
 
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if p.returncode != 0:
-        raise RuntimeError(f"gdal_calc failed: {p.stderr.strip()}")
+# ---- 波段统计：min/max/mean/std、分位数与直方图 ----
+
+STATS_PERCENTILES = (1, 2, 5, 25, 50, 75, 95, 98, 99)
+# 返回给前端的直方图桶数
+STATS_HIST_BINS = 128
+# 求分位数用的细直方图桶数；整型且取值跨度不超过它时按整数逐值计数（分位数精确）
+_STATS_FINE_BINS = 1 << 16
+
+
+class _BandAccumulator:
+    """单波段流式统计：矩按 Chan 并行公式逐块合并（float64），直方图在第二遍累加。"""
+
+    def __init__(self, nodata: Optional[float], is_int: bool):
+        self.nodata = nodata
+        self.is_int = is_int
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.fine: Optional[np.ndarray] = None
+        self.coarse: Optional[np.ndarray] = None
+        self._fine_width = 1.0
+        self._coarse_width = 1.0
+
+    def valid(self, a: np.ndarray) -> np.ndarray:
+        a = a.ravel()
+        m = np.isfinite(a)
+        if self.nodata is not None and not math.isnan(self.nodata):
+            m &= a != self.nodata
+        return a[m]
+
+    def add_moments(self, v: np.ndarray) -> None:
+        if v.size == 0:
+            return
+        nb = v.size
+        mb = float(v.mean())
+        m2b = float(np.square(v - mb).sum())
+        n = self.n + nb
+        d = mb - self.mean
+        self.mean += d * nb / n
+        self.m2 += m2b + d * d * self.n * nb / n
+        self.n = n
+        self.min = min(self.min, float(v.min()))
+        self.max = max(self.max, float(v.max()))
+
+    def start_histogram(self) -> None:
+        if self.n == 0:
+            return
+        span = self.max - self.min
+        if self.is_int and span < _STATS_FINE_BINS:
+            nfine, self._fine_width = int(span) + 1, 1.0
+        else:
+            nfine, self._fine_width = _STATS_FINE_BINS, (span / _STATS_FINE_BINS) or 1.0
+        self._coarse_width = (span / STATS_HIST_BINS) or 1.0
+        self.fine = np.zeros(nfine, dtype=np.int64)
+        self.coarse = np.zeros(STATS_HIST_BINS, dtype=np.int64)
+
+    def _bin(self, v: np.ndarray, width: float, nbins: int) -> np.ndarray:
+        idx = ((v - self.min) / width).astype(np.int64)
+        np.clip(idx, 0, nbins - 1, out=idx)
+        return np.bincount(idx, minlength=nbins)
+
+    def add_histogram(self, v: np.ndarray) -> None:
+        if self.fine is None or v.size == 0:
+            return
+        self.fine += self._bin(v, self._fine_width, self.fine.size)
+        self.coarse += self._bin(v, self._coarse_width, STATS_HIST_BINS)
+
+    def percentile(self, p: float) -> float:
+        cum = np.cumsum(self.fine)
+        k = int(np.searchsorted(cum, p / 100.0 * self.n, side="left"))
+        k = min(max(k, 0), self.fine.size - 1)
+        if self.is_int and self._fine_width == 1.0:
+            return self.min + k
+        return min(self.min + (k + 0.5) * self._fine_width, self.max)
+
+    def result(self, band: int) -> Dict:
+        out: Dict = {"band": band, "count": self.n}
+        if self.n == 0:
+            out.update({"min": None, "max": None, "mean": None, "std": None, "percentiles": {}, "histogram": None})
+            return out
+        out.update(
+            {
+                "min": self.min,
+                "max": self.max,
+                "mean": self.mean,
+                "std": math.sqrt(self.m2 / self.n),
+                "percentiles": {str(p): self.percentile(p) for p in STATS_PERCENTILES},
+                "histogram": {"min": self.min, "max": self.max, "counts": self.coarse.tolist()},
+            }
+        )
+        return out
+
+
+def _accumulate_windows(
+    ds: gdal.Dataset,
+    groups: list[Tuple[_BandAccumulator, list[int]]],
+    progress: Optional[ProgressFn] = None,
+) -> None:
+    """按窗口分块扫描两遍（矩 / 直方图），每个累加器汇总其对应波段的全部像元。"""
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    wx, wy = _window_shape(xsize, ysize, settings.CALC_BLOCK_PIXELS)
+    windows = list(_iter_windows(xsize, ysize, wx, wy))
+    total = 2 * len(windows)
+    for step in range(2):
+        for i, (x0, y0, xs, ys) in enumerate(windows):
+            for acc, bands in groups:
+                for b in bands:
+                    v = acc.valid(ds.GetRasterBand(b).ReadAsArray(x0, y0, xs, ys, buf_type=gdal.GDT_Float64))
+                    if step == 0:
+                        acc.add_moments(v)
+                    else:
+                        acc.add_histogram(v)
+            if progress is not None:
+                progress((step * len(windows) + i + 1) / total)
+        if step == 0:
+            for acc, _ in groups:
+                acc.start_histogram()
+
+
+def band_stats(
+    src: str | gdal.Dataset,
+    bands: Optional[list[int]] = None,
+    exact: bool = False,
+    progress: Optional[ProgressFn] = None,
+) -> Dict:
+    """各波段统计（跳过 nodata 与非有限值）。
+
+    exact=False：按 STATS_APPROX_PIXELS 缩小读取，GDAL 会改读合适层级的 overview，一次读取即可。
+    exact=True：按窗口分块扫描两遍（矩 / 直方图），内存占用与影像大小无关。
+    """
+    if isinstance(src, str):
+        with open_dataset(src) as ds:
+            return band_stats(ds, bands, exact, progress)
+    ds = src
+    band_list = list(bands) if bands else list(range(1, ds.RasterCount + 1))
+    for b in band_list:
+        if b < 1 or b > ds.RasterCount:
+            raise ValueError(f"band={b} 超出范围（共 {ds.RasterCount} 个 band）")
+    float_types = (gdal.GDT_Float32, gdal.GDT_Float64)
+    accs = {}
+    for b in band_list:
+        band = ds.GetRasterBand(b)
+        accs[b] = _BandAccumulator(band.GetNoDataValue(), band.DataType not in float_types)
+
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    if not exact:
+        scale = min(1.0, math.sqrt(settings.STATS_APPROX_PIXELS / float(xsize * ysize)))
+        bx, by = max(1, int(xsize * scale)), max(1, int(ysize * scale))
+        for i, b in enumerate(band_list):
+            # 最近邻缩小读取：保留原始取值，不引入插值出的新值
+            a = ds.GetRasterBand(b).ReadAsArray(buf_xsize=bx, buf_ysize=by, buf_type=gdal.GDT_Float64)
+            acc = accs[b]
+            v = acc.valid(a)
+            acc.add_moments(v)
+            acc.start_histogram()
+            acc.add_histogram(v)
+            if progress is not None:
+                progress((i + 1) / len(band_list))
+        sample = [bx, by]
+    else:
+        _accumulate_windows(ds, [(accs[b], [b]) for b in band_list], progress)
+        sample = [xsize, ysize]
+
+    return {
+        "exact": exact,
+        "sample_size": sample,
+        "bands": [accs[b].result(b) for b in band_list],
+    }
 
-    return out_path
 
+def _unit_bounds(ds: gdal.Dataset, bands: list[int], progress: Optional[ProgressFn] = None) -> Tuple[float, float]:
+    """整幅影像归一化到 [0,1] 的线性区间 (lo, hi)，各块共用同一拉伸（无接缝）。
 
-def _norm_to_unit(arr: np.ndarray) -> np.ndarray:
-    arr = arr.astype(np.float32)
-    if np.issubdtype(arr.dtype, np.integer):
-        # 这里基本不会触发，因为已转 float32；但保留逻辑
-        info = np.iinfo(arr.dtype)
-        if info.min >= 0:
-            return np.clip(arr / float(info.max), 0.0, 1.0)
-        return np.clip((arr - info.min) / float(info.max - info.min), 0.0, 1.0)
-    # float：用鲁棒分位数
-    finite = np.isfinite(arr)
-    if not np.any(finite):
-        return np.zeros_like(arr, dtype=np.float32)
-    lo, hi = np.percentile(arr[finite], [2, 98])
+    Byte/UInt16 用类型满量程；其余（Int16/浮点）用所选波段合并后的鲁棒分位数 2%/98%，
+    由一次分块流式直方图扫描得到，之后每块只做仿射变换。
+    """
+    dtype_name = gdal.GetDataTypeName(ds.GetRasterBand(bands[0]).DataType)
+    if dtype_name in ("Byte", "UInt8"):
+        return 0.0, 255.0
+    if dtype_name in ("UInt16",):
+        return 0.0, 65535.0
+    # Int16 假设数据主要非负；与浮点一样用分位数归一
+    acc = _BandAccumulator(ds.GetRasterBand(bands[0]).GetNoDataValue(), dtype_name not in ("Float32", "Float64"))
+    _accumulate_windows(ds, [(acc, bands)], progress)
+    if acc.n == 0:
+        return 0.0, 0.0
+    return float(acc.percentile(2)), float(acc.percentile(98))
+
+
+def _to_unit_inplace(buf: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    """原地做 (buf - lo) / (hi - lo) 并裁剪到 [0,1]；buf 须为 float32。"""
     if abs(hi - lo) < 1e-12:
-        return np.zeros_like(arr, dtype=np.float32)
-    return np.clip((arr - lo) / (hi - lo), 0.0, 1.0)
+        buf.fill(0.0)
+        return buf
+    buf -= np.float32(lo)
+    buf *= np.float32(1.0 / (hi - lo))
+    np.clip(buf, 0.0, 1.0, out=buf)
+    return buf
 
 
-def _scale_rgb_to_unit(rgb: np.ndarray, gdal_dtype_name: str) -> np.ndarray:
-    rgb = rgb.astype(np.float32)
-    if gdal_dtype_name in ("Byte", "UInt8"):
-        return np.clip(rgb / 255.0, 0.0, 1.0)
-    if gdal_dtype_name in ("UInt16",):
-        return np.clip(rgb / 65535.0, 0.0, 1.0)
-    if gdal_dtype_name in ("Int16",):
-        # 假设数据主要非负；否则退化到 min/max 归一
-        return _norm_to_unit(rgb)
-    return _norm_to_unit(rgb)
+# 融合输出窗口边长：与输出 GTiff 的 256x256 tile 对齐，一个窗口恰好写满一个块
+_FUSE_TILE = 256
 
+_FUSE_OUT_TYPES = {
+    "Byte": (gdal.GDT_Byte, np.uint8, 255.0),
+    "UInt8": (gdal.GDT_Byte, np.uint8, 255.0),
+    "UInt16": (gdal.GDT_UInt16, np.uint16, 65535.0),
+}
 
-def _cast_from_unit(rgb_unit: np.ndarray, out_dtype: str) -> np.ndarray:
-    rgb_unit = np.clip(rgb_unit, 0.0, 1.0)
-    if out_dtype in ("Byte", "UInt8"):
-        return np.round(rgb_unit * 255.0).astype(np.uint8)
-    if out_dtype == "UInt16":
-        return np.round(rgb_unit * 65535.0).astype(np.uint16)
-    # 浮点输出（少用；调试可用）
-    return rgb_unit.astype(np.float32)
+
+class _FuseTiler:
+    """融合的逐块计算：持有自己的 dataset 句柄，缓冲区预分配并在各块间复用。
+
+    每块只做一次 dataset 级多 band 读取（HS / RGB / LP 各一次）。
+    """
+
+    def __init__(
+        self,
+        hs_hr_ds: gdal.Dataset,
+        rgb_ds: gdal.Dataset,
+        rgb_lp_ds: gdal.Dataset,
+        mu: np.ndarray,
+        w_scaled: np.ndarray,
+        rgb_bounds: Tuple[float, float],
+        alpha: float,
+        out_dtype: str,
+    ):
+        self.hs_hr_ds = hs_hr_ds
+        self.rgb_ds = rgb_ds
+        self.rgb_lp_ds = rgb_lp_ds
+        self.B = hs_hr_ds.RasterCount
+        self.hs_bands = list(range(1, self.B + 1))
+        self.rgb_lo, self.rgb_hi = rgb_bounds
+        self.alpha = np.float32(alpha)
+        # (B, 1) 均值，(3, B) 已除以 sigma 的回归系数：pred = Ws @ (X - mu)
+        self.mu = mu.astype(np.float32).reshape(-1, 1)
+        self.w_scaled = np.ascontiguousarray(w_scaled, dtype=np.float32)
+        _, self.out_np, self.out_scale = _FUSE_OUT_TYPES.get(out_dtype, (gdal.GDT_Float32, np.float32, None))
+
+        n = _FUSE_TILE * _FUSE_TILE
+        self._hs = np.empty(self.B * n, dtype=np.float32)
+        self._rgb = np.empty(3 * n, dtype=np.float32)
+        self._lp = np.empty(3 * n, dtype=np.float32)
+        self._pred = np.empty(3 * n, dtype=np.float32)
+        self._out = np.empty(3 * n, dtype=self.out_np)
+
+    def compute(self, x0: int, y0: int, xs: int, ys: int) -> np.ndarray:
+        """计算一个窗口，返回 (3, ys, xs) 的输出数组（复用内部缓冲区，下次调用前有效）。"""
+        n = xs * ys
+        # 平坦缓冲区按窗口大小切片再 reshape，保证 buf_obj 连续（边缘块也成立）
+        hs = self._hs[: self.B * n].reshape(self.B, ys, xs)
+        rgb = self._rgb[: 3 * n].reshape(3, ys, xs)
+        lp = self._lp[: 3 * n].reshape(3, ys, xs)
+        pred = self._pred[: 3 * n].reshape(3, n)
+        out = self._out[: 3 * n].reshape(3, ys, xs)
+
+        self.hs_hr_ds.ReadAsArray(x0, y0, xs, ys, buf_obj=hs, buf_type=gdal.GDT_Float32, band_list=self.hs_bands)
+        self.rgb_ds.ReadAsArray(x0, y0, xs, ys, buf_obj=rgb, buf_type=gdal.GDT_Float32, band_list=[1, 2, 3])
+        self.rgb_lp_ds.ReadAsArray(x0, y0, xs, ys, buf_obj=lp, buf_type=gdal.GDT_Float32, band_list=[1, 2, 3])
+
+        # 标准化并回归：先原地去均值（避免 float32 大数相消），再 (3, B) @ (B, n)
+        hs2d = hs.reshape(self.B, n)
+        hs2d -= self.mu
+        np.matmul(self.w_scaled, hs2d, out=pred)
+        pred3 = pred.reshape(3, ys, xs)
+
+        # 细节注入：out = pred + alpha * (RGB - LP(RGB))
+        # RGB 与低通用同一全局拉伸：细节项在同一量纲下相减
+        _to_unit_inplace(rgb, self.rgb_lo, self.rgb_hi)
+        _to_unit_inplace(lp, self.rgb_lo, self.rgb_hi)
+        rgb -= lp
+        rgb *= self.alpha
+        pred3 += rgb
+        np.clip(pred3, 0.0, 1.0, out=pred3)
+
+        if self.out_scale is not None:
+            pred3 *= np.float32(self.out_scale)
+            np.rint(pred3, out=pred3)
+        np.copyto(out, pred3, casting="unsafe")
+        return out
+
+
+class _RidgeAccumulator:
+    """岭回归的流式充分统计量（float64）：样本数、X/Y 均值、X 的离差阵 Cxx 与交叉离差阵 Cxy。
+
+    各块先算块内统计量，再按 Chan 并行公式合并，避免 sum(x^2) - n*mean^2 的大数相消。
+    """
+
+    def __init__(self, B: int, K: int):
+        self.n = 0
+        self.mx = np.zeros(B, dtype=np.float64)
+        self.my = np.zeros(K, dtype=np.float64)
+        self.cxx = np.zeros((B, B), dtype=np.float64)
+        self.cxy = np.zeros((B, K), dtype=np.float64)
+
+    def add(self, X: np.ndarray, Y: np.ndarray) -> None:
+        """X: (n, B)，Y: (n, K)，均为 float64。"""
+        nb = X.shape[0]
+        if nb == 0:
+            return
+        mxb = X.mean(axis=0)
+        myb = Y.mean(axis=0)
+        Xc = X - mxb
+        cxx_b = Xc.T @ Xc
+        cxy_b = Xc.T @ (Y - myb)
+        n = self.n + nb
+        dx = mxb - self.mx
+        dy = myb - self.my
+        f = self.n * nb / n
+        self.cxx += cxx_b + f * np.outer(dx, dx)
+        self.cxy += cxy_b + f * np.outer(dx, dy)
+        self.mx += dx * (nb / n)
+        self.my += dy * (nb / n)
+        self.n = n
+
+    def solve(self, lam: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """标准化 X 后解 (Xn^T Xn + lam I) W = Xn^T Y，返回 (mu, sigma, W)。
+
+        X 去均值后 Xn^T Y 与 Y 是否去均值无关，故 Xn^T Y = Cxy / sigma。
+        """
+        if self.n == 0:
+            raise RuntimeError("no valid pixels to fit fusion regression (check nodata / overlap)")
+        sigma = np.sqrt(np.maximum(np.diag(self.cxx) / self.n, 0.0))
+        sigma = np.where(sigma < 1e-8, 1.0, sigma)
+        XtX = self.cxx / np.outer(sigma, sigma)
+        XtY = self.cxy / sigma[:, None]
+        W = np.linalg.solve(XtX + lam * np.eye(self.mx.size), XtY)  # (B, K)
+        return self.mx, sigma, W
+
+
+def _valid_mask(block: np.ndarray, nodata: list[Optional[float]]) -> np.ndarray:
+    """(C, n) 块中所有通道都有效（有限且不等于各自 nodata）的像元。"""
+    m = np.isfinite(block).all(axis=0)
+    for c, nd in enumerate(nodata):
+        if nd is not None and not math.isnan(nd):
+            m &= block[c] != nd
+    return m
+
+
+def _fit_ridge_streaming(
+    hs_ds: gdal.Dataset,
+    rgb_lr_ds: gdal.Dataset,
+    rgb_bounds: Tuple[float, float],
+    lam: float,
+    max_samples: int,
+    progress: Optional[ProgressFn] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """HS_lr -> RGB_lr（归一化到 [0,1]）的岭回归，分块读取并累加充分统计量。
+
+    max_samples > 0 且有效像元更多时，按 max_samples / 有效像元数 的概率做伯努利抽样（固定种子，可复现）；
+    max_samples <= 0 时用全部有效像元。有效像元数需要先单独扫一遍（只在像元总数超过 max_samples 时），
+    按像元总数算概率时 nodata 多的影像实际样本会远少于 max_samples。
+    """
+    B = hs_ds.RasterCount
+    lw, lh = hs_ds.RasterXSize, hs_ds.RasterYSize
+    if (rgb_lr_ds.RasterXSize, rgb_lr_ds.RasterYSize) != (lw, lh) or rgb_lr_ds.RasterCount < 3:
+        raise RuntimeError("RGB_lr unexpected dimensions")
+    hs_nodata = [hs_ds.GetRasterBand(i).GetNoDataValue() for i in range(1, B + 1)]
+    rgb_nodata = [rgb_lr_ds.GetRasterBand(i).GetNoDataValue() for i in (1, 2, 3)]
+
+    # 每块 B 个波段按 float64 读取：窗口像素数按波段数收缩，保持块内存有界
+    wx, wy = _window_shape(lw, lh, max(settings.CALC_BLOCK_PIXELS // B, 4096), align=64)
+    total = math.ceil(lw / wx) * math.ceil(lh / wy)
+
+    def _blocks(prog: Optional[ProgressFn]):
+        for i, (x0, y0, xs, ys) in enumerate(_iter_windows(lw, lh, wx, wy)):
+            hs = hs_ds.ReadAsArray(x0, y0, xs, ys, buf_type=gdal.GDT_Float64).reshape(B, -1)
+            rgb = rgb_lr_ds.ReadAsArray(x0, y0, xs, ys, buf_type=gdal.GDT_Float64, band_list=[1, 2, 3]).reshape(3, -1)
+            yield hs, rgb, _valid_mask(hs, hs_nodata) & _valid_mask(rgb, rgb_nodata)
+            if prog is not None:
+                prog((i + 1) / total)
+
+    keep_p = 1.0
+    if 0 < max_samples < lw * lh:
+        n_valid = sum(int(np.count_nonzero(m)) for _, _, m in _blocks(_scaled_progress(progress, 0.0, 0.5)))
+        keep_p = min(1.0, max_samples / n_valid) if n_valid else 1.0
+        progress = _scaled_progress(progress, 0.5, 1.0)
+    rng = np.random.default_rng(20260110)
+    acc = _RidgeAccumulator(B, 3)
+
+    for hs, rgb, m in _blocks(progress):
+        if keep_p < 1.0:
+            m &= rng.random(m.size) < keep_p
+        if m.any():
+            rgb_u = rgb[:, m].astype(np.float32)
+            _to_unit_inplace(rgb_u, *rgb_bounds)
+            acc.add(hs[:, m].T, rgb_u.T.astype(np.float64))
+    return acc.solve(lam)
 
 
 def fuse_hs_rgb(
@@ -197,6 +884,8 @@ def fuse_hs_rgb(
     lam: float = 1e-3,
     max_samples: int = 200_000,
     out_dtype: str = "Byte",
+    workers: Optional[int] = None,
+    progress: Optional[ProgressFn] = None,
 ) -> str:
     """传统 HS+RGB 融合：
 
@@ -206,139 +895,145 @@ def fuse_hs_rgb(
     4) 细节注入：out = pred(HS_hr) + alpha*(RGB - LP(RGB))
 
     输出：3-band GeoTIFF（RGB 网格）
+
+    workers > 1 时多线程并行计算各块（每线程独立的 dataset 句柄），
+    由调用线程按块顺序统一写出；默认取 settings.FUSE_WORKERS。
+    progress(frac)：RGB 降采样占前 10%，非 Byte/UInt16 的 RGB 求全局归一化区间与分块拟合各占约 10%，
+    其余按已写出的块数汇报。
+
+    拟合只在低分辨率网格上分块流式累加（跳过 nodata），不整读 HS；max_samples <= 0 时用全部有效像元。
     """
 
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
-    hs_ds = gdal.Open(hs_path, gdal.GA_ReadOnly)
-    rgb_ds = gdal.Open(rgb_path, gdal.GA_ReadOnly)
-    if hs_ds is None:
-        raise RuntimeError(f"Cannot open HS: {hs_path}")
-    if rgb_ds is None:
-        raise RuntimeError(f"Cannot open RGB: {rgb_path}")
-
-    if rgb_ds.RasterCount < 3:
+    if grid_info(rgb_path).band_count < 3:
         raise RuntimeError("RGB input must have at least 3 bands")
-    if hs_ds.RasterCount < 3:
+    if grid_info(hs_path).band_count < 3:
         raise RuntimeError("HS input must have at least 3 bands")
 
-    rgb_dtype = gdal.GetDataTypeName(rgb_ds.GetRasterBand(1).DataType)
-
-    with tempfile.TemporaryDirectory(prefix="rasterops_fuse_") as td:
-        # 1) RGB -> HS grid（低分辨率）
-        rgb_lr = os.path.join(td, "rgb_lr.tif")
-        warp_to_match(rgb_path, hs_path, rgb_lr, resample="average")
-
-        # 2) 低通：RGB_lr -> RGB grid（再上采样）
-        rgb_lp = os.path.join(td, "rgb_lp.tif")
-        warp_to_match(rgb_lr, rgb_path, rgb_lp, resample="bilinear")
-
-        # 3) HS -> RGB grid（高分辨率）
-        hs_hr = os.path.join(td, "hs_hr.tif")
-        warp_to_match(hs_path, rgb_path, hs_hr, resample="bilinear")
-
-        # 4) 读低分辨率用于拟合
-        hs_lr_ds = gdal.Open(hs_path, gdal.GA_ReadOnly)
-        rgb_lr_ds = gdal.Open(rgb_lr, gdal.GA_ReadOnly)
-        if hs_lr_ds is None or rgb_lr_ds is None:
-            raise RuntimeError("Internal warp failed")
-
-        B = hs_lr_ds.RasterCount
-        # HS_lr 读全图（通常比 RGB 小很多）；若仍然很大，可后续再优化为分块采样
-        hs_lr_arr = hs_lr_ds.ReadAsArray().astype(np.float32)  # (B, H, W)
-        rgb_lr_arr = rgb_lr_ds.ReadAsArray().astype(np.float32)  # (>=3, H, W)
-
-        if rgb_lr_arr.ndim == 2:
-            raise RuntimeError("RGB_lr unexpected dimensions")
-
-        rgb_lr_arr = rgb_lr_arr[:3, :, :]
-        rgb_lr_unit = _scale_rgb_to_unit(rgb_lr_arr, rgb_dtype)
-
-        # 展平采样
-        H, W = hs_lr_arr.shape[1], hs_lr_arr.shape[2]
-        N = H * W
-        n_samp = min(max_samples, N)
-        rng = np.random.default_rng(20260110)
-        idx = rng.choice(N, size=n_samp, replace=False)
-        ys = idx // W
-        xs = idx % W
-
-        # X: (n, B)
-        X = hs_lr_arr[:, ys, xs].T  # (n, B)
-        Y = rgb_lr_unit[:, ys, xs].T  # (n, 3)
-
-        # 标准化 X（每 band）
-        mu = X.mean(axis=0, dtype=np.float64)
-        sigma = X.std(axis=0, dtype=np.float64)
-        sigma = np.where(sigma < 1e-8, 1.0, sigma)
-        Xn = (X - mu) / sigma
-
-        # 岭回归：W = (X^T X + lam I)^{-1} X^T Y
-        XtX = Xn.T @ Xn
-        XtY = Xn.T @ Y
-        Wmat = np.linalg.solve(XtX + lam * np.eye(B), XtY)  # (B, 3)
-
-        # 5) 分块生成输出
-        hs_hr_ds = gdal.Open(hs_hr, gdal.GA_ReadOnly)
-        rgb_lp_ds = gdal.Open(rgb_lp, gdal.GA_ReadOnly)
-        if hs_hr_ds is None or rgb_lp_ds is None:
+    # 中间结果都不落盘：
+    # 1) RGB -> HS grid（低分辨率，average）：尺寸与 HS 网格相同，放在 /vsimem 内存文件里，
+    #    各线程可以按路径各自打开
+    rgb_lr_path = f"/vsimem/rasterops_fuse_{uuid.uuid4().hex}/rgb_lr.tif"
+    rgb_lr_ds = None
+    try:
+        with open_dataset(hs_path) as hs_ds, open_dataset(rgb_path) as rgb_ds:
+            hs_grid = grid_info(hs_path)
+            rgb_lr_ds = _run_with_progress(
+                lambda cb: gdal.Warp(rgb_lr_path, rgb_ds, options=_warp_options(hs_grid, "GTiff", "average", cb)),
+                _scaled_progress(progress, 0.0, 0.1),
+            )
+            if rgb_lr_ds is None:
+                raise RuntimeError("Internal warp failed")
+            return _fuse_from_lr(
+                hs_ds, rgb_ds, rgb_lr_ds, hs_path, rgb_path, rgb_lr_path, out_path,
+                alpha=alpha, lam=lam, max_samples=max_samples, out_dtype=out_dtype, workers=workers,
+                progress=_scaled_progress(progress, 0.1, 1.0),
+            )
+    finally:
+        rgb_lr_ds = None
+        gdal.Unlink(rgb_lr_path)
+
+
+def _fuse_from_lr(
+    hs_ds: gdal.Dataset,
+    rgb_ds: gdal.Dataset,
+    rgb_lr_ds: gdal.Dataset,
+    hs_path: str,
+    rgb_path: str,
+    rgb_lr_path: str,
+    out_path: str,
+    alpha: float,
+    lam: float,
+    max_samples: int,
+    out_dtype: str,
+    workers: Optional[int],
+    progress: Optional[ProgressFn],
+) -> str:
+    """fuse_hs_rgb 的拟合 + 分块输出部分（RGB_lr 已在内存里）。"""
+    # 全局归一化区间：整幅 RGB 只扫描一次（Byte/UInt16 直接用满量程）
+    rgb_bounds = _unit_bounds(rgb_ds, [1, 2, 3], _scaled_progress(progress, 0.0, 0.1))
+    progress = _scaled_progress(progress, 0.1, 1.0)
+
+    # 4) 拟合：HS_lr 与 RGB_lr 在同一低分辨率网格上分块流式累加，内存 O(B^2)
+    mu, sigma, Wmat = _fit_ridge_streaming(
+        hs_ds, rgb_lr_ds, rgb_bounds, lam, max_samples, _scaled_progress(progress, 0.0, 0.1)
+    )
+    progress = _scaled_progress(progress, 0.1, 1.0)
+
+    # 5) 分块生成输出
+    rgb_grid = grid_info(rgb_path)
+    out_x, out_y = rgb_grid.xsize, rgb_grid.ysize
+    gt = rgb_grid.geotransform
+    proj = rgb_grid.projection
+
+    out_type = _FUSE_OUT_TYPES.get(out_dtype, (gdal.GDT_Float32,))[0]
+    drv = gdal.GetDriverByName("GTiff")
+    out_ds = drv.Create(out_path, out_x, out_y, 3, out_type, options=_gtiff_creation_options(out_type))
+    if out_ds is None:
+        raise RuntimeError("Cannot create output")
+    out_ds.SetGeoTransform(gt)
+    out_ds.SetProjection(proj)
+
+    w_scaled = (Wmat / sigma[:, None]).T
+
+    def _new_tiler() -> _FuseTiler:
+        # 每个 tiler 自己打开全部输入：GDAL dataset 句柄不能跨线程并发使用
+        rgb_lp_ds = gdal.Warp("", rgb_lr_path, options=_warp_options(rgb_grid, "VRT", "bilinear"))
+        hs_hr_ds = open_aligned(hs_path, rgb_path, resample="bilinear")
+        rgb_tile_ds = gdal.Open(rgb_path, gdal.GA_ReadOnly)
+        if rgb_lp_ds is None or hs_hr_ds is None or rgb_tile_ds is None:
             raise RuntimeError("Internal warp failed")
-
-        out_x, out_y = rgb_ds.RasterXSize, rgb_ds.RasterYSize
-        gt = rgb_ds.GetGeoTransform()
-        proj = rgb_ds.GetProjection()
-
-        drv = gdal.GetDriverByName("GTiff")
-        # 压缩与 block size：实用向
-        creation = ["TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=2", "BIGTIFF=IF_SAFER"]
-        out_ds = drv.Create(out_path, out_x, out_y, 3, gdal.GDT_Byte if out_dtype in ("Byte", "UInt8") else gdal.GDT_UInt16 if out_dtype == "UInt16" else gdal.GDT_Float32, options=creation)
-        if out_ds is None:
-            raise RuntimeError("Cannot create output")
-        out_ds.SetGeoTransform(gt)
-        out_ds.SetProjection(proj)
-
-        # 用 RGB 的 block size（若无则 256）
-        b0 = rgb_ds.GetRasterBand(1)
-        bx, by = b0.GetBlockSize()
-        if bx <= 0 or by <= 0:
-            bx, by = 256, 256
-
-        for y0 in range(0, out_y, by):
-            ysize = min(by, out_y - y0)
-            for x0 in range(0, out_x, bx):
-                xsize = min(bx, out_x - x0)
-
-                # HS_hr block: (B, y, x)
-                hs_block = np.zeros((B, ysize, xsize), dtype=np.float32)
-                for bi in range(B):
-                    hs_block[bi] = hs_hr_ds.GetRasterBand(bi + 1).ReadAsArray(x0, y0, xsize, ysize).astype(np.float32)
-
-                # 标准化并回归
-                Xb = hs_block.reshape(B, -1).T  # (n, B)
-                Xb = (Xb - mu) / sigma
-                pred = (Xb @ Wmat).T.reshape(3, ysize, xsize)  # (3, y, x)
-
-                # 细节注入：RGB - LP(RGB)
-                rgb_block = np.zeros((3, ysize, xsize), dtype=np.float32)
-                for c in range(3):
-                    rgb_block[c] = rgb_ds.GetRasterBand(c + 1).ReadAsArray(x0, y0, xsize, ysize).astype(np.float32)
-
-                lp_block = np.zeros((3, ysize, xsize), dtype=np.float32)
-                for c in range(3):
-                    lp_block[c] = rgb_lp_ds.GetRasterBand(c + 1).ReadAsArray(x0, y0, xsize, ysize).astype(np.float32)
-
-                rgb_u = _scale_rgb_to_unit(rgb_block, rgb_dtype)
-                lp_u = _scale_rgb_to_unit(lp_block, rgb_dtype)
-
-                out_u = pred + float(alpha) * (rgb_u - lp_u)
-                out_u = np.clip(out_u, 0.0, 1.0)
-                out_cast = _cast_from_unit(out_u, out_dtype)
-
-                # 写入
-                for c in range(3):
-                    out_ds.GetRasterBand(c + 1).WriteArray(out_cast[c], xoff=x0, yoff=y0)
-
-        out_ds.FlushCache()
-        out_ds = None
+        return _FuseTiler(hs_hr_ds, rgb_tile_ds, rgb_lp_ds, mu, w_scaled, rgb_bounds, alpha, out_dtype)
+
+    windows = _iter_windows(out_x, out_y, _FUSE_TILE, _FUSE_TILE)
+    n_workers = max(1, int(workers if workers is not None else settings.FUSE_WORKERS))
+    total = math.ceil(out_x / _FUSE_TILE) * math.ceil(out_y / _FUSE_TILE)
+    written = 0
+
+    def _write(x0: int, y0: int, block: np.ndarray) -> None:
+        nonlocal written
+        out_ds.WriteArray(block, xoff=x0, yoff=y0, band_list=[1, 2, 3])
+        written += 1
+        if progress is not None:
+            progress(written / total)
+
+    if n_workers == 1:
+        tiler = _new_tiler()
+        for x0, y0, xs, ys in windows:
+            _write(x0, y0, tiler.compute(x0, y0, xs, ys))
+    else:
+        # 空闲 tiler 池：任务独占一个 tiler 计算，结果拷出后归还
+        tilers: "queue.Queue[_FuseTiler]" = queue.Queue()
+        for _ in range(n_workers):
+            tilers.put(_new_tiler())
+
+        def _compute(win: Tuple[int, int, int, int]) -> np.ndarray:
+            t = tilers.get()
+            try:
+                return t.compute(*win).copy()
+            finally:
+                tilers.put(t)
+
+        # 调用线程是唯一的写线程：按提交顺序取结果写出；在途块数有上限，内存有界
+        max_inflight = max(n_workers, settings.FUSE_MAX_INFLIGHT)
+        inflight: Deque[Tuple[Tuple[int, int, int, int], Future]] = deque()
+        with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="fuse") as pool:
+            try:
+                for win in windows:
+                    inflight.append((win, pool.submit(_compute, win)))
+                    if len(inflight) >= max_inflight:
+                        (x0, y0, _, _), fut = inflight.popleft()
+                        _write(x0, y0, fut.result())
+                while inflight:
+                    (x0, y0, _, _), fut = inflight.popleft()
+                    _write(x0, y0, fut.result())
+            except BaseException:
+                for _, fut in inflight:
+                    fut.cancel()
+                raise
+
+    out_ds.FlushCache()
+    out_ds = None
 
     return out_path
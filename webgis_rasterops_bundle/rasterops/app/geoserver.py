@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import os
 import re
-from typing import Tuple
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from config import settings
 
@@ -17,68 +20,170 @@ def sanitize_name(name: str) -> str:
     return base or "layer"
 
 
+def map_path(local_path: str) -> str:
+    """rasterops 内的文件路径 -> GeoServer 看到的路径（按 GEOSERVER_PATH_MAP，最长前缀优先）。"""
+    p = os.path.abspath(local_path)
+    for src in sorted(settings.GEOSERVER_PATH_MAP, key=len, reverse=True):
+        prefix = os.path.abspath(src)
+        if p == prefix or p.startswith(prefix.rstrip(os.sep) + os.sep):
+            return settings.GEOSERVER_PATH_MAP[src].rstrip("/") + p[len(prefix.rstrip(os.sep)):]
+    return p
+
+
 class GeoServerClient:
+    """GeoServer REST 客户端。
+
+    - 共享 requests.Session（连接池 + keep-alive），批量发布时不再每次重新建连接
+    - 已确认存在的 workspace 在 TTL 内缓存，publish 不再每次先 GET workspace；发布失败时丢弃该缓存
+    - 502/503/504 与连接错误按指数退避有限次重试（上传的文件每次重试重新打开）；
+      500 通常是 GeoServer 处理请求本身出错，重发同样的（可能很大的）文件没有意义，不重试
+    """
+
+    # 触发重试的 HTTP 状态码（网关/服务暂不可用）
+    _RETRY_STATUS = (502, 503, 504)
+
     def __init__(self):
         self.base = settings.GEOSERVER_URL.rstrip("/")
         self.auth = (settings.GEOSERVER_USER, settings.GEOSERVER_PASSWORD)
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GEOSERVER_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # REST 路径 -> 过期时间（monotonic）
+        self._known: Dict[str, float] = {}
+        self._known_lock = threading.Lock()
 
     def _url(self, path: str) -> str:
         return f"{self.base}/rest{path}"
 
+    # -------- 已知资源缓存 --------
+    def _is_known(self, path: str) -> bool:
+        with self._known_lock:
+            exp = self._known.get(path)
+            if exp is None:
+                return False
+            if exp < time.monotonic():
+                del self._known[path]
+                return False
+            return True
+
+    def _mark_known(self, path: str) -> None:
+        with self._known_lock:
+            self._known[path] = time.monotonic() + settings.GEOSERVER_CACHE_TTL_S
+
+    def _forget(self, path: str) -> None:
+        with self._known_lock:
+            self._known.pop(path, None)
+
+    # -------- HTTP --------
+    def _request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        json: Any = None,
+        data: Optional[str] = None,
+        data_path: Optional[str] = None,
+    ) -> requests.Response:
+        """发一个 REST 请求；502/503/504 / 连接错误按指数退避重试，最终返回最后一次的响应或抛出连接错误。"""
+        attempts = max(1, settings.GEOSERVER_RETRIES + 1)
+        for i in range(attempts):
+            last = i == attempts - 1
+            try:
+                if data_path is not None:
+                    with open(data_path, "rb") as f:
+                        r = self.session.request(
+                            method, self._url(path), params=params, headers=headers, data=f,
+                            timeout=settings.GEOSERVER_TIMEOUT_S,
+                        )
+                else:
+                    r = self.session.request(
+                        method, self._url(path), params=params, headers=headers, json=json, data=data,
+                        timeout=settings.GEOSERVER_TIMEOUT_S,
+                    )
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if r.status_code not in self._RETRY_STATUS or last:
+                    return r
+            time.sleep(settings.GEOSERVER_RETRY_BACKOFF_S * (2 ** i))
+        raise AssertionError("unreachable")
+
+    @staticmethod
+    def _check(r: requests.Response, ok: Iterable[int], what: str) -> None:
+        if r.status_code not in ok:
+            raise RuntimeError(f"GeoServer {what} failed: {r.status_code} {r.text}")
+
     def ensure_workspace(self, ws: str) -> None:
         ws = ws.strip()
-        r = requests.get(self._url(f"/workspaces/{ws}.json"), auth=self.auth)
-        if r.status_code == 200:
+        path = f"/workspaces/{ws}"
+        if self._is_known(path):
             return
-        if r.status_code != 404:
-            raise RuntimeError(f"GeoServer workspace check failed: {r.status_code} {r.text}")
-
-        payload = {"workspace": {"name": ws}}
-        r2 = requests.post(
-            self._url("/workspaces"),
-            auth=self.auth,
-            headers={"Content-Type": "application/json"},
-            json=payload,
-        )
-        if r2.status_code not in (201, 200):
-            raise RuntimeError(f"GeoServer workspace create failed: {r2.status_code} {r2.text}")
+        r = self._request("GET", f"{path}.json")
+        if r.status_code != 200:
+            if r.status_code != 404:
+                raise RuntimeError(f"GeoServer workspace check failed: {r.status_code} {r.text}")
+            payload = {"workspace": {"name": ws}}
+            r2 = self._request(
+                "POST",
+                "/workspaces",
+                headers={"Content-Type": "application/json"},
+                json=payload,
+            )
+            self._check(r2, (201, 200), "workspace create")
+        self._mark_known(path)
+
+    def _publish(self, ws: str, what: str, path: str, **kwargs: Any) -> None:
+        """确保 workspace 存在后 PUT 发布请求；失败时丢弃 workspace 缓存（可能已被外部删除，下次重新确认）。"""
+        self.ensure_workspace(ws)
+        try:
+            r = self._request("PUT", path, params={"configure": "all"}, **kwargs)
+            self._check(r, (201, 200), what)
+        except Exception:
+            self._forget(f"/workspaces/{ws}")
+            raise
 
     def publish_geotiff(self, ws: str, store: str, geotiff_path: str) -> Tuple[str, str]:
         """上传 GeoTIFF 并自动配置 coverage + layer。
 
         返回 (store, layer_name)
         """
-        self.ensure_workspace(ws)
-        url = self._url(f"/workspaces/{ws}/coveragestores/{store}/file.geotiff")
         # configure=all 参考 GeoServer REST 文档
-        params = {"configure": "all"}
-        with open(geotiff_path, "rb") as f:
-            r = requests.put(
-                url,
-                params=params,
-                auth=self.auth,
-                headers={"Content-Type": "image/tiff"},
-                data=f,
-            )
-        if r.status_code not in (201, 200):
-            raise RuntimeError(f"GeoServer publish GeoTIFF failed: {r.status_code} {r.text}")
+        self._publish(
+            ws,
+            "publish GeoTIFF",
+            f"/workspaces/{ws}/coveragestores/{store}/file.geotiff",
+            headers={"Content-Type": "image/tiff"},
+            data_path=geotiff_path,
+        )
         # 对单一 GeoTIFF，layer 通常与 store 同名
         return store, store
 
+    def publish_geotiff_external(self, ws: str, store: str, geotiff_path: str) -> Tuple[str, str]:
+        """以外部文件方式发布 GeoTIFF：只把（映射后的）文件路径登记为 coverage store，不传输文件内容。
+
+        要求 GeoServer 能按该路径读到文件（共享数据卷）。返回 (store, layer_name)
+        """
+        self._publish(
+            ws,
+            "publish external GeoTIFF",
+            f"/workspaces/{ws}/coveragestores/{store}/external.geotiff",
+            headers={"Content-Type": "text/plain"},
+            data=f"file://{map_path(geotiff_path)}",
+        )
+        return store, store
+
     def publish_shp_zip(self, ws: str, store: str, zip_path: str) -> Tuple[str, str]:
-        self.ensure_workspace(ws)
-        url = self._url(f"/workspaces/{ws}/datastores/{store}/file.shp")
-        params = {"configure": "all"}
-        with open(zip_path, "rb") as f:
-            r = requests.put(
-                url,
-                params=params,
-                auth=self.auth,
-                headers={"Content-Type": "application/zip"},
-                data=f,
-            )
-        if r.status_code not in (201, 200):
-            raise RuntimeError(f"GeoServer publish Shapefile zip failed: {r.status_code} {r.text}")
+        self._publish(
+            ws,
+            "publish Shapefile zip",
+            f"/workspaces/{ws}/datastores/{store}/file.shp",
+            headers={"Content-Type": "application/zip"},
+            data_path=zip_path,
+        )
         return store, store
 
     # -------- Delete / Unpublish --------
@@ -91,15 +196,11 @@ class GeoServerClient:
             "recurse": "true" if recurse else "false",
             "purge": purge,
         }
-        r = requests.delete(self._url(f"/workspaces/{ws}/coveragestores/{store}"), params=params, auth=self.auth)
-        if r.status_code in (200, 202, 204, 404):
-            return
-        raise RuntimeError(f"GeoServer delete coveragestore failed: {r.status_code} {r.text}")
+        r = self._request("DELETE", f"/workspaces/{ws}/coveragestores/{store}", params=params)
+        self._check(r, (200, 202, 204, 404), "delete coveragestore")
 
     def delete_datastore(self, ws: str, store: str, recurse: bool = True) -> None:
         """删除 datastore，并可递归删除其 layer/resource。"""
         params = {"recurse": "true" if recurse else "false"}
-        r = requests.delete(self._url(f"/workspaces/{ws}/datastores/{store}"), params=params, auth=self.auth)
-        if r.status_code in (200, 202, 204, 404):
-            return
-        raise RuntimeError(f"GeoServer delete datastore failed: {r.status_code} {r.text}")
+        r = self._request("DELETE", f"/workspaces/{ws}/datastores/{store}", params=params)
+        self._check(r, (200, 202, 204, 404), "delete datastore")
@@ -1,45 +1,533 @@
 from __future__ import annotations
 
+import asyncio
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
-from typing import Callable, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
+from config import settings
 from db import DB, utc_now_iso
 
+# 终态：到达后不再变化
+TERMINAL_STATUSES = ("done", "error", "cancelled")
+
+
+class JobCancelled(RuntimeError):
+    """任务被用户取消；由 JobContext.check() 在检查点抛出。"""
+
+
+class JobTimedOut(JobCancelled):
+    """任务运行超过该 kind 的时限。"""
+
+
+class JobInterrupted(RuntimeError):
+    """任务所在的 worker 进程非因本任务被终止而退出（如被系统 OOM 杀掉）；任务会重新排队。"""
+
 
 @dataclass
 class JobResult:
     output_asset_id: Optional[str] = None
     message: str = ""
+    # 结构化结果（如批量操作的逐项状态），存入 jobs.result_json
+    result: Optional[Dict] = None
+
+
+class JobEvents:
+    """进程内 job 变更通知：每个 job 一个版本号，变化时唤醒等待者（SSE/长轮询）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}
+        self._waiters: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+
+    def version(self, job_id: str) -> int:
+        with self._lock:
+            return self._versions.get(job_id, 0)
+
+    def notify(self, job_id: str, final: bool = False) -> None:
+        with self._lock:
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            waiters = self._waiters.pop(job_id, [])
+            if final:
+                # 终态之后不会再有变化，不再保留版本号
+                self._versions.pop(job_id, None)
+        for loop, ev in waiters:
+            loop.call_soon_threadsafe(ev.set)
+
+    async def wait(self, job_id: str, since: int, timeout: float) -> int:
+        """等到版本号不同于 since（或超时），返回当前版本号。"""
+        loop = asyncio.get_running_loop()
+        ev = asyncio.Event()
+        waiter = (loop, ev)
+        with self._lock:
+            if self._versions.get(job_id, 0) != since:
+                return self._versions.get(job_id, 0)
+            self._waiters.setdefault(job_id, []).append(waiter)
+        try:
+            await asyncio.wait_for(ev.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                lst = self._waiters.get(job_id)
+                if lst and waiter in lst:
+                    lst.remove(waiter)
+                    if not lst:
+                        self._waiters.pop(job_id, None)
+        return self.version(job_id)
+
+
+class JobContext:
+    """传给任务函数的上下文：job 信息、DB、汇报进度（节流写库 + 通知订阅者）。
+
+    progress() 同时是取消/超时检查点：任务被取消或超时时抛出 JobCancelled / JobTimedOut。
+    """
+
+    # 进度写库的节流：变化至少 1% 或间隔至少 1 秒
+    _MIN_STEP = 0.01
+    _MIN_INTERVAL = 1.0
+    # 查询取消标记的最小间隔（秒）
+    _CANCEL_CHECK_INTERVAL = 0.5
+
+    def __init__(self, db: DB, job_id: str, notify: Callable[[str], None], timeout: float = 0):
+        self.db = db
+        self.job_id = job_id
+        self._notify = notify
+        self._timeout = timeout
+        self._deadline = time.monotonic() + timeout if timeout > 0 else None
+        self._last_frac = 0.0
+        self._last_ts = 0.0
+        self._last_cancel_check = 0.0
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        """检查点：已超时或已请求取消时抛出异常，让任务尽快退出。"""
+        now = time.monotonic()
+        if self._deadline is not None and now > self._deadline:
+            raise JobTimedOut(f"job timed out after {self._timeout:g}s")
+        if now - self._last_cancel_check < self._CANCEL_CHECK_INTERVAL:
+            return
+        self._last_cancel_check = now
+        if self.db.is_job_cancel_requested(self.job_id):
+            raise JobCancelled("cancelled by user")
+
+    def progress(self, frac: float) -> None:
+        self.check()
+        frac = min(max(float(frac), 0.0), 1.0)
+        now = time.monotonic()
+        with self._lock:
+            if frac < 1.0 and frac - self._last_frac < self._MIN_STEP and now - self._last_ts < self._MIN_INTERVAL:
+                return
+            self._last_frac = frac
+            self._last_ts = now
+        self.db.update_job(self.job_id, progress=frac, updated_at=utc_now_iso())
+        self._notify(self.job_id)
+
+
+Handler = Callable[[Dict, JobContext], JobResult]
+# 内存估算：(params, db) -> MB
+MemoryEstimator = Callable[[Dict, DB], int]
+# 结果缓存键：(params, db) -> key；返回 None 表示不缓存
+CacheKeyFn = Callable[[Dict, DB], Optional[str]]
+# 任务结束（done/error/cancelled）后在调度所在进程（API 进程）里执行的回调：(job) -> None
+FinishHook = Callable[[Dict], None]
+# 清理任务半成品输出：(job_id) -> None
+DiscardFn = Callable[[str], None]
+
+
+class ThreadBackend:
+    """执行后端：任务在 API 进程内的线程池里运行。"""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.manager: Optional["JobManager"] = None
+
+    def start(self, manager: "JobManager") -> None:
+        self.manager = manager
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+
+    def submit(self, job: Dict) -> Future:
+        return self.pool.submit(self._call, job)
+
+    def _call(self, job: Dict) -> JobResult:
+        m = self.manager
+        ctx = JobContext(m.db, job["id"], m.events.notify, timeout=m.timeouts.get(job["kind"], 0))
+        return m.handlers[job["kind"]](job["params"], ctx)
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ---- 进程后端：worker 进程内的全局状态（由 initializer 设置） ----
+_WORKER: Dict[str, object] = {}
+
+
+def _process_worker_init(handlers_module: str, handlers_attr: str, db_path: str, notify_queue) -> None:
+    _WORKER["handlers"] = getattr(importlib.import_module(handlers_module), handlers_attr)
+    _WORKER["db"] = DB(db_path)
+    _WORKER["queue"] = notify_queue
+
+
+def _process_worker_run(kind: str, job_id: str, params: Dict, timeout: float) -> JobResult:
+    q = _WORKER["queue"]
+    # 告诉父进程本任务在哪个 worker 进程里，超时/取消后不退出时由父进程强制终止
+    q.put(("start", job_id, os.getpid()))
+    ctx = JobContext(_WORKER["db"], job_id, q.put, timeout=timeout)
+    return _WORKER["handlers"][kind](params, ctx)
+
+
+# 强制终止 worker 用的信号（Windows 没有 SIGKILL）
+_KILL_SIGNAL = getattr(signal, "SIGKILL", signal.SIGTERM)
+
+
+class ProcessBackend:
+    """执行后端：每个任务在自己独占的 worker 进程（spawn，单 worker 进程池）里运行。
+
+    重计算不再与 API 请求争 GIL，worker 内的 MemoryError/崩溃也不会拖垮 API 进程。
+    handlers 通过模块路径在 worker 内重新导入；进度由 worker 直接写库，
+    并经该任务自己的队列通知父进程唤醒 SSE 订阅者。并发数由 JobManager 控制。
+
+    超时/取消的硬停止：任务超过时限 kill_grace_s 秒后（或取消请求发出 kill_grace_s 秒后）仍未在检查点退出
+    （如卡在没有进度回调的 GDAL 调用或网络上传里），直接杀掉它的 worker 进程；
+    进程和通知队列都是该任务独占的，其它运行中的任务不受影响。
+    """
+
+    # 看门狗检查间隔（秒）
+    _WATCHDOG_INTERVAL = 1.0
+
+    def __init__(self, handlers_module: str, handlers_attr: str = "HANDLERS", kill_grace_s: float = 30):
+        self.handlers_module = handlers_module
+        self.handlers_attr = handlers_attr
+        self.kill_grace_s = kill_grace_s
+        self.manager: Optional["JobManager"] = None
+        self._mp = multiprocessing.get_context("spawn")
+        # 运行中的任务：job_id -> {started, timeout, pid, cancel_seen, pool}；被强制终止的任务 -> 结束原因
+        self._active: Dict[str, Dict] = {}
+        self._killed: Dict[str, JobCancelled] = {}
+        self._state_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self, manager: "JobManager") -> None:
+        self.manager = manager
+        threading.Thread(target=self._watchdog, name="job-watchdog", daemon=True).start()
+
+    def submit(self, job: Dict) -> Future:
+        job_id = job["id"]
+        timeout = self.manager.timeouts.get(job["kind"], 0)
+        q = self._mp.Queue()
+        pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self._mp,
+            initializer=_process_worker_init,
+            initargs=(self.handlers_module, self.handlers_attr, self.manager.db.db_path, q),
+        )
+        st = {"started": time.monotonic(), "timeout": timeout, "pid": None, "cancel_seen": None, "pool": pool}
+        with self._state_lock:
+            self._active[job_id] = st
+        try:
+            inner = pool.submit(_process_worker_run, job["kind"], job_id, job["params"], timeout)
+        except BaseException:
+            with self._state_lock:
+                self._active.pop(job_id, None)
+            pool.shutdown(wait=False, cancel_futures=True)
+            q.close()
+            raise
+        threading.Thread(
+            target=self._relay_notifications, args=(job_id, q), name="job-notify-relay", daemon=True
+        ).start()
+        outer: Future = Future()
+        inner.add_done_callback(lambda f: self._settle(job_id, f, outer))
+        return outer
+
+    def _relay_notifications(self, job_id: str, q) -> None:
+        """转发一个任务的通知，任务结束后退出并关闭其队列。"""
+        try:
+            while True:
+                try:
+                    msg = q.get(timeout=self._WATCHDOG_INTERVAL)
+                except queue.Empty:
+                    with self._state_lock:
+                        if job_id not in self._active:
+                            return
+                    continue
+                except Exception:  # noqa  被杀的 worker 可能留下残缺消息，队列不再可用
+                    return
+                if isinstance(msg, tuple):
+                    _, _, pid = msg
+                    with self._state_lock:
+                        if job_id in self._active:
+                            self._active[job_id]["pid"] = pid
+                    continue
+                self.manager.events.notify(msg)
+        finally:
+            q.close()
+
+    def _settle(self, job_id: str, inner: Future, outer: Future) -> None:
+        """把 worker future 的结果转交给 JobManager：被强制终止的任务换成超时/取消。"""
+        with self._state_lock:
+            st = self._active.pop(job_id, None)
+            killed = self._killed.pop(job_id, None)
+        if st is not None:
+            st["pool"].shutdown(wait=False)
+        if inner.cancelled():
+            outer.cancel()
+            return
+        exc = inner.exception()
+        if exc is None:
+            outer.set_result(inner.result())
+        elif killed is not None:
+            outer.set_exception(killed)
+        elif isinstance(exc, BrokenProcessPool):
+            outer.set_exception(JobInterrupted("worker process exited unexpectedly"))
+        else:
+            outer.set_exception(exc)
+
+    def _watchdog(self) -> None:
+        while not self._stopped.wait(self._WATCHDOG_INTERVAL):
+            now = time.monotonic()
+            with self._state_lock:
+                active = list(self._active.items())
+            for job_id, st in active:
+                reason: Optional[JobCancelled] = None
+                if st["timeout"] > 0 and now - st["started"] > st["timeout"] + self.kill_grace_s:
+                    reason = JobTimedOut(f"job timed out after {st['timeout']:g}s (worker killed)")
+                elif self.manager.db.is_job_cancel_requested(job_id):
+                    if st["cancel_seen"] is None:
+                        st["cancel_seen"] = now
+                    elif now - st["cancel_seen"] > self.kill_grace_s:
+                        reason = JobCancelled("cancelled by user (worker killed)")
+                if reason is not None and st["pid"] is not None:
+                    self._kill(job_id, st["pid"], reason)
+
+    def _kill(self, job_id: str, pid: int, reason: JobCancelled) -> None:
+        """杀掉 job 独占的 worker 进程；其 future 随之以 BrokenProcessPool 结束，由 _settle 换成 reason。"""
+        with self._state_lock:
+            if job_id not in self._active or job_id in self._killed:
+                return
+            self._killed[job_id] = reason
+        try:
+            os.kill(pid, _KILL_SIGNAL)
+        except ProcessLookupError:
+            pass
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        with self._state_lock:
+            pools = [st["pool"] for st in self._active.values()]
+        for pool in pools:
+            pool.shutdown(wait=False, cancel_futures=True)
 
 
 class JobManager:
-    """极简线程池任务管理：创建 job -> 后台执行 -> 更新 DB 状态"""
+    """持久化任务队列：job 以 kind + params 存在 jobs 表里，调度线程按优先级/FIFO 取出执行。
+
+    进程重启后，上次遗留的 running 任务会被重新排队（超过重试次数则置为 error）。
+    调度时遵守：总并发 max_workers、按 kind 的并发上限 kind_limits、
+    以及按估算内存占用的准入（总和不超过 memory_budget_mb；单个超预算的任务只在空闲时运行）。
+    取消与超时（timeouts，按 kind 的秒数）首先是协作式的：任务在 JobContext 检查点上自行退出；
+    进程后端在宽限期后还会强制终止不退出的 worker，线程后端则只能等到下一个检查点。
+    提供 cache_keys 的 kind 会做结果缓存：相同输入内容 + 参数的任务入队即完成，指向已有输出资产。
+    on_finish 里的回调在任务结束后于本进程执行，用于清理 worker 进程够不着的进程内状态（如瓦片内存缓存）。
+    任务没有产出输出就结束（失败、取消、超时、worker 被杀、中断后重新排队、重启时遗留）时，
+    由本进程调用 discard_outputs(job_id) 清理半成品：被强制终止的任务自己来不及清理。
+    """
 
-    def __init__(self, db: DB, max_workers: int = 16):
+    # 没有新任务通知时，调度线程兜底轮询 DB 的间隔（秒）
+    _POLL_INTERVAL = 2.0
+
+    def __init__(
+        self,
+        db: DB,
+        handlers: Dict[str, Handler],
+        max_workers: int = 2,
+        backend=None,
+        kind_limits: Optional[Dict[str, int]] = None,
+        memory_budget_mb: int = 0,
+        estimators: Optional[Dict[str, MemoryEstimator]] = None,
+        timeouts: Optional[Dict[str, int]] = None,
+        cache_keys: Optional[Dict[str, CacheKeyFn]] = None,
+        on_finish: Optional[Dict[str, FinishHook]] = None,
+        discard_outputs: Optional[DiscardFn] = None,
+    ):
         self.db = db
-        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.handlers = handlers
+        self.max_workers = max_workers
+        self.backend = backend or ThreadBackend(max_workers)
+        self.kind_limits = kind_limits or {}
+        self.memory_budget_mb = memory_budget_mb
+        self.estimators = estimators or {}
+        self.timeouts = timeouts or {}
+        self.cache_keys = cache_keys or {}
+        self.on_finish = on_finish or {}
+        self.discard_outputs = discard_outputs
+        self.events = JobEvents()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._running_by_kind: Dict[str, int] = {}
+        self._mem_in_use = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """恢复遗留任务、启动执行后端与调度线程。"""
+        if self._dispatcher is not None:
+            return
+        for job_id in self.db.recover_orphaned_jobs(max_attempts=settings.JOB_MAX_ATTEMPTS):
+            self._discard(job_id)
+        self.backend.start(self)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="job-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        with self._cond:
+            self._cond.notify_all()
+        self.backend.shutdown()
+
+    def enqueue(self, kind: str, params: Dict, priority: Optional[int] = None) -> Dict:
+        """新建 queued 任务并唤醒调度线程；priority 越大越先执行，同优先级 FIFO。"""
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind: {kind}")
+        if priority is None:
+            priority = settings.JOB_PRIORITIES.get(kind, 0)
+        key_fn = self.cache_keys.get(kind)
+        cache_key = key_fn(params, self.db) if key_fn else None
+        cached_output = self.db.get_cached_output(cache_key) if cache_key else None
+        estimator = self.estimators.get(kind)
+        now = utc_now_iso()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "params": params,
+            "output_asset_id": None,
+            "message": None,
+            "priority": int(priority),
+            "mem_mb": 0,
+            "cache_key": cache_key,
+        }
+        if cached_output is not None:
+            # 命中缓存：直接以已有输出完成，不进队列
+            job.update(status="done", output_asset_id=cached_output, message="ok (cached)", progress=1.0)
+            self.db.insert_job(job)
+            return self.db.get_job(job["id"])
+        if estimator:
+            job["mem_mb"] = int(estimator(params, self.db))
+        self.db.insert_job(job)
+        self._wake.set()
+        return self.db.get_job(job["id"])
 
-    def submit(self, job_id: str, fn: Callable[[], JobResult]) -> None:
-        def _run() -> None:
-            self.db.update_job(job_id, status="running", updated_at=utc_now_iso(), message=None)
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        """取消任务：排队中的立即取消，运行中的在下一个检查点退出；已结束的原样返回。"""
+        job = self.db.request_job_cancel(job_id)
+        if job is not None:
+            self.events.notify(job_id, final=job["status"] in TERMINAL_STATUSES)
+        return job
+
+    def _dispatch_loop(self) -> None:
+        while not self._stop.is_set():
+            with self._cond:
+                while self._running >= self.max_workers and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                busy_kinds = [k for k, n in self.kind_limits.items() if self._running_by_kind.get(k, 0) >= n]
+                max_mem = None
+                if self.memory_budget_mb > 0 and self._running > 0:
+                    max_mem = max(0, self.memory_budget_mb - self._mem_in_use)
+
+            # 先清唤醒标志再取任务：取任务之后的 enqueue / 完成通知不会丢
+            self._wake.clear()
+            job = self.db.claim_next_job(exclude_kinds=busy_kinds, max_mem_mb=max_mem)
+            if job is None:
+                self._wake.wait(self._POLL_INTERVAL)
+                continue
+
+            with self._cond:
+                self._running += 1
+                self._running_by_kind[job["kind"]] = self._running_by_kind.get(job["kind"], 0) + 1
+                self._mem_in_use += job["mem_mb"]
+            self.events.notify(job["id"])
             try:
-                res = fn()
-                self.db.update_job(
-                    job_id,
-                    status="done",
-                    updated_at=utc_now_iso(),
-                    output_asset_id=res.output_asset_id,
-                    message=res.message,
-                )
+                fut = self.backend.submit(job)
             except Exception as e:  # noqa
-                tb = traceback.format_exc(limit=20)
-                self.db.update_job(
-                    job_id,
-                    status="error",
-                    updated_at=utc_now_iso(),
-                    message=f"{e}\n{tb}",
-                )
-
-        self.pool.submit(_run)
+                self._finish_error(job, e)
+                continue
+            fut.add_done_callback(lambda f, job=job: self._finish(job, f))
+
+    def _finish(self, job: Dict, fut: Future) -> None:
+        job_id = job["id"]
+        try:
+            res = fut.result()
+            self.db.update_job(
+                job_id,
+                status="done",
+                updated_at=utc_now_iso(),
+                output_asset_id=res.output_asset_id,
+                message=res.message,
+                progress=1.0,
+                result=res.result,
+            )
+            if job.get("cache_key") and res.output_asset_id:
+                self.db.put_cached_output(job["cache_key"], job["kind"], res.output_asset_id)
+            self._release(job)
+        except BaseException as e:  # noqa
+            self._finish_error(job, e)
+
+    def _discard(self, job_id: str) -> None:
+        if self.discard_outputs is None:
+            return
+        try:
+            self.discard_outputs(job_id)
+        except Exception:  # noqa  清理失败不影响任务状态
+            traceback.print_exc()
+
+    def _finish_error(self, job: Dict, e: BaseException) -> None:
+        # 先清理半成品再改状态：重新排队的任务一旦可被调度，新一轮执行会重建输出目录
+        self._discard(job["id"])
+        if isinstance(e, JobInterrupted):
+            # 不是本任务的问题：重新排队（已请求取消 / 已达重试次数的除外）
+            after = self.db.requeue_interrupted_job(job["id"], settings.JOB_MAX_ATTEMPTS, str(e))
+            self._release(job, final=after is None or after["status"] in TERMINAL_STATUSES)
+            return
+        if isinstance(e, JobCancelled):
+            # 超时算失败，用户取消单独记为 cancelled；两者都不需要堆栈
+            status = "error" if isinstance(e, JobTimedOut) else "cancelled"
+            message = str(e)
+        else:
+            status = "error"
+            tb = "".join(traceback.format_exception(type(e), e, e.__traceback__, limit=20))
+            message = f"{e}\n{tb}"
+        self.db.update_job(job["id"], status=status, updated_at=utc_now_iso(), message=message)
+        self._release(job)
+
+    def _release(self, job: Dict, final: bool = True) -> None:
+        with self._cond:
+            self._running -= 1
+            self._running_by_kind[job["kind"]] -= 1
+            self._mem_in_use -= job["mem_mb"]
+            self._cond.notify_all()
+        hook = self.on_finish.get(job["kind"]) if final else None
+        if hook is not None:
+            try:
+                hook(self.db.get_job(job["id"]) or job)
+            except Exception:  # noqa  回调失败不影响任务状态
+                traceback.print_exc()
+        self._wake.set()
+        self.events.notify(job["id"], final=final)
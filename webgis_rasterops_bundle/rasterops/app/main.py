@@ -1,32 +1,94 @@
 from __future__ import annotations
 
-import os
-import shutil
+import hashlib
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Literal, Optional
+from urllib.parse import quote
 
-from fastapi import BackgroundTasks, FastAPI, File, HTTPException, UploadFile, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
-from config import settings
+from blobstore import BlobStore, BlobTooLarge
+from config import data_path, settings
 from db import DB, utc_now_iso
-from gdalops import fuse_hs_rgb, gdal_info, run_gdal_calc, warp_to_match
-from geoserver import GeoServerClient, sanitize_name
-from jobs import JobManager, JobResult
+from gdalops import compile_calc_expr, gdal_info
+from geoserver import GeoServerClient
+from jobs import TERMINAL_STATUSES, JobManager, ProcessBackend, ThreadBackend
+from sample import Sampler, parse_sample_request
+from subset import build_subset, parse_subset_request, release_vsimem, stream_vsimem, subset_filename, vsimem_size
+from tasks import (
+    CACHE_KEYS,
+    ESTIMATORS,
+    HANDLERS,
+    cached_stats,
+    compute_asset_stats,
+    content_id,
+    discard_job_outputs,
+    raster_source_path,
+    remove_asset_files,
+    unpublish_asset_from_geoserver,
+)
+from tiles import TileCache, TileRenderer, parse_tile_request, source_id, tilejson
+from upload import UploadedFile, receive_upload
 
 
-def _data_path(*parts: str) -> str:
-    return os.path.join(settings.DATA_DIR, *parts)
+db = DB(data_path("rasterops.sqlite"))
+blob_store = BlobStore(db, data_path("blobs"))
 
 
-db = DB(_data_path("rasterops.sqlite"))
-job_mgr = JobManager(db=db, max_workers=2)
+def _after_bulk_job(job: Dict) -> None:
+    """批量删除在 worker 进程里执行，够不着本进程的瓦片内存缓存：任务结束后清理已删除资产的瓦片缓存。"""
+    params = job.get("params") or {}
+    if params.get("action") != "delete":
+        return
+    for aid in params.get("asset_ids") or []:
+        if db.get_asset(aid) is None:
+            tile_cache.invalidate(aid)
+
+
+job_mgr = JobManager(
+    db=db,
+    handlers=HANDLERS,
+    max_workers=settings.JOB_WORKERS,
+    backend=(
+        ProcessBackend(handlers_module="tasks", kill_grace_s=settings.JOB_KILL_GRACE_S)
+        if settings.JOB_BACKEND == "process"
+        else ThreadBackend(settings.JOB_WORKERS)
+    ),
+    kind_limits=settings.JOB_KIND_LIMITS,
+    memory_budget_mb=settings.JOB_MEMORY_BUDGET_MB,
+    estimators=ESTIMATORS,
+    timeouts=settings.JOB_TIMEOUTS,
+    cache_keys=CACHE_KEYS,
+    on_finish={"bulk": _after_bulk_job},
+    discard_outputs=discard_job_outputs,
+)
 geoserver = GeoServerClient()
+tile_cache = TileCache(
+    data_path("tilecache"),
+    settings.TILE_CACHE_MB << 20,
+    disk=settings.TILE_DISK_CACHE,
+    max_disk_bytes=settings.TILE_DISK_CACHE_MB << 20,
+)
+tile_renderer = TileRenderer(max_sources=settings.TILE_SOURCE_CACHE_SIZE)
+sampler = Sampler()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动时恢复上次遗留的任务并开始调度
+    job_mgr.start()
+    yield
+    job_mgr.stop()
 
-app = FastAPI(title="rasterops", version="0.1.0")
+
+app = FastAPI(title="rasterops", version="0.1.0", lifespan=lifespan)
 
 # CORS
 origins = ["*"] if settings.CORS_ALLOW_ORIGINS == "*" else [o.strip() for o in settings.CORS_ALLOW_ORIGINS.split(",")]
@@ -36,6 +98,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -44,18 +107,12 @@ class AssetOut(BaseModel):
     filename: str
     kind: str
     created_at: str
-    meta: Dict
+    meta: Optional[Dict] = None
     geoserver_layer: Optional[str] = None
     geoserver_store: Optional[str] = None
     published_at: Optional[str] = None
 
 
-class PublishOut(BaseModel):
-    workspace: str
-    store: str
-    layer: str
-
-
 class JobOut(BaseModel):
     id: str
     kind: str
@@ -64,6 +121,27 @@ class JobOut(BaseModel):
     updated_at: str
     output_asset_id: Optional[str] = None
     message: Optional[str] = None
+    progress: Optional[float] = None
+    priority: Optional[int] = None
+    cancel_requested: bool = False
+    # 结构化结果（批量操作的逐项状态等）
+    result: Optional[Dict] = None
+
+
+class SampleIn(BaseModel):
+    points: Optional[List[List[float]]] = Field(None, description="点坐标 [[x, y], ...]")
+    line: Optional[List[List[float]]] = Field(None, description="折线顶点 [[x, y], ...]，按 step 加密采样")
+    crs: str = Field("EPSG:4326", description="坐标的坐标系")
+    bands: Optional[List[int]] = Field(None, description="波段列表（1-based），缺省为全部")
+    step: Optional[float] = Field(None, description="折线采样间距（资产坐标系单位），缺省为像元大小")
+
+
+class BulkAssetsIn(BaseModel):
+    action: Literal["publish", "unpublish", "delete"]
+    asset_ids: List[str] = Field(..., description="资产 id 列表")
+    purge: str = Field("all", description="unpublish/delete 时 raster coveragestore 的 purge=all/none")
+    unpublish: bool = Field(True, description="delete 时是否同时从 GeoServer 取消发布")
+    delete_files: bool = Field(True, description="delete 时是否删除 rasterops 本地文件")
 
 
 class RasterCalcIn(BaseModel):
@@ -80,7 +158,7 @@ class RasterFuseIn(BaseModel):
     rgb: str
     alpha: float = 1.0
     lambda_: float = Field(0.001, alias="lambda")
-    max_samples: int = 200_000
+    max_samples: int = Field(200_000, description="拟合抽样像元数上限；<=0 表示用全部有效像元")
     out_name: str = "fusion_output"
     out_dtype: str = "Byte"  # Byte 或 UInt16
 
@@ -91,7 +169,7 @@ def _asset_to_out(asset: dict) -> AssetOut:
         filename=asset["filename"],
         kind=asset["kind"],
         created_at=asset["created_at"],
-        meta=asset.get("meta", {}),
+        meta=asset.get("meta"),
         geoserver_layer=asset.get("geoserver_layer"),
         geoserver_store=asset.get("geoserver_store"),
         published_at=asset.get("published_at"),
@@ -103,46 +181,107 @@ def health():
     return {"ok": True}
 
 
-@app.post("/api/assets/upload", response_model=AssetOut)
-def upload_asset(file: UploadFile = File(...)):
-    filename = file.filename or "upload"
-    ext = Path(filename).suffix.lower()
-    kind = "raster" if ext in (".tif", ".tiff") else "vector" if ext in (".zip",) else "unknown"
-    if kind == "unknown":
-        raise HTTPException(status_code=400, detail="仅支持 .tif/.tiff 或 Shapefile .zip")
+_UPLOAD_KINDS = {".tif": "raster", ".tiff": "raster", ".zip": "vector"}
+
+
+@app.post(
+    "/api/assets/upload",
+    response_model=AssetOut,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["file"],
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                    }
+                }
+            },
+        }
+    },
+)
+async def upload_asset(request: Request):
+    # 请求体直接流式写入 blob 临时目录（边收边算 sha256、边检查大小上限）
+    try:
+        upload = await receive_upload(request, blob_store, "file", tuple(_UPLOAD_KINDS))
+    except BlobTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await run_in_threadpool(_register_upload, upload)
 
-    asset_id = uuid.uuid4().hex
-    dst_dir = _data_path("uploads", asset_id)
-    os.makedirs(dst_dir, exist_ok=True)
-    dst_path = os.path.join(dst_dir, filename)
 
-    with open(dst_path, "wb") as f:
-        f.write(file.file.read())
+def _register_upload(upload: UploadedFile) -> AssetOut:
+    filename = upload.filename
+    ext = Path(filename).suffix.lower()
+    kind = _UPLOAD_KINDS[ext]
+
+    # 按内容去重：相同内容复用已有 blob 及其缓存的元信息
+    blob, created = blob_store.ingest_written(upload.tmp_path, upload.size, upload.sha256, ext)
 
-    meta = {}
-    if kind == "raster":
-        meta = gdal_info(dst_path)
-    else:
-        meta = {"driver": "zip", "size_bytes": os.path.getsize(dst_path)}
+    meta = blob["meta"]
+    if created or not meta:
+        try:
+            if kind == "raster":
+                meta = gdal_info(blob["path"])
+            else:
+                meta = {"driver": "zip"}
+        except Exception:
+            blob_store.release(blob["sha256"])
+            raise
+        meta.update({"size_bytes": blob["size_bytes"], "sha256": blob["sha256"]})
+        db.update_blob_meta(blob["sha256"], meta)
 
+    asset_id = uuid.uuid4().hex
     asset = {
         "id": asset_id,
         "filename": filename,
         "kind": kind,
-        "path": dst_path,
+        "path": blob["path"],
         "created_at": utc_now_iso(),
         "meta": meta,
         "geoserver_layer": None,
         "geoserver_store": None,
         "published_at": None,
+        "blob_sha256": blob["sha256"],
     }
     db.insert_asset(asset)
+    if kind == "raster" and settings.COG_ENABLED and not meta.get("cog"):
+        # 后台转 COG（内部金字塔），完成后写入 meta["cog"]；同一 blob 只会真正转换一次
+        job_mgr.enqueue("cog", {"asset_id": asset_id})
     return _asset_to_out(asset)
 
 
 @app.get("/api/assets", response_model=list[AssetOut])
-def list_assets():
-    return [_asset_to_out(a) for a in db.list_assets()]
+def list_assets(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="每页条数；不传则返回全部"),
+    cursor: Optional[str] = Query(None, description="上一页响应头 X-Next-Cursor 的值"),
+    kind: Optional[str] = Query(None, description="raster/vector"),
+    published: Optional[bool] = Query(None, description="是否已发布到 GeoServer"),
+    prefix: Optional[str] = Query(None, description="文件名前缀"),
+    created_from: Optional[str] = Query(None, description="创建时间下界（含，ISO8601）"),
+    created_to: Optional[str] = Query(None, description="创建时间上界（不含，ISO8601）"),
+    slim: bool = Query(False, description="精简返回：不带 meta"),
+):
+    try:
+        assets, next_cursor = db.list_assets(
+            limit=limit,
+            cursor=cursor,
+            kind=kind,
+            published=published,
+            prefix=prefix,
+            created_from=created_from,
+            created_to=created_to,
+            slim=slim,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [_asset_to_out(a) for a in assets]
 
 
 @app.get("/api/assets/{asset_id}", response_model=AssetOut)
@@ -153,41 +292,84 @@ def get_asset(asset_id: str):
     return _asset_to_out(a)
 
 
+def _asset_etag(asset: dict) -> Optional[str]:
+    """按内容标识生成 ETag：上传文件即 blob sha256，派生文件为路径 + mtime + 大小。"""
+    cid = content_id(db, asset["id"])
+    if cid is None:
+        return None
+    return '"' + hashlib.sha256(cid.encode("utf-8")).hexdigest()[:32] + '"'
+
+
 @app.get("/api/assets/{asset_id}/file")
-def download_asset(asset_id: str):
+def download_asset(asset_id: str, request: Request):
+    """下载原始文件：支持 Range（断点续传/按需读取）与 If-None-Match。"""
     a = db.get_asset(asset_id)
     if not a:
         raise HTTPException(status_code=404, detail="asset not found")
-    return FileResponse(a["path"], filename=a["filename"], media_type="application/octet-stream")
+    etag = _asset_etag(a)
+    if etag is None:
+        raise HTTPException(status_code=404, detail="asset file missing")
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(a["path"], filename=a["filename"], media_type="application/octet-stream", headers=headers)
 
 
-def _safe_rm_asset_files(path: str) -> None:
-    """Best-effort 删除资产对应的本地文件/目录。
+@app.get("/api/assets/{asset_id}/subset")
+def download_subset(
+    asset_id: str,
+    request: Request,
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy；缺省为全幅"),
+    bbox_crs: str = Query("EPSG:4326", description="bbox 的坐标系"),
+    bands: Optional[str] = Query(None, description="波段列表，如 4,3,2；缺省为全部"),
+    res: Optional[float] = Query(None, description="目标像元大小（资产坐标系单位）；缺省为原始分辨率"),
+    resampling: str = Query("nearest", description="nearest/bilinear/cubic/average"),
+):
+    """按范围/波段/分辨率裁剪并以 GeoTIFF 流式返回（窗口读取，粗分辨率时读 overview）。"""
+    a = _get_raster_asset(asset_id)
+    try:
+        req = parse_subset_request(bbox, bbox_crs, bands, res, resampling)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    cid = content_id(db, asset_id)
+    if cid is None:
+        raise HTTPException(status_code=404, detail="asset file missing")
+    etag = req.etag(cid)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
 
-    - 只允许删除 DATA_DIR 之下的路径，避免误删。
-    - uploads/<asset_id>/...：删除该目录
-    - derived/<job_id>/...：删除该目录
-    """
     try:
-        data_root = os.path.abspath(settings.DATA_DIR)
-        p = os.path.abspath(path)
-        if not p.startswith(data_root + os.sep):
-            return
-        if not os.path.exists(p):
-            return
-
-        parent = os.path.dirname(p)
-        # 对 uploads/derived 目录，优先删整个子目录，顺带清理对齐/中间产物
-        if os.path.basename(os.path.dirname(parent)) in ("uploads", "derived"):
-            shutil.rmtree(parent, ignore_errors=True)
-            return
-
-        # 否则删单文件
-        if os.path.isfile(p):
-            os.remove(p)
-    except Exception:
-        # best-effort
-        return
+        out_path = build_subset(raster_source_path(a), req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    # 生成器只有开始迭代后才会在 finally 里释放内存文件（HEAD、客户端提前断开时可能根本不迭代），
+    # 因此再挂一个响应结束后的后台任务兜底；构造响应出错时当场释放
+    try:
+        headers["Content-Length"] = str(vsimem_size(out_path))
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(subset_filename(a['filename']))}"
+        return StreamingResponse(
+            stream_vsimem(out_path),
+            media_type="image/tiff",
+            headers=headers,
+            background=BackgroundTask(release_vsimem, out_path),
+        )
+    except BaseException:
+        release_vsimem(out_path)
+        raise
+
+
+@app.post("/api/assets/bulk", response_model=JobOut)
+def bulk_assets(req: BulkAssetsIn):
+    """批量发布/取消发布/删除：作为后台任务有界并发执行，逐项结果见 job.result.items。"""
+    if not req.asset_ids:
+        raise HTTPException(status_code=400, detail="asset_ids 不能为空")
+    if len(req.asset_ids) > settings.BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多 {settings.BULK_MAX_ITEMS} 个资产")
+    job = job_mgr.enqueue("bulk", req.model_dump())
+    return JobOut(**job)
 
 
 @app.delete("/api/assets/{asset_id}")
@@ -203,44 +385,136 @@ def delete_asset(
         raise HTTPException(status_code=404, detail="asset not found")
 
     # 1) optional: unpublish in GeoServer
-    if unpublish and a.get("geoserver_store"):
-        ws = settings.GEOSERVER_WORKSPACE
-        store = a["geoserver_store"]
+    if unpublish:
         try:
-            if a["kind"] == "raster":
-                geoserver.delete_coveragestore(ws, store, recurse=True, purge=purge)
-            elif a["kind"] == "vector":
-                geoserver.delete_datastore(ws, store, recurse=True)
+            unpublish_asset_from_geoserver(geoserver, a, purge=purge)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"geoserver unpublish failed: {e}")
 
-    # 2) optional: delete local files
-    if delete_files:
-        _safe_rm_asset_files(a["path"])
-
-    # 3) delete DB record
+    # 2) delete DB record（先提交：中途出错时最多留下无主文件，不会留下指向已删文件的记录）
     db.delete_asset(asset_id)
+    tile_cache.invalidate(asset_id)
+
+    # 3) optional: delete local files
+    if delete_files:
+        remove_asset_files(a, blob_store)
     return {"ok": True}
 
 
-@app.post("/api/assets/{asset_id}/publish", response_model=PublishOut)
-def publish_asset(asset_id: str):
+def _get_raster_asset(asset_id: str) -> dict:
     a = db.get_asset(asset_id)
     if not a:
         raise HTTPException(status_code=404, detail="asset not found")
+    if a["kind"] != "raster":
+        raise HTTPException(status_code=400, detail="asset is not raster")
+    return a
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    tags = [t.strip() for t in inm.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+@app.get("/api/assets/{asset_id}/tiles.json")
+def get_tilejson(asset_id: str):
+    """TileJSON：瓦片 URL 模板、经纬度范围与建议的最大缩放级别。"""
+    a = _get_raster_asset(asset_id)
+    base = settings.PUBLIC_BASE_URL.rstrip("/")
+    return tilejson(raster_source_path(a), f"{base}/api/assets/{asset_id}/tiles/{{z}}/{{x}}/{{y}}.png")
 
-    ws = settings.GEOSERVER_WORKSPACE
-    store = sanitize_name(a["filename"]) + "_" + asset_id[:8]
 
-    if a["kind"] == "raster":
-        store, layer = geoserver.publish_geotiff(ws, store, a["path"])
-    elif a["kind"] == "vector":
-        store, layer = geoserver.publish_shp_zip(ws, store, a["path"])
-    else:
+@app.get("/api/assets/{asset_id}/tiles/{z}/{x}/{y}.png")
+def get_tile(
+    asset_id: str,
+    z: int,
+    x: int,
+    y: int,
+    request: Request,
+    bands: Optional[str] = Query(None, description="显示波段，1 个或 3 个，如 1 或 4,3,2；默认 1,2,3 或 1"),
+    vmin: Optional[str] = Query(None, description="拉伸下限，1 个或每波段 1 个，逗号分隔；默认按波段统计"),
+    vmax: Optional[str] = Query(None, description="拉伸上限，与 vmin 对应"),
+    resampling: str = Query("bilinear", description="nearest/bilinear/cubic/average"),
+):
+    """XYZ 瓦片（EPSG:3857，256 PNG）：直接从资产渲染，不需要先发布到 GeoServer。"""
+    a = _get_raster_asset(asset_id)
+    try:
+        req = parse_tile_request(
+            raster_source_path(a), z, x, y, bands, vmin, vmax, resampling, stats=cached_stats(db, a)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 缓存键由源文件标识 + 渲染参数决定，可直接作为 ETag，命中时无需渲染
+    etag = f'"{req.key}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=300"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    data = tile_cache.get(asset_id, req.key)
+    if data is None:
+        try:
+            data = tile_renderer.render(req)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        tile_cache.put(asset_id, req.key, data)
+    return Response(content=data, media_type="image/png", headers=headers)
+
+
+@app.get("/api/assets/{asset_id}/stats")
+def get_asset_stats(asset_id: str, exact: bool = Query(False, description="只返回全量扫描的精确统计")):
+    """波段统计（min/max/mean/std、分位数、直方图），供前端拉伸控件使用。
+
+    优先返回 meta.stats 中仍有效的结果；没有时当场计算近似统计（读 overview）并保存。
+    exact=true 且尚无精确结果时返回 404，可先 POST 本接口提交全量统计任务。
+    """
+    a = _get_raster_asset(asset_id)
+    stats = cached_stats(db, a, exact=exact)
+    if stats is not None:
+        return stats
+    if exact:
+        raise HTTPException(status_code=404, detail="exact stats not computed yet")
+    try:
+        return compute_asset_stats(db, a)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/assets/{asset_id}/stats", response_model=JobOut)
+def compute_stats(asset_id: str):
+    """提交全量统计任务（分块扫描），完成后 GET stats 返回 exact=true 的结果。"""
+    _get_raster_asset(asset_id)
+    job = job_mgr.enqueue("stats", {"asset_id": asset_id})
+    return JobOut(**job)
+
+
+@app.post("/api/assets/{asset_id}/sample")
+def sample_asset(asset_id: str, req: SampleIn):
+    """批量点 / 折线取值：一次请求返回所有点的波段值；折线另给出沿线距离（米），用于剖面。"""
+    a = _get_raster_asset(asset_id)
+    try:
+        sreq = parse_sample_request(req.points, req.line, req.crs, req.bands, req.step)
+        path = raster_source_path(a)
+        return sampler.sample(path, source_id(path), sreq)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/assets/{asset_id}/publish", response_model=JobOut)
+def publish_asset(asset_id: str):
+    """发布到 GeoServer：作为后台任务执行，完成后 job.message 为 "<workspace>:<layer>"。"""
+    a = db.get_asset(asset_id)
+    if not a:
+        raise HTTPException(status_code=404, detail="asset not found")
+    if a["kind"] not in ("raster", "vector"):
         raise HTTPException(status_code=400, detail="unsupported asset kind")
 
-    db.update_asset_publish(asset_id, layer=layer, store=store)
-    return PublishOut(workspace=ws, store=store, layer=layer)
+    job = job_mgr.enqueue("publish", {"asset_id": asset_id})
+    return JobOut(**job)
 
 
 @app.post("/api/raster/calc", response_model=JobOut)
@@ -251,124 +525,19 @@ def raster_calc(req: RasterCalcIn):
     for var in req.inputs.keys():
         if len(var) != 1 or not var.isalpha() or not var.isupper():
             raise HTTPException(status_code=400, detail="变量名必须为单个大写字母，如 A/B/C")
+    try:
+        compile_calc_expr(req.expr, req.inputs.keys())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    job_id = uuid.uuid4().hex
-    job = {
-        "id": job_id,
-        "kind": "calc",
-        "status": "queued",
-        "created_at": utc_now_iso(),
-        "updated_at": utc_now_iso(),
-        "params": req.model_dump(by_alias=True),
-        "output_asset_id": None,
-        "message": None,
-    }
-    db.insert_job(job)
-
-    derived_dir = _data_path("derived", job_id)
-    os.makedirs(derived_dir, exist_ok=True)
-
-    def _run() -> JobResult:
-        # 取输入文件路径
-        var_paths: Dict[str, str] = {}
-        for var, aid in req.inputs.items():
-            a = db.get_asset(aid)
-            if not a:
-                raise RuntimeError(f"asset not found: {aid}")
-            if a["kind"] != "raster":
-                raise RuntimeError(f"asset is not raster: {aid}")
-            var_paths[var] = a["path"]
-
-        # 以字母序最小的变量作为 reference 网格
-        ref_var = sorted(var_paths.keys())[0]
-        ref_path = var_paths[ref_var]
-
-        aligned: Dict[str, str] = {}
-        for var, p in var_paths.items():
-            if var == ref_var:
-                aligned[var] = p
-                continue
-            out = os.path.join(derived_dir, f"aligned_{var}.tif")
-            warp_to_match(p, ref_path, out, resample="bilinear")
-            aligned[var] = out
-
-        out_path = os.path.join(derived_dir, f"{req.out_name}.tif")
-        run_gdal_calc(aligned, req.bands, req.expr, out_path, out_dtype=req.out_dtype, nodata=req.nodata)
-
-        # 输出资产入库
-        out_asset_id = uuid.uuid4().hex
-        out_asset = {
-            "id": out_asset_id,
-            "filename": f"{req.out_name}.tif",
-            "kind": "raster",
-            "path": out_path,
-            "created_at": utc_now_iso(),
-            "meta": gdal_info(out_path),
-            "geoserver_layer": None,
-            "geoserver_store": None,
-            "published_at": None,
-        }
-        db.insert_asset(out_asset)
-        return JobResult(output_asset_id=out_asset_id, message="ok")
-
-    job_mgr.submit(job_id, _run)
-    return JobOut(**db.get_job(job_id))
+    job = job_mgr.enqueue("calc", req.model_dump(by_alias=True))
+    return JobOut(**job)
 
 
 @app.post("/api/raster/fuse", response_model=JobOut)
 def raster_fuse(req: RasterFuseIn):
-    job_id = uuid.uuid4().hex
-    job = {
-        "id": job_id,
-        "kind": "fuse",
-        "status": "queued",
-        "created_at": utc_now_iso(),
-        "updated_at": utc_now_iso(),
-        "params": req.model_dump(by_alias=True),
-        "output_asset_id": None,
-        "message": None,
-    }
-    db.insert_job(job)
-
-    derived_dir = _data_path("derived", job_id)
-    os.makedirs(derived_dir, exist_ok=True)
-
-    def _run() -> JobResult:
-        hs_a = db.get_asset(req.hs)
-        rgb_a = db.get_asset(req.rgb)
-        if not hs_a or not rgb_a:
-            raise RuntimeError("hs/rgb asset not found")
-        if hs_a["kind"] != "raster" or rgb_a["kind"] != "raster":
-            raise RuntimeError("hs/rgb must be raster")
-
-        out_path = os.path.join(derived_dir, f"{req.out_name}.tif")
-        fuse_hs_rgb(
-            hs_path=hs_a["path"],
-            rgb_path=rgb_a["path"],
-            out_path=out_path,
-            alpha=req.alpha,
-            lam=req.lambda_,
-            max_samples=req.max_samples,
-            out_dtype=req.out_dtype,
-        )
-
-        out_asset_id = uuid.uuid4().hex
-        out_asset = {
-            "id": out_asset_id,
-            "filename": f"{req.out_name}.tif",
-            "kind": "raster",
-            "path": out_path,
-            "created_at": utc_now_iso(),
-            "meta": gdal_info(out_path),
-            "geoserver_layer": None,
-            "geoserver_store": None,
-            "published_at": None,
-        }
-        db.insert_asset(out_asset)
-        return JobResult(output_asset_id=out_asset_id, message="ok")
-
-    job_mgr.submit(job_id, _run)
-    return JobOut(**db.get_job(job_id))
+    job = job_mgr.enqueue("fuse", req.model_dump(by_alias=True))
+    return JobOut(**job)
 
 
 @app.get("/api/jobs/{job_id}", response_model=JobOut)
@@ -377,3 +546,42 @@ def get_job(job_id: str):
     if not j:
         raise HTTPException(status_code=404, detail="job not found")
     return JobOut(**j)
+
+
+@app.delete("/api/jobs/{job_id}", response_model=JobOut)
+def cancel_job(job_id: str):
+    """取消任务：排队中的立即变为 cancelled；运行中的标记 cancel_requested，在下一个检查点退出。"""
+    j = job_mgr.cancel(job_id)
+    if not j:
+        raise HTTPException(status_code=404, detail="job not found")
+    return JobOut(**j)
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """Server-Sent Events：job 状态/进度变化时推送一条 `event: job`，到达终态后结束。"""
+    if not db.get_job(job_id):
+        raise HTTPException(status_code=404, detail="job not found")
+
+    async def _stream():
+        last = None
+        while True:
+            # 先取版本号再读库：读库之后的变化一定会唤醒下面的 wait
+            version = job_mgr.events.version(job_id)
+            j = db.get_job(job_id)
+            if j is None:
+                return
+            payload = JobOut(**j).model_dump_json()
+            if payload != last:
+                yield f"event: job\ndata: {payload}\n\n"
+                last = payload
+            if j["status"] in TERMINAL_STATUSES or await request.is_disconnected():
+                return
+            if await job_mgr.events.wait(job_id, version, timeout=15.0) == version:
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
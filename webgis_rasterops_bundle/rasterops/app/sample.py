@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from osgeo import gdal, osr
+
+from config import settings
+from dscache import GridInfo, grid_info, open_dataset
+
+# 批量点/折线取值：坐标一次性向量化变换到像元行列，按数据块分组读取（每个块只读一次），
+# 折线按像元大小加密采样并给出沿线距离（米），用于剖面/高程曲线。
+
+_EARTH_RADIUS_M = 6371008.8
+
+
+@dataclass(frozen=True)
+class SampleRequest:
+    points: Tuple[Tuple[float, float], ...]
+    is_line: bool
+    crs: str
+    bands: Optional[Tuple[int, ...]]  # None = 全部波段
+    step: Optional[float]  # 折线采样间距（数据集坐标系单位），None = 像元大小
+
+
+def parse_sample_request(
+    points: Optional[Sequence[Sequence[float]]] = None,
+    line: Optional[Sequence[Sequence[float]]] = None,
+    crs: str = "EPSG:4326",
+    bands: Optional[Sequence[int]] = None,
+    step: Optional[float] = None,
+) -> SampleRequest:
+    """校验取样参数（points 与 line 二选一）；参数非法时抛 ValueError。"""
+    if (points is None) == (line is None):
+        raise ValueError("exactly one of points / line is required")
+    coords = points if points is not None else line
+    if not coords:
+        raise ValueError("coordinates must not be empty")
+    if line is not None and len(line) < 2:
+        raise ValueError("line needs at least 2 vertices")
+    if len(coords) > settings.SAMPLE_MAX_POINTS:
+        raise ValueError(f"too many coordinates (max {settings.SAMPLE_MAX_POINTS})")
+    try:
+        pts = tuple((float(c[0]), float(c[1])) for c in coords)
+    except (TypeError, ValueError, IndexError):
+        raise ValueError("coordinates must be [x, y] pairs")
+    if not all(math.isfinite(v) for p in pts for v in p):
+        raise ValueError("coordinates must be finite")
+    srs = osr.SpatialReference()
+    try:
+        if srs.SetFromUserInput(crs) != 0:
+            raise ValueError
+    except (RuntimeError, ValueError):
+        raise ValueError(f"invalid crs: {crs}")
+    band_list = None
+    if bands:
+        band_list = tuple(int(b) for b in bands)
+        if min(band_list) < 1:
+            raise ValueError("bands must be 1-based band indexes")
+    if step is not None and not (step > 0 and math.isfinite(step)):
+        raise ValueError("step must be a positive number")
+    return SampleRequest(pts, line is not None, crs, band_list, step)
+
+
+class _GridInfo:
+    """每个源文件只构造一次的取值辅助信息：逆地理变换、坐标系对象与坐标变换缓存（网格描述来自 dscache）。
+
+    osr.CoordinateTransformation 不能跨线程并发使用，坐标变换按线程各缓存一份。
+    """
+
+    def __init__(self, g: GridInfo):
+        gt = g.geotransform
+        if gt is None:
+            raise ValueError("raster has no geotransform")
+        self.inv_gt = gdal.InvGeoTransform(gt)
+        if self.inv_gt is None:
+            raise ValueError("raster geotransform is not invertible")
+        self.xsize, self.ysize = g.xsize, g.ysize
+        self.band_count = g.band_count
+        self.pixel_size = min(math.hypot(gt[1], gt[4]), math.hypot(gt[2], gt[5]))
+        self.block = g.block_size
+        self.nodata = list(g.nodata)
+        self.is_int = [t not in ("Float32", "Float64") for t in g.dtypes]
+        wkt = g.projection
+        self.srs: Optional[osr.SpatialReference] = None
+        if wkt:
+            self.srs = osr.SpatialReference()
+            self.srs.ImportFromWkt(wkt)
+            self.srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self._local = threading.local()
+
+    def transform(self, crs: str) -> Optional[osr.CoordinateTransformation]:
+        """请求坐标系 -> 数据集坐标系的变换（相同坐标系或数据集无坐标系时为 None），仅供当前线程使用。"""
+        transforms: Dict[str, Optional[osr.CoordinateTransformation]] = getattr(self._local, "transforms", None)
+        if transforms is None:
+            transforms = self._local.transforms = {}
+        if crs in transforms:
+            return transforms[crs]
+        ct = None
+        if self.srs is not None:
+            src = osr.SpatialReference()
+            src.SetFromUserInput(crs)
+            src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            if not src.IsSame(self.srs):
+                ct = osr.CoordinateTransformation(src, self.srs.Clone())
+        transforms[crs] = ct
+        return ct
+
+
+class Sampler:
+    """按资产源文件取值；取值辅助信息按 source_id 做 LRU 缓存，dataset 句柄从 dscache 共享池借用。"""
+
+    def __init__(self, max_sources: int = 64):
+        self.max_sources = max_sources
+        self._grids: "OrderedDict[str, _GridInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _grid(self, path: str, source_id: str) -> _GridInfo:
+        with self._lock:
+            g = self._grids.get(source_id)
+            if g is not None:
+                self._grids.move_to_end(source_id)
+                return g
+        g = _GridInfo(grid_info(path))
+        with self._lock:
+            self._grids[source_id] = g
+            while len(self._grids) > self.max_sources:
+                self._grids.popitem(last=False)
+        return g
+
+    def sample(self, path: str, source_id: str, req: SampleRequest) -> Dict:
+        grid = self._grid(path, source_id)
+        bands = list(req.bands) if req.bands else list(range(1, grid.band_count + 1))
+        if max(bands) > grid.band_count:
+            raise ValueError(f"band index out of range (raster has {grid.band_count} bands)")
+
+        xy = np.asarray(req.points, dtype=np.float64)
+        ct = grid.transform(req.crs)
+        if ct is not None:
+            xy = np.asarray(ct.TransformPoints(xy.tolist()), dtype=np.float64)[:, :2]
+
+        distance = None
+        if req.is_line:
+            # 变换失败的顶点（inf/NaN）无法加密和计算沿线距离
+            if not np.isfinite(xy).all():
+                raise ValueError("line vertices cannot be transformed to the raster crs")
+            xy, distance = _densify(xy, req.step or grid.pixel_size, grid)
+
+        col, row = _pixel_index(xy, grid)
+        with open_dataset(path) as ds:
+            values = _read_by_block(ds, grid, bands, col, row)
+
+        # 输出坐标用请求坐标系（折线加密点需要反变换回去）
+        out_xy = xy
+        if ct is not None and req.is_line:
+            out_xy = np.asarray(ct.GetInverse().TransformPoints(xy.tolist()), dtype=np.float64)[:, :2]
+        elif not req.is_line:
+            out_xy = np.asarray(req.points, dtype=np.float64)
+
+        inside = (col >= 0) & (col < grid.xsize) & (row >= 0) & (row < grid.ysize)
+        return {
+            "crs": req.crs,
+            "bands": bands,
+            "count": int(len(col)),
+            "x": out_xy[:, 0].tolist(),
+            "y": out_xy[:, 1].tolist(),
+            "col": [int(c) if ok else None for c, ok in zip(col, inside)],
+            "row": [int(r) if ok else None for r, ok in zip(row, inside)],
+            "distance": distance.tolist() if distance is not None else None,
+            "values": _values_to_json(values, inside, bands, grid),
+        }
+
+
+def _pixel_index(xy: np.ndarray, grid: _GridInfo) -> Tuple[np.ndarray, np.ndarray]:
+    """坐标 -> 像元列/行（int64）。范围外、坐标变换失败（非有限值）的点统一记为 -1，
+    先在浮点上判断再取整，避免 inf/NaN 或超大值转 int64 时得到任意值。"""
+    inv = grid.inv_gt
+    with np.errstate(invalid="ignore", over="ignore"):
+        fc = np.floor(inv[0] + inv[1] * xy[:, 0] + inv[2] * xy[:, 1])
+        fr = np.floor(inv[3] + inv[4] * xy[:, 0] + inv[5] * xy[:, 1])
+    ok = np.isfinite(fc) & np.isfinite(fr) & (fc >= 0) & (fc < grid.xsize) & (fr >= 0) & (fr < grid.ysize)
+    col = np.where(ok, fc, -1).astype(np.int64)
+    row = np.where(ok, fr, -1).astype(np.int64)
+    return col, row
+
+
+def _densify(xy: np.ndarray, step: float, grid: _GridInfo) -> Tuple[np.ndarray, np.ndarray]:
+    """按 step（数据集坐标系单位）加密折线（保留原始顶点），返回 (点, 沿线累计距离/米)。
+
+    加密后点数超过 SAMPLE_MAX_POINTS 时自动放大步长。
+    """
+    seg = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1]))
+    total = float(seg.sum())
+    limit = max(settings.SAMPLE_MAX_POINTS - len(xy), 0)
+    if total > 0 and total / step > limit:
+        step = total / max(limit, 1)
+    parts: List[np.ndarray] = []
+    for i, length in enumerate(seg):
+        n = max(int(math.ceil(length / step)), 1)
+        t = np.arange(n, dtype=np.float64) / n
+        parts.append(xy[i] + t[:, None] * (xy[i + 1] - xy[i]))
+    parts.append(xy[-1:])
+    pts = np.concatenate(parts)
+    return pts, _cumulative_meters(pts, grid.srs)
+
+
+def _cumulative_meters(xy: np.ndarray, srs: Optional[osr.SpatialReference]) -> np.ndarray:
+    """沿线累计距离（米）：地理坐标系用大圆距离，投影坐标系按线性单位换算。"""
+    if srs is not None and srs.IsGeographic():
+        lon, lat = np.radians(xy[:, 0]), np.radians(xy[:, 1])
+        dlat, dlon = np.diff(lat), np.diff(lon)
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+        d = 2 * _EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    else:
+        unit = srs.GetLinearUnits() if srs is not None else 1.0
+        d = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1])) * unit
+    return np.concatenate([[0.0], np.cumsum(d)])
+
+
+def _read_by_block(ds: gdal.Dataset, grid: _GridInfo, bands: List[int], col: np.ndarray, row: np.ndarray) -> np.ndarray:
+    """按数据块分组读取：每个被命中的块只读一次（所选波段一起读），返回 (n, nb) float64，范围外为 NaN。"""
+    n, nb = len(col), len(bands)
+    out = np.full((n, nb), np.nan, dtype=np.float64)
+    inside = (col >= 0) & (col < grid.xsize) & (row >= 0) & (row < grid.ysize)
+    if not inside.any():
+        return out
+    bw, bh = grid.block
+    idx = np.nonzero(inside)[0]
+    c, r = col[idx], row[idx]
+    nbx = (grid.xsize + bw - 1) // bw
+    key = (r // bh) * nbx + (c // bw)
+    order = np.argsort(key, kind="stable")
+    keys, starts = np.unique(key[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for k, s, e in zip(keys, starts, ends):
+        sel = order[s:e]
+        x0, y0 = int(k % nbx) * bw, int(k // nbx) * bh
+        xs, ys = min(bw, grid.xsize - x0), min(bh, grid.ysize - y0)
+        block = ds.ReadAsArray(x0, y0, xs, ys, band_list=bands, buf_type=gdal.GDT_Float64).reshape(nb, ys, xs)
+        out[idx[sel]] = block[:, r[sel] - y0, c[sel] - x0].T
+    return out
+
+
+def _values_to_json(values: np.ndarray, inside: np.ndarray, bands: List[int], grid: _GridInfo) -> List[Optional[List]]:
+    """(n, nb) -> 每点一行；范围外为 null，nodata/非有限值的波段为 null，整型波段输出整数。"""
+    nodata = [grid.nodata[b - 1] for b in bands]
+    is_int = [grid.is_int[b - 1] for b in bands]
+    rows: List[Optional[List]] = []
+    for v, ok in zip(values, inside):
+        if not ok:
+            rows.append(None)
+            continue
+        row = []
+        for j, x in enumerate(v):
+            if not math.isfinite(x) or (nodata[j] is not None and x == nodata[j]):
+                row.append(None)
+            else:
+                row.append(int(x) if is_int[j] else float(x))
+        rows.append(row)
+    return rows
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import uuid
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple
+
+from osgeo import gdal, osr
+
+from config import settings
+from dscache import open_dataset
+
+# 按范围/波段/分辨率裁剪下载：gdal.Translate 只读取窗口内的块，目标分辨率较粗时
+# RasterIO 自动改读合适层级的 overview（COG 内部金字塔）；结果写在 /vsimem，分块流式返回。
+
+# 裁剪逻辑变化时递增，使 ETag 失效
+_SUBSET_VERSION = 1
+
+_RESAMPLING = {
+    "nearest": "near",
+    "bilinear": "bilinear",
+    "cubic": "cubic",
+    "average": "average",
+}
+
+
+@dataclass(frozen=True)
+class SubsetRequest:
+    bbox: Optional[Tuple[float, float, float, float]]  # None = 全幅
+    bbox_crs: str  # bbox 的坐标系（EPSG:4326 / EPSG:3857 / WKT 等 GDAL 可识别的写法）
+    bands: Optional[Tuple[int, ...]]  # None = 全部波段
+    res: Optional[float]  # 目标像元大小（数据集坐标系单位），None = 原始分辨率
+    resampling: str
+
+    def etag(self, content_id: str) -> str:
+        body = "|".join(str(v) for v in (_SUBSET_VERSION, content_id, self.bbox, self.bbox_crs, self.bands, self.res, self.resampling))
+        return '"' + hashlib.sha256(body.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def parse_subset_request(
+    bbox: Optional[str] = None,
+    bbox_crs: str = "EPSG:4326",
+    bands: Optional[str] = None,
+    res: Optional[float] = None,
+    resampling: str = "nearest",
+) -> SubsetRequest:
+    """校验并规范化裁剪参数；参数非法时抛 ValueError。"""
+    box = None
+    if bbox is not None and bbox.strip() != "":
+        try:
+            box = tuple(float(v) for v in bbox.split(","))
+        except ValueError:
+            raise ValueError(f"invalid bbox: {bbox}")
+        if len(box) != 4 or not all(math.isfinite(v) for v in box):
+            raise ValueError("bbox must be minx,miny,maxx,maxy")
+        if box[0] >= box[2] or box[1] >= box[3]:
+            raise ValueError("bbox must satisfy minx<maxx and miny<maxy")
+    srs = osr.SpatialReference()
+    try:
+        if srs.SetFromUserInput(bbox_crs) != 0:
+            raise ValueError
+    except (RuntimeError, ValueError):
+        raise ValueError(f"invalid bbox_crs: {bbox_crs}")
+    band_list = None
+    if bands is not None and bands.strip() != "":
+        try:
+            band_list = tuple(int(b) for b in bands.split(","))
+        except ValueError:
+            raise ValueError(f"invalid bands: {bands}")
+        if not band_list or min(band_list) < 1:
+            raise ValueError("bands must be 1-based band indexes")
+    if res is not None and not (res > 0 and math.isfinite(res)):
+        raise ValueError("res must be a positive number")
+    if resampling not in _RESAMPLING:
+        raise ValueError(f"unsupported resampling: {resampling}")
+    return SubsetRequest(box, bbox_crs, band_list, res, resampling)
+
+
+def _proj_win(ds: gdal.Dataset, req: SubsetRequest) -> Optional[list]:
+    """bbox 变换到数据集坐标系并与数据范围求交，返回 projWin [ulx, uly, lrx, lry]。"""
+    if req.bbox is None:
+        return None
+    gt = ds.GetGeoTransform(can_return_null=True)
+    wkt = ds.GetProjectionRef()
+    if gt is None:
+        raise ValueError("raster has no geotransform, bbox subset is not possible")
+    if gt[2] != 0 or gt[4] != 0:
+        raise ValueError("rotated rasters are not supported")
+    minx, miny, maxx, maxy = req.bbox
+    if wkt:
+        src = osr.SpatialReference()
+        src.SetFromUserInput(req.bbox_crs)
+        dst = osr.SpatialReference()
+        dst.ImportFromWkt(wkt)
+        for s in (src, dst):
+            s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not src.IsSame(dst):
+            try:
+                ct = osr.CoordinateTransformation(src, dst)
+                minx, miny, maxx, maxy = ct.TransformBounds(minx, miny, maxx, maxy, 21)
+            except RuntimeError as e:
+                raise ValueError(f"cannot transform bbox: {e}")
+    x0, x1 = gt[0], gt[0] + gt[1] * ds.RasterXSize
+    y0, y1 = gt[3], gt[3] + gt[5] * ds.RasterYSize
+    ulx, lrx = max(minx, min(x0, x1)), min(maxx, max(x0, x1))
+    lry, uly = max(miny, min(y0, y1)), min(maxy, max(y0, y1))
+    if not (ulx < lrx and lry < uly):
+        raise ValueError("bbox does not intersect the raster")
+    return [ulx, uly, lrx, lry]
+
+
+def build_subset(path: str, req: SubsetRequest) -> str:
+    """把裁剪结果写成 /vsimem 下的 GeoTIFF 并返回其路径（调用方负责 stream_vsimem 后释放）。
+
+    先建 VRT 确定输出尺寸，超过 SUBSET_MAX_PIXELS（宽 x 高 x 波段）时抛 ValueError，不做任何读取。
+    """
+    # 句柄从共享池借出：VRT 引用它，CreateCopy 完成前不能归还
+    with open_dataset(path) as ds:
+        if req.bands is not None and max(req.bands) > ds.RasterCount:
+            raise ValueError(f"band index out of range (raster has {ds.RasterCount} bands)")
+
+        opts = {"format": "VRT", "resampleAlg": _RESAMPLING[req.resampling]}
+        win = _proj_win(ds, req)
+        if win is not None:
+            opts["projWin"] = win
+        if req.bands is not None:
+            opts["bandList"] = list(req.bands)
+        if req.res is not None:
+            opts["xRes"] = req.res
+            opts["yRes"] = req.res
+        vrt = gdal.Translate("", ds, options=gdal.TranslateOptions(**opts))
+        if vrt is None:
+            raise RuntimeError("subset failed")
+        pixels = vrt.RasterXSize * vrt.RasterYSize * vrt.RasterCount
+        if settings.SUBSET_MAX_PIXELS > 0 and pixels > settings.SUBSET_MAX_PIXELS:
+            raise ValueError(
+                f"subset too large: {vrt.RasterXSize}x{vrt.RasterYSize}x{vrt.RasterCount} "
+                f"> {settings.SUBSET_MAX_PIXELS} pixels; use a smaller bbox, fewer bands or a coarser res"
+            )
+
+        is_float = vrt.GetRasterBand(1).DataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+        out_path = f"/vsimem/rasterops_subset_{uuid.uuid4().hex}.tif"
+        out = gdal.GetDriverByName("GTiff").CreateCopy(
+            out_path,
+            vrt,
+            options=[
+                "TILED=YES",
+                "COMPRESS=DEFLATE",
+                f"PREDICTOR={3 if is_float else 2}",
+                f"NUM_THREADS={settings.GDAL_NUM_THREADS}",
+            ],
+        )
+        if out is None:
+            gdal.Unlink(out_path)
+            raise RuntimeError("subset failed")
+        out = vrt = None  # flush；VRT 引用借出的句柄，归还前先释放
+    return out_path
+
+
+def stream_vsimem(path: str, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """分块读出 /vsimem 文件，读完（或客户端断开）后释放。"""
+    f = gdal.VSIFOpenL(path, "rb")
+    try:
+        if f is None:
+            return
+        while True:
+            data = gdal.VSIFReadL(1, chunk_size, f)
+            if not data:
+                break
+            yield bytes(data)
+    finally:
+        if f is not None:
+            gdal.VSIFCloseL(f)
+        release_vsimem(path)
+
+
+def release_vsimem(path: str) -> None:
+    """释放 /vsimem 文件；已释放时什么也不做（响应的后台任务与生成器都会调用）。"""
+    try:
+        gdal.Unlink(path)
+    except RuntimeError:
+        pass
+
+
+def vsimem_size(path: str) -> int:
+    st = gdal.VSIStatL(path)
+    return int(st.size) if st is not None else 0
+
+
+def subset_filename(filename: str) -> str:
+    return os.path.splitext(filename)[0] + "_subset.tif"
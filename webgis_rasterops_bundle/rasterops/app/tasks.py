@@ -0,0 +1,526 @@
+from __future__ import annotations
+
+import ast
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from blobstore import BlobStore
+from config import data_path, settings
+from db import DB, utc_now_iso
+from dscache import invalidate
+from gdalops import ProgressFn, band_stats, convert_to_cog, fuse_hs_rgb, gdal_info, open_aligned, run_raster_calc
+from geoserver import GeoServerClient, sanitize_name
+from jobs import JobContext, JobResult
+
+# 后台任务实现：按 kind 注册，参数即 jobs.params_json（可持久化、重启后可重放）
+
+
+@contextmanager
+def _derived_dir(job_id: str) -> Iterator[str]:
+    """任务输出目录 derived/<job_id>；任务失败/取消/超时时连同半成品一起删除。
+
+    worker 被强制终止、进程崩溃时走不到这里，由 JobManager 调用 discard_job_outputs 兜底。
+    """
+    d = data_path("derived", job_id)
+    os.makedirs(d, exist_ok=True)
+    try:
+        yield d
+    except BaseException:
+        shutil.rmtree(d, ignore_errors=True)
+        raise
+
+
+def discard_job_outputs(job_id: str) -> None:
+    """删除未产出输出就结束的任务留下的 derived/<job_id>。"""
+    shutil.rmtree(data_path("derived", job_id), ignore_errors=True)
+
+
+def _get_raster_asset(ctx: JobContext, asset_id: str) -> Dict:
+    a = ctx.db.get_asset(asset_id)
+    if not a:
+        raise RuntimeError(f"asset not found: {asset_id}")
+    if a["kind"] != "raster":
+        raise RuntimeError(f"asset is not raster: {asset_id}")
+    return a
+
+
+def raster_source_path(asset: Dict) -> str:
+    """读取栅格资产时优先用其 COG 版本（内部金字塔、分块），否则用原文件。"""
+    cog = (asset.get("meta") or {}).get("cog") or {}
+    if cog.get("path") and os.path.exists(cog["path"]):
+        return cog["path"]
+    return asset["path"]
+
+
+def _stage(ctx: JobContext, lo: float, hi: float) -> ProgressFn:
+    """子步骤的 0~1 进度映射到任务整体进度的 [lo, hi]。"""
+    return lambda frac: ctx.progress(lo + (hi - lo) * frac)
+
+
+def _cog_meta(path: str) -> Dict:
+    return {"path": path, "resampling": settings.COG_RESAMPLING, "overviews": gdal_info(path)["overviews"]}
+
+
+def _finalize_output(ctx: JobContext, out_path: str, lo: float) -> None:
+    """任务输出的后处理：开启 COG 时原地转换（进度占 [lo, 1]）。"""
+    if settings.COG_ENABLED:
+        convert_to_cog(out_path, out_path, settings.COG_RESAMPLING, progress=_stage(ctx, lo, 1.0))
+    ctx.check()
+
+
+def _register_output(ctx: JobContext, out_path: str) -> str:
+    """输出栅格入库为新资产，返回 asset_id。"""
+    meta = gdal_info(out_path)
+    if settings.COG_ENABLED:
+        meta["cog"] = _cog_meta(out_path)
+    out_asset_id = uuid.uuid4().hex
+    out_asset = {
+        "id": out_asset_id,
+        "filename": os.path.basename(out_path),
+        "kind": "raster",
+        "path": out_path,
+        "created_at": utc_now_iso(),
+        "meta": meta,
+        "geoserver_layer": None,
+        "geoserver_store": None,
+        "published_at": None,
+    }
+    ctx.db.insert_asset(out_asset)
+    return out_asset_id
+
+
+def run_calc(params: Dict, ctx: JobContext) -> JobResult:
+    inputs: Dict[str, str] = params["inputs"]
+    # 取输入文件路径
+    var_paths = {var: raster_source_path(_get_raster_asset(ctx, aid)) for var, aid in inputs.items()}
+
+    # 以字母序最小的变量作为 reference 网格
+    ref_var = sorted(var_paths.keys())[0]
+    ref_path = var_paths[ref_var]
+
+    # 已在参考网格上的输入直接使用，其余用 warped VRT 按块即时重采样（不落盘）
+    aligned: Dict[str, object] = {}
+    for var, p in var_paths.items():
+        aligned[var] = p if var == ref_var else open_aligned(p, ref_path, resample="bilinear")
+
+    with _derived_dir(ctx.job_id) as out_dir:
+        out_path = os.path.join(out_dir, f"{params['out_name']}.tif")
+        run_raster_calc(
+            aligned,
+            params.get("bands") or {},
+            params["expr"],
+            out_path,
+            out_dtype=params.get("out_dtype", "Float32"),
+            nodata=params.get("nodata"),
+            progress=_stage(ctx, 0.0, 0.8),
+        )
+        _finalize_output(ctx, out_path, 0.8)
+        return JobResult(output_asset_id=_register_output(ctx, out_path), message="ok")
+
+
+def run_fuse(params: Dict, ctx: JobContext) -> JobResult:
+    hs_a = ctx.db.get_asset(params["hs"])
+    rgb_a = ctx.db.get_asset(params["rgb"])
+    if not hs_a or not rgb_a:
+        raise RuntimeError("hs/rgb asset not found")
+    if hs_a["kind"] != "raster" or rgb_a["kind"] != "raster":
+        raise RuntimeError("hs/rgb must be raster")
+
+    with _derived_dir(ctx.job_id) as out_dir:
+        out_path = os.path.join(out_dir, f"{params['out_name']}.tif")
+        fuse_hs_rgb(
+            hs_path=raster_source_path(hs_a),
+            rgb_path=raster_source_path(rgb_a),
+            out_path=out_path,
+            alpha=params.get("alpha", 1.0),
+            lam=params.get("lambda", 1e-3),
+            max_samples=params.get("max_samples", 200_000),
+            out_dtype=params.get("out_dtype", "Byte"),
+            progress=_stage(ctx, 0.0, 0.9),
+        )
+        _finalize_output(ctx, out_path, 0.9)
+        return JobResult(output_asset_id=_register_output(ctx, out_path), message="ok")
+
+
+def run_cog(params: Dict, ctx: JobContext) -> JobResult:
+    """把已入库的栅格转为 COG，结果记录在 meta["cog"]。
+
+    上传文件（blob）在 blob 目录里另存一份 data.cog.tif（原文件保持不变，内容寻址仍成立），
+    并更新所有引用该 blob 的资产；其他文件原地转换。
+    """
+    a = _get_raster_asset(ctx, params["asset_id"])
+    if a.get("blob_sha256"):
+        blob = ctx.db.get_blob(a["blob_sha256"])
+        if blob is None:
+            raise RuntimeError(f"blob not found: {a['blob_sha256']}")
+        if (blob["meta"] or {}).get("cog"):
+            return JobResult(output_asset_id=a["id"], message="ok (already cog)")
+        cog_path = os.path.join(os.path.dirname(blob["path"]), "data.cog.tif")
+        convert_to_cog(blob["path"], cog_path, settings.COG_RESAMPLING, progress=ctx.progress)
+        ctx.db.patch_meta({"cog": _cog_meta(cog_path)}, blob_sha256=blob["sha256"])
+    else:
+        convert_to_cog(a["path"], a["path"], settings.COG_RESAMPLING, progress=ctx.progress)
+        ctx.db.patch_meta({"cog": _cog_meta(a["path"])}, asset_id=a["id"])
+    return JobResult(output_asset_id=a["id"], message="ok")
+
+
+_geoserver: Optional[GeoServerClient] = None
+
+
+def _geoserver_client() -> GeoServerClient:
+    # 每个进程一个客户端（进程后端下各 worker 各自持有连接池）
+    global _geoserver
+    if _geoserver is None:
+        _geoserver = GeoServerClient()
+    return _geoserver
+
+
+def publish_asset_to_geoserver(gs: GeoServerClient, a: Dict) -> Dict:
+    """发布单个资产，返回 {workspace, store, layer, external}；不写数据库。
+
+    栅格按 GEOSERVER_PUBLISH_MODE 上传文件或登记外部路径；矢量 zip 总是上传。
+    """
+    ws = settings.GEOSERVER_WORKSPACE
+    store = sanitize_name(a["filename"]) + "_" + a["id"][:8]
+    external = False
+    if a["kind"] == "raster":
+        if settings.GEOSERVER_PUBLISH_MODE == "external":
+            store, layer = gs.publish_geotiff_external(ws, store, raster_source_path(a))
+            external = True
+        else:
+            store, layer = gs.publish_geotiff(ws, store, raster_source_path(a))
+    elif a["kind"] == "vector":
+        store, layer = gs.publish_shp_zip(ws, store, a["path"])
+    else:
+        raise RuntimeError("unsupported asset kind")
+    return {"workspace": ws, "store": store, "layer": layer, "external": external}
+
+
+def unpublish_asset_from_geoserver(gs: GeoServerClient, a: Dict, purge: str = "all") -> None:
+    """从 GeoServer 删除资产对应的 store/layer；未发布的资产直接返回。"""
+    store = a.get("geoserver_store")
+    if not store:
+        return
+    ws = settings.GEOSERVER_WORKSPACE
+    if a["kind"] == "raster":
+        # 外部 store 指向的是 rasterops 自己的文件，不能让 GeoServer 删除
+        if (a.get("meta") or {}).get("geoserver_external"):
+            purge = "none"
+        gs.delete_coveragestore(ws, store, recurse=True, purge=purge)
+    elif a["kind"] == "vector":
+        gs.delete_datastore(ws, store, recurse=True)
+
+
+def remove_asset_files(asset: Dict, blob_store: BlobStore) -> None:
+    """Best-effort 删除资产对应的本地文件/目录。
+
+    - blob 资产：释放一个引用，最后一个引用释放时才删除 blob 目录。
+    - 只允许删除 DATA_DIR 之下的路径，避免误删。
+    - uploads/<asset_id>/...：删除该目录（去重之前的旧上传）
+    - derived/<job_id>/...：删除该目录
+    删除前先丢弃本进程缓存的该目录下的句柄/网格信息（其它进程的空闲句柄在下次打开新文件时清理）。
+    """
+    try:
+        invalidate(os.path.dirname(asset["path"]))
+        if asset.get("blob_sha256"):
+            blob_store.release(asset["blob_sha256"])
+            return
+
+        path = asset["path"]
+        data_root = os.path.abspath(settings.DATA_DIR)
+        p = os.path.abspath(path)
+        if not p.startswith(data_root + os.sep):
+            return
+        if not os.path.exists(p):
+            return
+
+        parent = os.path.dirname(p)
+        # 对 uploads/derived 目录，优先删整个子目录，顺带清理对齐/中间产物
+        if os.path.basename(os.path.dirname(parent)) in ("uploads", "derived"):
+            shutil.rmtree(parent, ignore_errors=True)
+            return
+
+        # 否则删单文件
+        if os.path.isfile(p):
+            os.remove(p)
+    except Exception:
+        # best-effort
+        return
+
+
+def run_publish(params: Dict, ctx: JobContext) -> JobResult:
+    """发布资产到 GeoServer，完成后 message 为 "<workspace>:<layer>"。"""
+    a = ctx.db.get_asset(params["asset_id"])
+    if not a:
+        raise RuntimeError(f"asset not found: {params['asset_id']}")
+
+    r = publish_asset_to_geoserver(_geoserver_client(), a)
+    ctx.db.update_asset_publish(a["id"], layer=r["layer"], store=r["store"])
+    # 外部 store 引用的是我们自己的文件，取消发布时不能让 GeoServer purge
+    ctx.db.patch_meta({"geoserver_external": r["external"]}, asset_id=a["id"])
+    return JobResult(output_asset_id=a["id"], message=f"{r['workspace']}:{r['layer']}")
+
+
+def cached_stats(db: DB, a: Dict, exact: bool = False) -> Optional[Dict]:
+    """meta.stats 中仍然有效的统计（内容未变化）；要求 exact 时只认全量扫描的结果。"""
+    stats = (a.get("meta") or {}).get("stats")
+    if not stats or stats.get("source") != content_id(db, a["id"]):
+        return None
+    if exact and not stats.get("exact"):
+        return None
+    return stats
+
+
+def compute_asset_stats(db: DB, a: Dict, exact: bool = False, progress: Optional[ProgressFn] = None) -> Dict:
+    """计算波段统计并写入 meta.stats（上传资产写到 blob，同内容的资产共享）。
+
+    结果带内容标识 source，文件变化后自然失效；近似结果不会覆盖已有的精确结果。
+    """
+    source = content_id(db, a["id"])
+    stats = band_stats(raster_source_path(a), exact=exact, progress=progress)
+    stats.update({"source": source, "computed_at": utc_now_iso()})
+    if not exact:
+        current = db.get_asset(a["id"])
+        kept = cached_stats(db, current, exact=True) if current else None
+        if kept is not None:
+            return kept
+    if a.get("blob_sha256"):
+        db.patch_meta({"stats": stats}, blob_sha256=a["blob_sha256"])
+    else:
+        db.patch_meta({"stats": stats}, asset_id=a["id"])
+    return stats
+
+
+def run_stats(params: Dict, ctx: JobContext) -> JobResult:
+    """全量分块扫描计算精确统计（两遍：矩 / 直方图），结果见资产 meta.stats。"""
+    a = _get_raster_asset(ctx, params["asset_id"])
+    compute_asset_stats(ctx.db, a, exact=True, progress=ctx.progress)
+    return JobResult(output_asset_id=a["id"], message="ok")
+
+
+BULK_ACTIONS = ("publish", "unpublish", "delete")
+
+_blob_store: Optional[BlobStore] = None
+
+
+def _blob_store_for(db: DB) -> BlobStore:
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BlobStore(db, data_path("blobs"))
+    return _blob_store
+
+
+def _bulk_item(action: str, a: Dict, params: Dict) -> Dict:
+    """单个资产的批量操作（在线程池中执行，只做 GeoServer I/O，不写数据库、不删本地文件）。"""
+    gs = _geoserver_client()
+    if action == "publish":
+        if a["kind"] not in ("raster", "vector"):
+            raise RuntimeError("unsupported asset kind")
+        return publish_asset_to_geoserver(gs, a)
+    if action == "unpublish":
+        unpublish_asset_from_geoserver(gs, a, params.get("purge", "all"))
+        return {}
+    # delete：先取消发布，失败则保留本地文件与记录；本地文件在记录删除提交后由 _flush_bulk 删除
+    if params.get("unpublish", True):
+        unpublish_asset_from_geoserver(gs, a, params.get("purge", "all"))
+    # 瓦片缓存（内存 + 磁盘）由 API 进程在任务结束后清理（见 main.py 的 on_finish 回调）
+    return {}
+
+
+def _flush_bulk(db: DB, action: str, done: Dict[str, Dict], assets: Dict[str, Dict], params: Dict) -> None:
+    """把成功项的数据库变更合并为一个事务写入。
+
+    delete 先提交记录删除、再删本地文件（释放 blob 引用）：中途被取消/终止/崩溃时最多留下无主文件，
+    不会留下指向已删文件的记录；重试时记录已不存在，也不会重复释放 blob 引用。
+    """
+    if not done:
+        return
+    if action == "publish":
+        db.update_assets_publish_many(
+            [(aid, r["layer"], r["store"], r["external"]) for aid, r in done.items()]
+        )
+    elif action == "unpublish":
+        db.clear_assets_publish_many(list(done))
+    else:
+        db.delete_assets(list(done))
+        if params.get("delete_files", True):
+            for aid in done:
+                remove_asset_files(assets[aid], _blob_store_for(db))
+
+
+def run_bulk(params: Dict, ctx: JobContext) -> JobResult:
+    """批量发布/取消发布/删除资产：有界并发执行，逐项记录结果（job.result.items）。
+
+    单项失败不影响其它项；取消时未开始的项不再执行，已完成项的数据库变更仍会写入。
+    """
+    action = params["action"]
+    if action not in BULK_ACTIONS:
+        raise RuntimeError(f"unsupported bulk action: {action}")
+    asset_ids = list(dict.fromkeys(params.get("asset_ids") or []))
+
+    items: Dict[str, Dict] = {}
+    assets: Dict[str, Dict] = {}
+    for aid in asset_ids:
+        a = ctx.db.get_asset(aid)
+        if a:
+            assets[aid] = a
+        else:
+            items[aid] = {"ok": False, "error": "asset not found"}
+
+    n = len(asset_ids)
+    done: Dict[str, Dict] = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, settings.BULK_WORKERS), thread_name_prefix="bulk")
+    futs: Dict = {}
+    try:
+        futs = {pool.submit(_bulk_item, action, a, params): aid for aid, a in assets.items()}
+        finished = len(items)
+        for fut in as_completed(futs):
+            aid = futs[fut]
+            try:
+                done[aid] = fut.result()
+                items[aid] = {"ok": True, **done[aid]}
+            except Exception as e:
+                items[aid] = {"ok": False, "error": str(e)}
+            finished += 1
+            ctx.progress(finished / n if n else 1.0)
+    except BaseException:
+        for f in futs:
+            f.cancel()
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        # 取消时仍在执行的项已经改动了 GeoServer/文件，需要一并记账
+        for f, aid in futs.items():
+            if aid not in done and f.done() and not f.cancelled() and f.exception() is None:
+                done[aid] = f.result()
+        _flush_bulk(ctx.db, action, done, assets, params)
+
+    ok = sum(1 for r in items.values() if r["ok"])
+    result = {"action": action, "items": {aid: items[aid] for aid in asset_ids}}
+    return JobResult(message=f"{action}: {ok}/{n} ok", result=result)
+
+
+HANDLERS: Dict[str, Callable[[Dict, JobContext], JobResult]] = {
+    "calc": run_calc,
+    "fuse": run_fuse,
+    "cog": run_cog,
+    "publish": run_publish,
+    "bulk": run_bulk,
+    "stats": run_stats,
+}
+
+
+# ---- 内存估算（MB，入队时计算，供调度准入）：按资产元信息粗估峰值占用 ----
+
+_MB = 1 << 20
+# GDAL 块缓存、VRT 重采样缓冲等固定开销
+_BASE_OVERHEAD_MB = 256
+_WARP_MEMORY_MB = 512
+
+
+def _asset_shape(db: DB, asset_id: str) -> Tuple[int, int, int]:
+    a = db.get_asset(asset_id)
+    meta = (a or {}).get("meta") or {}
+    return int(meta.get("xsize") or 0), int(meta.get("ysize") or 0), int(meta.get("bands") or 0)
+
+
+def estimate_calc_mb(params: Dict, db: DB) -> int:
+    # 每个输入一个 float64 窗口，另算表达式中间结果与输出缓冲
+    n = len(params.get("inputs") or {})
+    block_bytes = settings.CALC_BLOCK_PIXELS * 8
+    return _BASE_OVERHEAD_MB + (n + 3) * block_bytes // _MB + max(n - 1, 0) * _WARP_MEMORY_MB
+
+
+def estimate_fuse_mb(params: Dict, db: DB) -> int:
+    # 拟合阶段分块累加（块内存有界，另有 B^2 的累加器）；低分辨率 RGB 在 /vsimem 里；
+    # 输出阶段每个 worker 一组瓦片缓冲
+    w, h, b = _asset_shape(db, params["hs"])
+    fit_bytes = w * h * 3 * 4 + settings.CALC_BLOCK_PIXELS * 8 * 4 + b * b * 8 * 2
+    tile_bytes = settings.FUSE_WORKERS * (b + 9) * 256 * 256 * 4
+    return _BASE_OVERHEAD_MB + _WARP_MEMORY_MB + (fit_bytes + tile_bytes) // _MB
+
+
+def estimate_cog_mb(params: Dict, db: DB) -> int:
+    # COG 驱动逐块拷贝并生成金字塔，占用基本是 GDAL 缓存
+    return _BASE_OVERHEAD_MB
+
+
+def estimate_stats_mb(params: Dict, db: DB) -> int:
+    # 每个窗口按 float64 读一个波段，外加细直方图
+    return _BASE_OVERHEAD_MB + (settings.CALC_BLOCK_PIXELS * 8 >> 20) * 3
+
+
+ESTIMATORS: Dict[str, Callable[[Dict, DB], int]] = {
+    "calc": estimate_calc_mb,
+    "fuse": estimate_fuse_mb,
+    "cog": estimate_cog_mb,
+    "stats": estimate_stats_mb,
+}
+
+
+# ---- 结果缓存键：输入内容标识 + 规范化参数（out_name 不参与，命中时直接复用已有输出） ----
+
+# 算法版本：计算逻辑变化导致结果不同时递增，使旧缓存自然失效
+_CACHE_VERSIONS = {"calc": 1, "fuse": 4}
+
+
+def content_id(db: DB, asset_id: str) -> Optional[str]:
+    """资产内容标识：上传文件用 blob sha256，其他文件用 路径 + mtime + 大小。"""
+    a = db.get_asset(asset_id)
+    if not a:
+        return None
+    if a.get("blob_sha256"):
+        return f"sha256:{a['blob_sha256']}"
+    try:
+        st = os.stat(a["path"])
+    except OSError:
+        return None
+    return f"file:{a['path']}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def _digest(kind: str, payload: Dict) -> str:
+    body = json.dumps({"kind": kind, "v": _CACHE_VERSIONS[kind], **payload}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def calc_cache_key(params: Dict, db: DB) -> Optional[str]:
+    inputs = params.get("inputs") or {}
+    bands = params.get("bands") or {}
+    content = {var: content_id(db, aid) for var, aid in inputs.items()}
+    if not content or None in content.values():
+        return None
+    nodata = params.get("nodata")
+    return _digest("calc", {
+        "inputs": content,
+        "bands": {var: int(bands.get(var, 1)) for var in inputs},
+        # 表达式按 AST 规范化：空白、多余括号、引号风格不影响命中
+        "expr": ast.unparse(ast.parse(params["expr"].strip(), mode="eval")),
+        "out_dtype": params.get("out_dtype", "Float32"),
+        "nodata": None if nodata is None else float(nodata),
+    })
+
+
+def fuse_cache_key(params: Dict, db: DB) -> Optional[str]:
+    hs, rgb = content_id(db, params["hs"]), content_id(db, params["rgb"])
+    if hs is None or rgb is None:
+        return None
+    return _digest("fuse", {
+        "hs": hs,
+        "rgb": rgb,
+        "alpha": float(params.get("alpha", 1.0)),
+        "lambda": float(params.get("lambda", 1e-3)),
+        "max_samples": int(params.get("max_samples", 200_000)),
+        "out_dtype": params.get("out_dtype", "Byte"),
+    })
+
+
+CACHE_KEYS: Dict[str, Callable[[Dict, DB], Optional[str]]] = {
+    "calc": calc_cache_key,
+    "fuse": fuse_cache_key,
+}
@@ -0,0 +1,438 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from osgeo import gdal, osr
+
+from dscache import GridInfo, grid_info, open_dataset
+
+# 直接从资产渲染 XYZ 瓦片（EPSG:3857，256x256 PNG），不经过 GeoServer。
+# 缩小显示时 gdal.Warp 默认（-ovr AUTO）会选用合适层级的 overview，配合 COG 内部金字塔读取量很小。
+
+TILE_SIZE = 256
+MAX_ZOOM = 24
+_WEB_MERCATOR_HALF = 20037508.342789244
+# 渲染逻辑变化时递增，使磁盘缓存与 ETag 一并失效
+_RENDER_VERSION = 2
+
+_RESAMPLING = {
+    "nearest": "near",
+    "bilinear": "bilinear",
+    "cubic": "cubic",
+    "average": "average",
+}
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """XYZ 瓦片在 EPSG:3857 下的范围 (minx, miny, maxx, maxy)。"""
+    span = 2 * _WEB_MERCATOR_HALF / (1 << z)
+    minx = -_WEB_MERCATOR_HALF + x * span
+    maxy = _WEB_MERCATOR_HALF - y * span
+    return minx, maxy - span, minx + span, maxy
+
+
+def source_id(path: str) -> str:
+    """源文件标识：路径 + mtime + 大小（文件被替换后自然变化）。"""
+    st = os.stat(path)
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+
+@dataclass(frozen=True)
+class TileRequest:
+    path: str
+    source_id: str
+    z: int
+    x: int
+    y: int
+    bands: Optional[Tuple[int, ...]]  # None = 自动（>=3 波段取 1,2,3，否则 1）
+    vmin: Optional[Tuple[float, ...]]  # None = 按波段统计自动拉伸
+    vmax: Optional[Tuple[float, ...]]
+    resampling: str
+    # 未给 vmin/vmax 时的默认拉伸：已保存统计里各波段的 2%/98% 分位数 ((band, lo, hi), ...)；None = 现算 min/max
+    stats_ranges: Optional[Tuple[Tuple[int, float, float], ...]] = None
+
+    @property
+    def key(self) -> str:
+        """缓存键（同时作为 ETag）：源文件标识 + 瓦片坐标 + 渲染参数（含默认拉伸区间）。"""
+        body = "|".join(
+            str(v)
+            for v in (
+                _RENDER_VERSION, self.source_id, self.z, self.x, self.y,
+                self.bands, self.vmin, self.vmax, self.resampling, self.stats_ranges,
+            )
+        )
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+
+
+def _parse_floats(s: Optional[str], name: str) -> Optional[Tuple[float, ...]]:
+    if s is None or s.strip() == "":
+        return None
+    try:
+        return tuple(float(v) for v in s.split(","))
+    except ValueError:
+        raise ValueError(f"invalid {name}: {s}")
+
+
+def parse_tile_request(
+    path: str,
+    z: int,
+    x: int,
+    y: int,
+    bands: Optional[str] = None,
+    vmin: Optional[str] = None,
+    vmax: Optional[str] = None,
+    resampling: str = "bilinear",
+    stats: Optional[Dict] = None,
+) -> TileRequest:
+    """校验并规范化瓦片请求参数；参数非法时抛 ValueError。
+
+    stats 为资产已保存的波段统计（meta.stats），有时默认拉伸用其中的 2%/98% 分位数。
+    """
+    if not (0 <= z <= MAX_ZOOM) or not (0 <= x < (1 << z)) or not (0 <= y < (1 << z)):
+        raise ValueError(f"invalid tile: {z}/{x}/{y}")
+    band_list = None
+    if bands is not None and bands.strip() != "":
+        try:
+            band_list = tuple(int(b) for b in bands.split(","))
+        except ValueError:
+            raise ValueError(f"invalid bands: {bands}")
+        if len(band_list) not in (1, 3) or min(band_list) < 1:
+            raise ValueError("bands must be 1 or 3 band indexes (1-based)")
+    lo, hi = _parse_floats(vmin, "vmin"), _parse_floats(vmax, "vmax")
+    if (lo is None) != (hi is None):
+        raise ValueError("vmin and vmax must be given together")
+    if lo is not None and len(lo) != len(hi):
+        raise ValueError("vmin and vmax must have the same length")
+    if resampling not in _RESAMPLING:
+        raise ValueError(f"unsupported resampling: {resampling}")
+    ranges = stats_ranges(stats) if lo is None else None
+    return TileRequest(path, source_id(path), z, x, y, band_list, lo, hi, resampling, ranges)
+
+
+def stats_ranges(stats: Optional[Dict]) -> Optional[Tuple[Tuple[int, float, float], ...]]:
+    """波段统计 -> 各波段默认拉伸区间 (band, p2, p98)；没有可用分位数的波段跳过。"""
+    if not stats:
+        return None
+    out = []
+    for b in stats.get("bands") or []:
+        p = b.get("percentiles") or {}
+        if p.get("2") is not None and p.get("98") is not None:
+            out.append((int(b["band"]), float(p["2"]), float(p["98"])))
+    return tuple(out) or None
+
+
+class _SourceInfo:
+    """每个源文件只算一次的信息：EPSG:3857 范围、各波段默认拉伸区间。"""
+
+    def __init__(self, grid: GridInfo):
+        self.band_count = grid.band_count
+        self.bounds_3857 = _dataset_bounds(grid, 3857)
+        self._ranges: Dict[int, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def band_range(self, ds: gdal.Dataset, band: int) -> Optional[Tuple[float, float]]:
+        """波段默认拉伸区间；波段全是 nodata（GDAL 算不出 min/max）时为 None。"""
+        with self._lock:
+            if band in self._ranges:
+                return self._ranges[band]
+        b = ds.GetRasterBand(band)
+        if b.DataType == gdal.GDT_Byte:
+            r: Optional[Tuple[float, float]] = (0.0, 255.0)
+        else:
+            # 近似 min/max：有 overview 时只读 overview
+            try:
+                lo, hi = b.ComputeRasterMinMax(True)
+                r = (float(lo), float(hi))
+            except RuntimeError:
+                r = None
+        with self._lock:
+            self._ranges[band] = r
+        return r
+
+
+def _dataset_bounds(grid: GridInfo, epsg: int) -> Optional[Tuple[float, float, float, float]]:
+    """数据集范围变换到 epsg 下的外包框；无地理参考或变换失败时返回 None。"""
+    gt = grid.geotransform
+    wkt = grid.projection
+    if gt is None or not wkt:
+        return None
+    xs = [gt[0], gt[0] + gt[1] * grid.xsize + gt[2] * grid.ysize]
+    ys = [gt[3], gt[3] + gt[4] * grid.xsize + gt[5] * grid.ysize]
+    src = osr.SpatialReference()
+    src.ImportFromWkt(wkt)
+    dst = osr.SpatialReference()
+    dst.ImportFromEPSG(epsg)
+    for s in (src, dst):
+        s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    try:
+        ct = osr.CoordinateTransformation(src, dst)
+        b = ct.TransformBounds(min(xs), min(ys), max(xs), max(ys), 21)
+    except RuntimeError:
+        return None
+    if not all(math.isfinite(v) for v in b):
+        return None
+    return tuple(b)
+
+
+class TileCache:
+    """两级瓦片缓存：按字节数限额的内存 LRU + 磁盘目录 <root>/<asset_id>/<key>.png。
+
+    磁盘层超过 max_disk_bytes（0 = 不限制）时按 mtime 淘汰最旧的文件到上限的 90%；
+    磁盘命中会刷新 mtime，因此近似 LRU。
+    """
+
+    # 磁盘淘汰后保留的比例，避免每写一个瓦片都触发一次全目录扫描
+    _DISK_LOW_WATER = 0.9
+
+    def __init__(self, root: str, max_bytes: int, disk: bool = True, max_disk_bytes: int = 0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.max_disk_bytes = max_disk_bytes
+        self._mem: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = self._scan_disk()[1] if disk and max_disk_bytes > 0 else 0
+
+    def _disk_path(self, asset_id: str, key: str) -> str:
+        return os.path.join(self.root, asset_id, f"{key}.png")
+
+    def get(self, asset_id: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get((asset_id, key))
+            if data is not None:
+                self._mem.move_to_end((asset_id, key))
+                return data
+        if not self.disk:
+            return None
+        path = self._disk_path(asset_id, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if self.max_disk_bytes > 0:
+                os.utime(path)
+        except OSError:
+            return None
+        self._put_mem(asset_id, key, data)
+        return data
+
+    def put(self, asset_id: str, key: str, data: bytes) -> None:
+        self._put_mem(asset_id, key, data)
+        if not self.disk:
+            return
+        path = self._disk_path(asset_id, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        if self.max_disk_bytes > 0:
+            with self._lock:
+                self._disk_bytes += len(data)
+                over = self._disk_bytes > self.max_disk_bytes
+            if over:
+                self._prune_disk()
+
+    def _scan_disk(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        """磁盘缓存中的全部瓦片 [(mtime, size, path)] 与总字节数。"""
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files, sum(f[1] for f in files)
+
+    def _prune_disk(self) -> None:
+        """淘汰最旧的磁盘瓦片到上限的 90%；已有线程在淘汰时直接返回。"""
+        if not self._disk_lock.acquire(blocking=False):
+            return
+        try:
+            files, total = self._scan_disk()
+            target = self.max_disk_bytes * self._DISK_LOW_WATER
+            files.sort()
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            with self._lock:
+                self._disk_bytes = total
+        finally:
+            self._disk_lock.release()
+
+    def _put_mem(self, asset_id: str, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._mem.pop((asset_id, key), None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._mem[(asset_id, key)] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._mem.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def invalidate(self, asset_id: str) -> None:
+        """删除某资产的全部缓存瓦片（资产删除时调用）。"""
+        with self._lock:
+            for k in [k for k in self._mem if k[0] == asset_id]:
+                self._bytes -= len(self._mem.pop(k))
+        if self.disk:
+            shutil.rmtree(os.path.join(self.root, asset_id), ignore_errors=True)
+            # 删掉的字节数不单独统计，下次淘汰时按实际扫描结果校正
+
+
+class TileRenderer:
+    """按 TileRequest 渲染 PNG 瓦片；源文件信息按 source_id 做 LRU 缓存（上限 max_sources 条）。"""
+
+    def __init__(self, max_sources: int = 256):
+        self.max_sources = max_sources
+        self._sources: "OrderedDict[str, _SourceInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._empty: Optional[bytes] = None
+
+    def _source(self, req: TileRequest) -> _SourceInfo:
+        with self._lock:
+            info = self._sources.get(req.source_id)
+            if info is not None:
+                self._sources.move_to_end(req.source_id)
+                return info
+        info = _SourceInfo(grid_info(req.path))
+        with self._lock:
+            self._sources[req.source_id] = info
+            while len(self._sources) > self.max_sources:
+                self._sources.popitem(last=False)
+        return info
+
+    def empty_tile(self) -> bytes:
+        """全透明瓦片（范围外/全是 nodata）。"""
+        if self._empty is None:
+            self._empty = _encode_png(np.zeros((2, TILE_SIZE, TILE_SIZE), dtype=np.uint8))
+        return self._empty
+
+    def render(self, req: TileRequest) -> bytes:
+        info = self._source(req)
+
+        bands = req.bands or ((1, 2, 3) if info.band_count >= 3 else (1,))
+        if max(bands) > info.band_count:
+            raise ValueError(f"band index out of range (raster has {info.band_count} bands)")
+        if req.vmin is not None and len(req.vmin) not in (1, len(bands)):
+            raise ValueError("vmin/vmax must have 1 value or one per band")
+
+        minx, miny, maxx, maxy = tile_bounds(req.z, req.x, req.y)
+        b = info.bounds_3857
+        if b is not None and (b[0] >= maxx or b[2] <= minx or b[1] >= maxy or b[3] <= miny):
+            return self.empty_tile()
+
+        # 句柄从共享池借出：VRT/warp 都引用它，必须在 with 内用完
+        with open_dataset(req.path) as ds:
+            src = ds if list(bands) == list(range(1, ds.RasterCount + 1)) else gdal.Translate(
+                "", ds, options=gdal.TranslateOptions(format="VRT", bandList=list(bands))
+            )
+            warped = gdal.Warp(
+                "",
+                src,
+                options=gdal.WarpOptions(
+                    format="MEM",
+                    outputBounds=(minx, miny, maxx, maxy),
+                    width=TILE_SIZE,
+                    height=TILE_SIZE,
+                    dstSRS="EPSG:3857",
+                    resampleAlg=_RESAMPLING[req.resampling],
+                    outputType=gdal.GDT_Float32,
+                    dstAlpha=True,
+                ),
+            )
+            if warped is None:
+                raise RuntimeError("tile warp failed")
+            arr = warped.ReadAsArray()  # (nb + 1, H, W)，最后一个是 alpha
+            warped = src = None  # VRT 引用借出的句柄，归还前先释放
+            alpha = arr[-1]
+            if not np.any(alpha > 0):
+                return self.empty_tile()
+
+            stats = {b: (lo, hi) for b, lo, hi in req.stats_ranges or ()}
+            out = np.empty((len(bands) + 1, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+            for i, band in enumerate(bands):
+                if req.vmin is not None:
+                    j = i if len(req.vmin) > 1 else 0
+                    lo, hi = req.vmin[j], req.vmax[j]
+                else:
+                    r = stats.get(band) or info.band_range(ds, band)
+                    if r is None:
+                        return self.empty_tile()
+                    lo, hi = r
+                scale = 255.0 / (hi - lo) if hi > lo else 0.0
+                v = arr[i]
+                v -= lo
+                v *= scale
+                np.clip(v, 0, 255, out=v)
+                np.rint(v, out=v)
+                out[i] = v
+            out[-1] = np.where(alpha > 0, 255, 0)
+            return _encode_png(out)
+
+
+def _encode_png(arr: np.ndarray) -> bytes:
+    """(bands, H, W) uint8 数组编码为 PNG（2 波段 = 灰度 + alpha，4 波段 = RGBA）。"""
+    nb, h, w = arr.shape
+    mem = gdal.GetDriverByName("MEM").Create("", w, h, nb, gdal.GDT_Byte)
+    mem.WriteArray(arr, band_list=list(range(1, nb + 1)))
+    path = f"/vsimem/rasterops_tile_{uuid.uuid4().hex}.png"
+    try:
+        gdal.GetDriverByName("PNG").CreateCopy(path, mem)
+        return _read_vsimem(path)
+    finally:
+        gdal.Unlink(path)
+
+
+def _read_vsimem(path: str) -> bytes:
+    f = gdal.VSIFOpenL(path, "rb")
+    if f is None:
+        raise RuntimeError(f"Cannot read {path}")
+    try:
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        return bytes(gdal.VSIFReadL(1, size, f))
+    finally:
+        gdal.VSIFCloseL(f)
+
+
+def tilejson(path: str, tiles_url: str) -> Dict:
+    """TileJSON 2.2：经纬度范围 + 与原始分辨率匹配的最大缩放级别，供前端定位。"""
+    grid = grid_info(path)
+    out: Dict = {"tilejson": "2.2.0", "tiles": [tiles_url], "minzoom": 0, "maxzoom": 18}
+    lonlat = _dataset_bounds(grid, 4326)
+    if lonlat is not None:
+        out["bounds"] = list(lonlat)
+    merc = _dataset_bounds(grid, 3857)
+    if merc is not None and grid.xsize > 0:
+        res = (merc[2] - merc[0]) / grid.xsize
+        if res > 0:
+            z = math.ceil(math.log2(2 * _WEB_MERCATOR_HALF / (TILE_SIZE * res)))
+            out["maxzoom"] = int(min(max(z, 0), MAX_ZOOM))
+    return out
+
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from typing import Optional, Sequence
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from blobstore import BlobStore, BlobTooLarge, BlobWriter
+from config import settings
+
+# 直接解析请求体里的 multipart 流，把文件字段写进 blob 临时目录：
+# 不经过 Starlette 的 SpooledTemporaryFile（避免整份内容先落一次系统临时目录），
+# 大小上限在收到字节时就检查，Content-Length 明显超限时不读请求体直接拒绝。
+
+# multipart 边界与各段头部的额外开销（Content-Length 预检时放宽的字节数）
+_MULTIPART_OVERHEAD = 64 << 10
+
+
+class UploadedFile:
+    """已写入 blob 临时目录的上传文件（交给 BlobStore.ingest_written 入库）。"""
+
+    def __init__(self, filename: str, tmp_path: str, size: int, sha256: str):
+        self.filename = filename
+        self.tmp_path = tmp_path
+        self.size = size
+        self.sha256 = sha256
+
+
+def check_content_length(request: Request) -> None:
+    """Content-Length 已超过上限时直接抛 BlobTooLarge（不读请求体）。"""
+    length = request.headers.get("content-length")
+    if settings.UPLOAD_MAX_BYTES <= 0 or not length or not length.isdigit():
+        return
+    if int(length) > settings.UPLOAD_MAX_BYTES + _MULTIPART_OVERHEAD:
+        raise BlobTooLarge(f"文件超过上限 {settings.UPLOAD_MAX_BYTES} 字节")
+
+
+class _FilePartParser:
+    """MultipartParser 回调：只收集名为 field 的文件段，数据按 UPLOAD_CHUNK_BYTES 攒批后写出。"""
+
+    def __init__(self, blob_store: BlobStore, field: str, allowed_exts: Sequence[str]):
+        self.blob_store = blob_store
+        self.field = field
+        self.allowed_exts = tuple(allowed_exts)
+        self.filename: Optional[str] = None
+        self.writer: Optional[BlobWriter] = None
+        self.pending = bytearray()
+        self.done = False
+        self._in_target = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: dict = {}
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+        self._in_target = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, params = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if params.get(b"name", b"").decode("utf-8", "replace") != self.field or b"filename" not in params:
+            return
+        if self.writer is not None:
+            raise ValueError(f"只能上传一个 {self.field} 文件")
+        filename = params[b"filename"].decode("utf-8", "replace") or "upload"
+        # 在收到文件内容之前校验扩展名
+        if not filename.lower().endswith(self.allowed_exts):
+            raise ValueError("仅支持 " + " / ".join(self.allowed_exts))
+        self.filename = filename
+        self.writer = self.blob_store.writer()
+        self._in_target = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_target:
+            self.pending += data[start:end]
+            if settings.UPLOAD_MAX_BYTES > 0 and self.writer.size + len(self.pending) > settings.UPLOAD_MAX_BYTES:
+                raise BlobTooLarge(f"文件超过上限 {settings.UPLOAD_MAX_BYTES} 字节")
+
+    def _on_part_end(self) -> None:
+        if self._in_target:
+            self.done = True
+            self._in_target = False
+
+    def take_pending(self) -> bytes:
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+
+async def receive_upload(
+    request: Request,
+    blob_store: BlobStore,
+    field: str = "file",
+    allowed_exts: Sequence[str] = (),
+) -> UploadedFile:
+    """流式接收 multipart/form-data 里的文件字段，写入 blob 临时目录。
+
+    请求格式不对、缺少文件字段或扩展名不在 allowed_exts 时抛 ValueError，超过上限抛 BlobTooLarge；
+    出错（包括客户端断开）时删除已写的临时文件。
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("需要 multipart/form-data 上传")
+    check_content_length(request)
+
+    part = _FilePartParser(blob_store, field, allowed_exts)
+    parser = MultipartParser(boundary, part.callbacks())
+    try:
+        async for chunk in request.stream():
+            if part.done:
+                break  # 文件段之后的内容（结束边界等）不再需要
+            parser.write(chunk)
+            if part.writer is not None and (part.done or len(part.pending) >= settings.UPLOAD_CHUNK_BYTES):
+                await run_in_threadpool(part.writer.write, part.take_pending())
+        if part.writer is None or not part.done:
+            raise ValueError(f"缺少上传文件字段 {field}")
+        tmp_path, size, sha256 = await run_in_threadpool(part.writer.finish)
+    except BaseException:
+        if part.writer is not None:
+            part.writer.abort()
+        raise
+    return UploadedFile(part.filename, tmp_path, size, sha256)
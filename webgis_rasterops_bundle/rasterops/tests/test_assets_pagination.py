@@ -0,0 +1,74 @@
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+from db import DB  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path / "db" / "rasterops.sqlite"))
+    # 同一时刻创建多个资产：翻页必须靠 id 打破平局，不能重复或遗漏
+    for i in range(9):
+        db.insert_asset(
+            {
+                "id": f"a{i}",
+                "filename": f"{'dem' if i % 2 else 'ndvi'}_{i}.tif",
+                "kind": "upload" if i < 6 else "derived",
+                "path": f"/x/a{i}.tif",
+                "created_at": f"2024-01-0{1 + i // 3}T00:00:00+00:00",
+                "meta": {"i": i},
+            }
+        )
+    return db
+
+
+def _all_pages(db, limit, **filters):
+    ids, cursor, pages = [], None, 0
+    while True:
+        items, cursor = db.list_assets(limit=limit, cursor=cursor, **filters)
+        ids += [a["id"] for a in items]
+        pages += 1
+        if cursor is None:
+            return ids, pages
+
+
+def test_pages_cover_all_assets_in_order(db):
+    everything, next_cursor = db.list_assets()
+    assert next_cursor is None
+    expected = [a["id"] for a in everything]
+    assert expected == ["a8", "a7", "a6", "a5", "a4", "a3", "a2", "a1", "a0"]
+
+    for limit in (1, 2, 3, 4, 9):
+        ids, pages = _all_pages(db, limit)
+        assert ids == expected
+        assert pages == -(-len(expected) // limit)
+
+
+def test_filters_combine_with_cursor(db):
+    db.update_asset_publish("a1", "ws:a1", "st_a1")
+
+    assert _all_pages(db, 2, kind="upload")[0] == ["a5", "a4", "a3", "a2", "a1", "a0"]
+    assert _all_pages(db, 2, prefix="dem_")[0] == ["a7", "a5", "a3", "a1"]
+    assert _all_pages(db, 2, published=True)[0] == ["a1"]
+    assert "a1" not in _all_pages(db, 2, published=False)[0]
+    ids, _ = _all_pages(db, 2, created_from="2024-01-02T00:00:00+00:00", created_to="2024-01-03T00:00:00+00:00")
+    assert ids == ["a5", "a4", "a3"]
+
+
+def test_slim_listing_omits_meta(db):
+    items, _ = db.list_assets(limit=1)
+    assert items[0]["meta"] == {"i": 8}
+    items, _ = db.list_assets(limit=1, slim=True)
+    assert items[0]["id"] == "a8"
+    assert items[0]["meta"] is None
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "bm90IGpzb24", "WzFd"])
+def test_invalid_cursor(db, cursor):
+    with pytest.raises(ValueError):
+        db.list_assets(limit=2, cursor=cursor)
@@ -0,0 +1,79 @@
+import hashlib
+import io
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+from blobstore import BlobStore, BlobTooLarge  # noqa: E402
+from config import settings  # noqa: E402
+from db import DB  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    db = DB(str(tmp_path / "db" / "rasterops.sqlite"))
+    return BlobStore(db, str(tmp_path / "blobs"))
+
+
+def _tmp_files(store):
+    return os.listdir(os.path.join(store.root, "tmp"))
+
+
+def test_ingest_dedups_by_content(store):
+    data = b"raster bytes" * 100
+    blob, created = store.ingest(io.BytesIO(data), ".tif")
+    assert created
+    assert blob["sha256"] == hashlib.sha256(data).hexdigest()
+    assert blob["size_bytes"] == len(data)
+    with open(blob["path"], "rb") as f:
+        assert f.read() == data
+
+    again, created = store.ingest(io.BytesIO(data), ".tif")
+    assert not created
+    assert again["path"] == blob["path"]
+    assert store.db.get_blob(blob["sha256"])["refcount"] == 2
+    assert _tmp_files(store) == []
+
+
+def test_release_removes_blob_with_last_reference(store):
+    blob, _ = store.ingest(io.BytesIO(b"abc"), ".tif")
+    store.ingest(io.BytesIO(b"abc"), ".tif")
+
+    store.release(blob["sha256"])
+    assert store.db.get_blob(blob["sha256"])["refcount"] == 1
+    assert os.path.exists(blob["path"])
+
+    store.release(blob["sha256"])
+    assert store.db.get_blob(blob["sha256"]) is None
+    assert not os.path.exists(os.path.dirname(blob["path"]))
+    assert _tmp_files(store) == []
+
+    # 释放后同一内容可以重新入库
+    blob, created = store.ingest(io.BytesIO(b"abc"), ".tif")
+    assert created
+    assert os.path.exists(blob["path"])
+
+
+def test_leftover_tombstones_are_removed_on_startup(store):
+    tomb = os.path.join(store.root, "tmp", ".deleted_abc_123")
+    os.makedirs(tomb)
+    open(os.path.join(tomb, "data.tif"), "wb").close()
+
+    BlobStore(store.db, store.root)
+    assert not os.path.exists(tomb)
+
+
+def test_ingest_rejects_oversized_content(store, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_BYTES", 16)
+    monkeypatch.setattr(settings, "UPLOAD_CHUNK_BYTES", 4)
+    with pytest.raises(BlobTooLarge):
+        store.ingest(io.BytesIO(b"x" * 17), ".tif")
+    assert _tmp_files(store) == []
+
+    blob, created = store.ingest(io.BytesIO(b"x" * 16), ".tif")
+    assert created
+    assert blob["size_bytes"] == 16
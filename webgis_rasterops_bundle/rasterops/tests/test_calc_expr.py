@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+from gdalops import compile_calc_expr  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "expr",
+    [
+        "A + 9**9**9**9",
+        "A * (1 | 2) ** (9 ** 9 ** 9)",
+        "A + ((1 < 2) + 8) ** ((1 < 2) + 8) ** ((1 < 2) + 8) ** ((1 < 2) + 8)",
+        "A + 10**300 * 10**300",
+    ],
+)
+def test_huge_constant_expressions_are_rejected(expr):
+    with pytest.raises(ValueError):
+        compile_calc_expr(expr, ["A"])
+
+
+@pytest.mark.parametrize(
+    "expr",
+    ["1 << 5", "A + (2 >> 1)", "A + (1 @ 2)", "A + (1 is 2)", "A + (1 in 2)", "A + ('x' + 'y')"],
+)
+def test_unsupported_constant_operators_are_validation_errors(expr):
+    # 回归：纯常量估算遇到白名单外的运算符时不能抛 KeyError（接口会变成 500）
+    with pytest.raises(ValueError):
+        compile_calc_expr(expr, ["A"])
+
+
+def test_huge_power_does_not_hang():
+    # 回归：校验必须在编译阶段失败，而不是让 worker 卡在 eval 里
+    code = f"import sys; sys.path.insert(0, {APP_DIR!r}); from gdalops import compile_calc_expr as c\n" \
+        "try:\n    c('A + 9**9**9**9', ['A'])\nexcept ValueError:\n    sys.exit(0)\nsys.exit(1)"
+    assert subprocess.run([sys.executable, "-c", code], timeout=30).returncode == 0
+
+
+def test_ordinary_expressions_still_work():
+    f = compile_calc_expr("(A & 8) > 0", ["A"])
+    assert f({"A": np.array([8, 1])}).tolist() == [True, False]
+    f = compile_calc_expr("A * 2**10 + numpy.sqrt(B)", ["A", "B"])
+    assert f({"A": np.array([1.0]), "B": np.array([4.0])}).tolist() == [1026.0]
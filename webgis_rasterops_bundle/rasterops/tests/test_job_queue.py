@@ -0,0 +1,312 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+from config import settings  # noqa: E402
+from db import DB, utc_now_iso  # noqa: E402
+from jobs import TERMINAL_STATUSES, JobManager, JobResult  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    return DB(str(tmp_path / "db" / "rasterops.sqlite"))
+
+
+def _insert_job(db, job_id, kind="calc", priority=0, mem_mb=0, created_at=None):
+    now = created_at or utc_now_iso()
+    db.insert_job(
+        {
+            "id": job_id,
+            "kind": kind,
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "params": {},
+            "priority": priority,
+            "mem_mb": mem_mb,
+        }
+    )
+
+
+def _insert_asset(db, asset_id):
+    db.insert_asset(
+        {
+            "id": asset_id,
+            "filename": f"{asset_id}.tif",
+            "kind": "derived",
+            "path": f"/x/{asset_id}.tif",
+            "created_at": utc_now_iso(),
+        }
+    )
+
+
+def _wait_terminal(db, job_id, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = db.get_job(job_id)
+        if job["status"] in TERMINAL_STATUSES:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish: {db.get_job(job_id)}")
+
+
+# ---------- DB 层：取任务、恢复、取消 ----------
+
+
+def test_claim_next_job_orders_by_priority_then_fifo(db):
+    _insert_job(db, "low", priority=-5, created_at="2024-01-01T00:00:00+00:00")
+    _insert_job(db, "first", priority=10, created_at="2024-01-01T00:00:01+00:00")
+    _insert_job(db, "second", priority=10, created_at="2024-01-01T00:00:02+00:00")
+
+    order = [db.claim_next_job()["id"] for _ in range(3)]
+    assert order == ["first", "second", "low"]
+    assert db.claim_next_job() is None
+    job = db.get_job("first")
+    assert job["status"] == "running"
+    assert job["attempts"] == 1
+
+
+def test_claim_next_job_respects_kind_and_memory_filters(db):
+    _insert_job(db, "busy", kind="fuse", priority=10)
+    _insert_job(db, "big", kind="calc", priority=5, mem_mb=900)
+    _insert_job(db, "small", kind="calc", priority=0, mem_mb=100)
+
+    assert db.claim_next_job(exclude_kinds=["fuse"], max_mem_mb=500)["id"] == "small"
+    assert db.claim_next_job(exclude_kinds=["fuse"], max_mem_mb=500) is None
+    assert db.claim_next_job(exclude_kinds=["fuse"])["id"] == "big"
+    assert db.claim_next_job()["id"] == "busy"
+
+
+def test_recover_orphaned_jobs(db):
+    for job_id in ("exhausted", "retry", "cancel"):
+        _insert_job(db, job_id)
+    # exhausted 已经跑过一次：再次领取后 attempts 达到上限
+    db.claim_next_job()
+    db.update_job("exhausted", status="queued")
+    db.claim_next_job()
+    db.claim_next_job()
+    db.claim_next_job()
+    db.request_job_cancel("cancel")
+
+    attempts = {j: db.get_job(j)["attempts"] for j in ("exhausted", "retry", "cancel")}
+    assert attempts == {"exhausted": 2, "retry": 1, "cancel": 1}
+
+    orphaned = db.recover_orphaned_jobs(max_attempts=2)
+    assert sorted(orphaned) == ["cancel", "exhausted", "retry"]
+    assert db.get_job("exhausted")["status"] == "error"
+    assert "max attempts" in db.get_job("exhausted")["message"]
+    assert db.get_job("retry")["status"] == "queued"
+    assert db.get_job("retry")["progress"] == 0
+    assert db.get_job("cancel")["status"] == "cancelled"
+    assert db.recover_orphaned_jobs(max_attempts=2) == []
+
+
+def test_request_job_cancel(db):
+    _insert_job(db, "queued")
+    _insert_job(db, "running", priority=1)
+    db.claim_next_job()
+
+    assert db.request_job_cancel("queued")["status"] == "cancelled"
+    job = db.request_job_cancel("running")
+    assert job["status"] == "running"
+    assert job["cancel_requested"] is True
+    assert db.is_job_cancel_requested("running")
+    assert db.request_job_cancel("missing") is None
+
+
+def test_requeue_interrupted_job(db):
+    _insert_job(db, "j")
+    db.claim_next_job()
+    job = db.requeue_interrupted_job("j", max_attempts=2, message="worker died")
+    assert job["status"] == "queued"
+    assert job["message"] == "worker died"
+
+    db.claim_next_job()
+    job = db.requeue_interrupted_job("j", max_attempts=2, message="worker died")
+    assert job["status"] == "error"
+    assert job["message"] == "worker died (max attempts reached)"
+
+
+def test_cached_output_is_invalidated_with_its_asset(db):
+    _insert_asset(db, "out")
+    db.put_cached_output("key", "calc", "out")
+    assert db.get_cached_output("key") == "out"
+    assert db.get_cached_output("other") is None
+
+    db.delete_asset("out")
+    assert db.get_cached_output("key") is None
+
+
+# ---------- JobManager（线程后端） ----------
+
+
+class _Concurrency:
+    """记录同时运行的任务数峰值；任务在 gate 打开前阻塞。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+        self.gate = threading.Event()
+
+    def handler(self, params, ctx):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        try:
+            self.gate.wait(5)
+            time.sleep(0.05)
+        finally:
+            with self.lock:
+                self.current -= 1
+        return JobResult(message="ok")
+
+
+@pytest.fixture
+def make_manager(db):
+    managers = []
+
+    def _make(handlers, **kwargs):
+        m = JobManager(db, handlers, **kwargs)
+        managers.append(m)
+        return m
+
+    yield _make
+    for m in managers:
+        m.stop()
+
+
+def test_kind_limit_caps_concurrency(db, make_manager):
+    c = _Concurrency()
+    m = make_manager({"calc": c.handler}, max_workers=3, kind_limits={"calc": 1})
+    m.start()
+    jobs = [m.enqueue("calc", {}) for _ in range(3)]
+    time.sleep(0.3)
+    c.gate.set()
+    for job in jobs:
+        assert _wait_terminal(db, job["id"])["status"] == "done"
+    assert c.peak == 1
+
+
+def test_memory_budget_admission(db, make_manager):
+    c = _Concurrency()
+    m = make_manager(
+        {"calc": c.handler},
+        max_workers=3,
+        memory_budget_mb=1000,
+        estimators={"calc": lambda params, db: params["mem"]},
+    )
+    m.start()
+    # 600 + 600 超预算，不能同时运行；超预算的单个任务在空闲时仍会运行
+    jobs = [m.enqueue("calc", {"mem": 600}), m.enqueue("calc", {"mem": 600}), m.enqueue("calc", {"mem": 5000})]
+    time.sleep(0.3)
+    c.gate.set()
+    for job in jobs:
+        assert _wait_terminal(db, job["id"])["status"] == "done"
+    assert c.peak == 1
+    assert db.get_job(jobs[2]["id"])["mem_mb"] == 5000
+
+
+def test_cancel_running_job(db, make_manager):
+    started = threading.Event()
+
+    def handler(params, ctx):
+        started.set()
+        while True:
+            ctx.progress(0.1)
+            time.sleep(0.02)
+
+    discarded = []
+    m = make_manager({"calc": handler}, discard_outputs=discarded.append)
+    m.start()
+    job = m.enqueue("calc", {})
+    assert started.wait(5)
+    m.cancel(job["id"])
+    job = _wait_terminal(db, job["id"])
+    assert job["status"] == "cancelled"
+    assert discarded == [job["id"]]
+
+
+def test_timeout_marks_job_as_error(db, make_manager):
+    def handler(params, ctx):
+        while True:
+            ctx.check()
+            time.sleep(0.02)
+
+    m = make_manager({"calc": handler}, timeouts={"calc": 0.2})
+    m.start()
+    job = _wait_terminal(db, m.enqueue("calc", {})["id"])
+    assert job["status"] == "error"
+    assert "timed out" in job["message"]
+
+
+def test_failed_job_discards_outputs_and_runs_finish_hook(db, make_manager):
+    def handler(params, ctx):
+        raise RuntimeError("boom")
+
+    discarded = []
+    finished = []
+    m = make_manager({"calc": handler}, discard_outputs=discarded.append, on_finish={"calc": finished.append})
+    m.start()
+    job = _wait_terminal(db, m.enqueue("calc", {})["id"])
+    assert job["status"] == "error"
+    assert job["message"].startswith("boom")
+    assert discarded == [job["id"]]
+    deadline = time.monotonic() + 5
+    while not finished and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert [j["id"] for j in finished] == [job["id"]]
+    assert finished[0]["status"] == "error"
+
+
+def test_cache_hit_completes_without_running(db, make_manager):
+    calls = []
+
+    def handler(params, ctx):
+        calls.append(params)
+        asset_id = f"out-{len(calls)}"
+        _insert_asset(db, asset_id)
+        return JobResult(output_asset_id=asset_id, message="ok")
+
+    m = make_manager({"calc": handler}, cache_keys={"calc": lambda params, db: f"calc:{params['expr']}"})
+    m.start()
+    first = _wait_terminal(db, m.enqueue("calc", {"expr": "A+1"})["id"])
+    assert first["output_asset_id"] == "out-1"
+
+    cached = m.enqueue("calc", {"expr": "A+1"})
+    assert cached["status"] == "done"
+    assert cached["message"] == "ok (cached)"
+    assert cached["output_asset_id"] == "out-1"
+    assert len(calls) == 1
+
+    # 输出资产删除后缓存失效，重新计算
+    db.delete_asset("out-1")
+    again = _wait_terminal(db, m.enqueue("calc", {"expr": "A+1"})["id"])
+    assert again["output_asset_id"] == "out-2"
+    assert len(calls) == 2
+
+
+def test_start_requeues_orphaned_jobs_and_discards_their_outputs(db, make_manager, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_ATTEMPTS", 3)
+    _insert_job(db, "orphan")
+    db.claim_next_job()  # 模拟上次进程崩溃时正在运行
+
+    discarded = []
+    m = make_manager({"calc": lambda params, ctx: JobResult(message="ok")}, discard_outputs=discarded.append)
+    m.start()
+    job = _wait_terminal(db, "orphan")
+    assert job["status"] == "done"
+    assert job["attempts"] == 2
+    assert discarded == ["orphan"]
+
+
+def test_enqueue_unknown_kind(db, make_manager):
+    m = make_manager({"calc": lambda params, ctx: JobResult()})
+    with pytest.raises(ValueError):
+        m.enqueue("nope", {})
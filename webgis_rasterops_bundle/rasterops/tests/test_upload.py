@@ -0,0 +1,95 @@
+import hashlib
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("httpx")
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+from starlette.testclient import TestClient  # noqa: E402
+
+from blobstore import BlobStore, BlobTooLarge  # noqa: E402
+from config import settings  # noqa: E402
+from db import DB  # noqa: E402
+from upload import receive_upload  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    db = DB(str(tmp_path / "db" / "rasterops.sqlite"))
+    return BlobStore(db, str(tmp_path / "blobs"))
+
+
+@pytest.fixture
+def client(store):
+    async def upload(request):
+        try:
+            up = await receive_upload(request, store, allowed_exts=(".tif", ".tiff"))
+        except BlobTooLarge as e:
+            return JSONResponse({"detail": str(e)}, status_code=413)
+        except ValueError as e:
+            return JSONResponse({"detail": str(e)}, status_code=400)
+        with open(up.tmp_path, "rb") as f:
+            data = f.read()
+        os.remove(up.tmp_path)
+        return JSONResponse({"filename": up.filename, "size": up.size, "sha256": up.sha256, "data": data.decode("latin-1")})
+
+    return TestClient(Starlette(routes=[Route("/upload", upload, methods=["POST"])]))
+
+
+def _tmp_files(store):
+    return os.listdir(os.path.join(store.root, "tmp"))
+
+
+def test_streams_file_field(client, store, monkeypatch):
+    # 小块写出，覆盖跨多次 parser.write / 攒批写入的路径
+    monkeypatch.setattr(settings, "UPLOAD_CHUNK_BYTES", 7)
+    payload = bytes(range(256)) * 40
+    r = client.post(
+        "/upload",
+        data={"note": "before the file"},
+        files={"file": ("scene.TIF", payload, "image/tiff")},
+    )
+    assert r.status_code == 200, r.text
+    body = r.json()
+    assert body["filename"] == "scene.TIF"
+    assert body["size"] == len(payload)
+    assert body["sha256"] == hashlib.sha256(payload).hexdigest()
+    assert body["data"].encode("latin-1") == payload
+    assert _tmp_files(store) == []
+
+
+def test_rejects_bad_extension(client, store):
+    r = client.post("/upload", files={"file": ("notes.txt", b"hello", "text/plain")})
+    assert r.status_code == 400
+    assert _tmp_files(store) == []
+
+
+def test_requires_file_field(client, store):
+    r = client.post("/upload", files={"other": ("a.tif", b"x", "image/tiff")})
+    assert r.status_code == 400
+    r = client.post("/upload", content=b"raw", headers={"content-type": "application/octet-stream"})
+    assert r.status_code == 400
+    assert _tmp_files(store) == []
+
+
+def test_rejects_oversized_body(client, store, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_BYTES", 100)
+    monkeypatch.setattr(settings, "UPLOAD_CHUNK_BYTES", 16)
+    # 未超过 Content-Length 预检的余量：边读边检查
+    r = client.post("/upload", files={"file": ("a.tif", b"x" * 101, "image/tiff")})
+    assert r.status_code == 413
+    # Content-Length 明显超限：不读请求体直接拒绝
+    r = client.post("/upload", files={"file": ("a.tif", b"x" * (200 << 10), "image/tiff")})
+    assert r.status_code == 413
+    assert _tmp_files(store) == []
+
+    r = client.post("/upload", files={"file": ("a.tif", b"x" * 100, "image/tiff")})
+    assert r.status_code == 200
+    assert r.json()["size"] == 100